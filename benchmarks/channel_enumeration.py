@@ -0,0 +1,103 @@
+"""
+Benchmark of channel enumeration in TaskGenerator.
+
+Channel listings are replaced by synthetic channels that return pages of 30 videos with a fixed page
+latency, mimicking scrapetube. The previous sequential enumeration, which lists every channel in full
+before emitting tasks, is compared against the concurrent lazy enumeration. Reports the time to the
+first task, the total time and the number of tasks, with and without the channel budget cut-off and the listing
+duration pre-filter, and the number of videos rejected from their listing duration, which skip extract_info.
+Past responses are read from and rejections written to a moto DynamoDB stand-in.
+
+Run from the repository root:
+    python -m benchmarks.channel_enumeration --channels 8 --videos-per-channel 600 --page-latency-s 0.2
+"""
+import argparse
+import time
+from decimal import Decimal
+
+import boto3
+from moto import mock_aws
+
+from yt_dl import DynamoDBHelper, TaskGenerator
+
+PAGE_SIZE = 30
+# Listed durations, two out of six are in the configured range
+LENGTH_TEXTS = ('3:20', '7:45', '12:30', '25:10', '48:00', '1:32:15')
+INPUT_CFG = {
+    'min_audio_duration_M': 10,
+    'max_audio_duration_M': 30,
+    'max_download_H_per_channel': 1,
+    'max_downloaded_videos_per_channel': 9,
+    'min_successful_download_ration': 0.05
+}
+
+
+def create_table(table_name: str, key_schema: list) -> None:
+    boto3.resource('dynamodb', region_name='us-east-1').create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': name, 'KeyType': key_type} for name, key_type in key_schema],
+        AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name, _ in key_schema],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def make_channel_listing(videos_per_channel: int, page_latency_s: float):
+
+    def iter_channel_videos(channel_url: str, page_sleep_s: float = 1):
+        channel_id = channel_url.split('@')[-1]
+        for i in range(videos_per_channel):
+            # Every page is one round trip
+            if i % PAGE_SIZE == 0:
+                time.sleep(page_latency_s)
+            yield {'videoId': f'{channel_id}_{i:06d}', 'lengthText': {'simpleText': LENGTH_TEXTS[i % len(LENGTH_TEXTS)]}}
+    return iter_channel_videos
+
+
+def sequential_enumeration(channels: list, dynamo_hlp_instance: DynamoDBHelper, iter_channel_videos_fn) -> list:
+    # Baseline: list every channel in full, one after another
+    tasks = list()
+    for channel_id, channel_url in channels:
+        videos_metadata = list(iter_channel_videos_fn(channel_url))
+        attempted_video_ids = TaskGenerator._get_attempted_video_ids(channel_id.replace('@', ''), dynamo_hlp_instance)
+        tasks += [video['videoId'] for video in videos_metadata if video['videoId'] not in attempted_video_ids]
+    return tasks
+
+
+def measure(name: str, enumerate_fn, *args, **kwargs) -> None:
+    st = time.time()
+    first_task_s, n_tasks = None, 0
+    for _ in enumerate_fn(*args, **kwargs):
+        first_task_s = first_task_s or time.time() - st
+        n_tasks += 1
+    print(f'{name:<12} first_task={first_task_s:.2f}s total={time.time() - st:.2f}s tasks={n_tasks}')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark sequential and concurrent channel enumeration.')
+    parser.add_argument('--channels', type=int, default=8)
+    parser.add_argument('--videos-per-channel', type=int, default=600)
+    parser.add_argument('--page-latency-s', type=float, default=0.2)
+    args = parser.parse_args()
+
+    channels = [[f'@channel{i}', f'https://www.youtube.com/@channel{i}'] for i in range(args.channels)]
+    iter_channel_videos = make_channel_listing(args.videos_per_channel, args.page_latency_s)
+
+    with mock_aws():
+        create_table('VideoChannelInfoTable', [('channel_id', 'HASH'), ('video_id', 'RANGE')])
+        create_table('ChannelStatsTable', [('channel_id', 'HASH')])
+        dynamo_hlp_instance = DynamoDBHelper(table_name='VideoChannelInfoTable')
+        stats_hlp_instance = DynamoDBHelper(table_name='ChannelStatsTable')
+        # One channel already exhausted its budget
+        stats_hlp_instance.import_item({
+            'channel_id': 'channel0', 'downloaded_seconds': Decimal(2 * 60 * 60),
+            'success_count': 3, 'attempt_count': 3, 'channel_status': 'Active'
+        })
+
+        measure('sequential', sequential_enumeration, channels, dynamo_hlp_instance, iter_channel_videos)
+        measure('concurrent', TaskGenerator.extract_channel_video_urls, channels, dynamo_hlp_instance,
+                iter_channel_videos_fn=iter_channel_videos)
+        measure('cut-off', TaskGenerator.extract_channel_video_urls, channels, dynamo_hlp_instance,
+                input_cfg=INPUT_CFG, stats_hlp_instance=stats_hlp_instance, iter_channel_videos_fn=iter_channel_videos)
+        dynamo_hlp_instance.flush()
+        print(f'rejected_from_listing={len(dynamo_hlp_instance.query_all_table_items())}')
@@ -0,0 +1,103 @@
+"""
+Benchmark of the "already attempted" lookup used by TaskGenerator.
+
+Compares the per-video `query_items` round trip against the bulk partition query
+of `TaskGenerator._get_attempted_video_ids` on a moto DynamoDB stand-in and reports
+request counts and wall time per 10k videos.
+
+Run from the repository root:
+    python -m benchmarks.dedup_lookup --videos 10000 --attempted-ratio 0.3
+"""
+import argparse
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from moto import mock_aws
+
+from yt_dl import DynamoDBHelper, TaskGenerator
+
+TABLE_NAME = 'VideoChannelInfoTable'
+CHANNEL_ID = 'benchmark_channel'
+
+
+def create_table(dynamo_hlp_instance: DynamoDBHelper, video_ids: list, attempted_ratio: float) -> None:
+    dynamodb = boto3.resource('dynamodb', region_name=dynamo_hlp_instance.dynamodb_table.meta.client.meta.region_name)
+    dynamodb.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[
+            {'AttributeName': 'channel_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'video_id', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'channel_id', 'AttributeType': 'S'},
+            {'AttributeName': 'video_id', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    # Mark a share of the videos as already attempted
+    with dynamodb.Table(TABLE_NAME).batch_writer() as batch:
+        for video_id in video_ids[:int(len(video_ids) * attempted_ratio)]:
+            batch.put_item(Item={
+                'channel_id': CHANNEL_ID,
+                'video_id': video_id,
+                'download_status': True,
+                'channel_status': 'Active',
+                'video_title': 'x' * 64
+            })
+
+
+def per_video_lookup(dynamo_hlp_instance: DynamoDBHelper, video_ids: list) -> list:
+    # Baseline: one query round trip per video
+    tasks = list()
+    for video_id in video_ids:
+        res = dynamo_hlp_instance.query_items({
+            "KeyConditionExpression": Key('channel_id').eq(CHANNEL_ID) & Key('video_id').eq(video_id),
+            "ProjectionExpression": 'download_status'
+        })
+        if res['Count'] > 0:
+            continue
+        tasks.append(video_id)
+    return tasks
+
+
+def bulk_lookup(dynamo_hlp_instance: DynamoDBHelper, video_ids: list) -> list:
+    attempted_video_ids = TaskGenerator._get_attempted_video_ids(CHANNEL_ID, dynamo_hlp_instance)
+    return [video_id for video_id in video_ids if video_id not in attempted_video_ids]
+
+
+def measure(name: str, lookup_fn, dynamo_hlp_instance: DynamoDBHelper, video_ids: list) -> list:
+    requests = {'count': 0}
+
+    def count_request(**kwargs):
+        requests['count'] += 1
+
+    events = dynamo_hlp_instance.dynamodb_table.meta.client.meta.events
+    events.register('before-call.dynamodb', count_request)
+    st = time.time()
+    tasks = lookup_fn(dynamo_hlp_instance, video_ids)
+    elapsed = time.time() - st
+    events.unregister('before-call.dynamodb', count_request)
+
+    scale = 10000 / len(video_ids)
+    print(f'{name:<12} tasks={len(tasks):<7} requests={requests["count"]:<7} '
+          f'time={elapsed:.2f}s requests/10k={requests["count"] * scale:.0f} time/10k={elapsed * scale:.2f}s')
+    return tasks
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the already-attempted video lookup.')
+    parser.add_argument('--videos', type=int, default=10000)
+    parser.add_argument('--attempted-ratio', type=float, default=0.3)
+    args = parser.parse_args()
+
+    video_ids = [f'{i:011d}' for i in range(args.videos)]
+
+    with mock_aws():
+        dynamo_hlp_instance = DynamoDBHelper(table_name=TABLE_NAME)
+        create_table(dynamo_hlp_instance, video_ids, args.attempted_ratio)
+
+        baseline_tasks = measure('per-video', per_video_lookup, dynamo_hlp_instance, video_ids)
+        bulk_tasks = measure('bulk', bulk_lookup, dynamo_hlp_instance, video_ids)
+        assert baseline_tasks == bulk_tasks, 'Bulk lookup returned different tasks!'
@@ -0,0 +1,81 @@
+"""
+Benchmark of download report writes to DynamoDB.
+
+Worker threads write download report items to a moto stand-in of the responses table, each request delayed by
+`--latency-ms` to stand in for the network round trip, once with one `put_item` per item (DynamoDBHelper.import_item)
+and once through the buffered writer (DynamoDBHelper.import_item_buffered followed by a flush). Reports the writes
+per second, the time the worker threads were blocked per item and the number of requests sent. Runs entirely locally.
+
+Run from the repository root:
+    python -m benchmarks.dynamo_writes --items 2000 --threads 8 --latency-ms 10
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from moto import mock_aws
+
+from benchmarks.fakes import RoundTrip, create_table, measure
+from yt_dl.aws_helpers import AWSClientPool, DynamoDBHelper
+
+N_CHANNELS = 20
+KEY_SCHEMA = [('channel_id', 'HASH'), ('video_id', 'RANGE')]
+
+
+def report_item(i: int) -> dict:
+    return {
+        'channel_id': f'channel{i % N_CHANNELS}',
+        'video_id': f'{i:011d}',
+        'video_wpm': Decimal('151.2'),
+        'video_duration': 600,
+        'video_title': f'Video {i}',
+        'update_time': '2024-01-01 00:00:00',
+        'channel_status': 'Active',
+        'download_status': True,
+        'reason': None
+    }
+
+
+def write_reports(dynamo_hlp_instance: DynamoDBHelper, n_items: int, n_threads: int, buffered: bool) -> float:
+    # Write the reports from the worker threads, returns the time the threads were blocked
+    write_fn = dynamo_hlp_instance.import_item_buffered if buffered else dynamo_hlp_instance.import_item
+
+    def write(i: int) -> float:
+        st = time.perf_counter()
+        write_fn(report_item(i))
+        return time.perf_counter() - st
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        blocked_s = sum(executor.map(write, range(n_items)))
+    dynamo_hlp_instance.flush()
+    return blocked_s
+
+
+def run(name: str, table_name: str, n_items: int, n_threads: int, round_trip: RoundTrip, buffered: bool) -> None:
+    create_table(table_name, KEY_SCHEMA)
+    dynamo_hlp_instance = DynamoDBHelper(table_name=table_name)
+    # Set up the table binding and the writer before timing
+    dynamo_hlp_instance.dynamodb_table.load()
+    if buffered is True:
+        dynamo_hlp_instance.buffered_writer
+
+    blocked_s = measure(name, lambda: write_reports(dynamo_hlp_instance, n_items, n_threads, buffered), round_trip, n_items)
+    n_written = len(dynamo_hlp_instance.query_all_table_items())
+    assert n_written == n_items
+    print(f'{name:<22} written={n_written} blocked_per_item={blocked_s / n_items * 1000:.2f}ms')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Write download reports one by one and buffered.')
+    parser.add_argument('--items', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=10)
+    args = parser.parse_args()
+
+    with mock_aws():
+        round_trip = RoundTrip(args.latency_ms / 1000)
+        AWSClientPool.register_event_handler('before-call.dynamodb', round_trip.before_call)
+        run('put_item', 'PutItemTable', args.items, args.threads, round_trip, buffered=False)
+        run('buffered', 'BufferedTable', args.items, args.threads, round_trip, buffered=True)
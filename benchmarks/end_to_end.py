@@ -0,0 +1,186 @@
+"""
+End-to-end benchmark of the pipeline on local fakes of YouTube and AWS.
+
+`pipeline.run_pipeline` generates the tasks of `--channels` synthetic channels, downloads the videos passing the
+constraints and generates the reports. YouTube is served by the fakes of benchmarks/fakes.py, with the latencies and
+error rates of the arguments, and DynamoDB and S3 by moto, in-process for the sequential and thread modes and as a
+local moto server for the Ray mode. Each mode runs in a fresh process:
+    sequential  one video after another in the driver, yt_dl transcodes in the downloading thread
+    thread      prefetching threads and StagedEngine, with download threads and transcoding processes
+    ray         prefetching threads and a pool of local Ray actors
+Reports the downloaded videos per second, the p50 and p99 of every stage and the peak RSS of the driver, which holds
+the moto stand-ins and includes its finished transcoding processes, and of the largest actor. The Ray mode requires
+moto[server], from requirements-dev.txt.
+
+Run from the repository root:
+    python -m benchmarks.end_to_end --modes sequential thread ray --channels 4 --videos-per-channel 60
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+MODES = {
+    'sequential': {'use_ray': False, 'use_prefetch': False, 'split_transcode': False},
+    'thread': {'use_ray': False, 'use_prefetch': True, 'split_transcode': True},
+    'ray': {'use_ray': True, 'use_actors': True, 'use_prefetch': True}
+}
+INPUT_CFG = {
+    'captions_language': 'en',
+    'min_audio_duration_M': 5,
+    'max_audio_duration_M': 30,
+    'min_wpm': 120,
+    'skip_low_wpm_channels': False,
+    'max_download_H_per_channel': 1000,
+    'min_successful_download_ration': 0.05,
+    'stream_audio': False,
+    'transcript_format': 'srt',
+    'requests': {
+        'rate_limits_per_s': {'www.youtube.com': 1000, 'googlevideo.com': 1000},
+        'proxies': [],
+        'use_free_proxies': False,
+        'max_attempts': 3
+    }
+}
+TABLES = {
+    'VideoChannelInfoTable': [('channel_id', 'HASH'), ('video_id', 'RANGE')],
+    'ChannelStatsTable': [('channel_id', 'HASH')]
+}
+BUCKETS = ('ytdldata', 'ytdlreports')
+
+
+def create_resources() -> None:
+    from yt_dl.aws_helpers import AWSClientPool
+    for table_name, key_schema in TABLES.items():
+        AWSClientPool.resource('dynamodb').create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': name, 'KeyType': key_type} for name, key_type in key_schema],
+            AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name, _ in key_schema],
+            BillingMode='PAY_PER_REQUEST'
+        )
+    for bucket in BUCKETS:
+        AWSClientPool.client('s3').create_bucket(Bucket=bucket)
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_mode(mode: str, settings: dict, args: argparse.Namespace) -> dict:
+    # Runs in the process of the mode, the modules under test are imported once the fakes are set up
+    from moto import mock_aws
+
+    from benchmarks import fakes
+
+    if mode == 'ray':
+        # Ray workers reach the moto server through the standard endpoint variable of botocore
+        from moto.server import ThreadedMotoServer
+        port = get_free_port()
+        server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+        server.start()
+        os.environ['AWS_ENDPOINT_URL'] = f'http://127.0.0.1:{port}'
+        aws = contextlib.nullcontext()
+    else:
+        aws = mock_aws()
+
+    with aws:
+        youtube = fakes.install(settings)
+        create_resources()
+
+        import pipeline
+        import ray
+        from yt_dl import SQLiteTaskQueue
+
+        if mode == 'ray':
+            ray.init(runtime_env={
+                'worker_process_setup_hook': fakes.worker_setup_hook,
+                'env_vars': {fakes.ENV_VAR: os.environ[fakes.ENV_VAR], 'AWS_ENDPOINT_URL': os.environ['AWS_ENDPOINT_URL'], 'PYTHONPATH': os.getcwd()}
+            })
+        input_file = {
+            'channels': fakes.FakeYouTube.get_channels(settings['channels']),
+            'configuration': {**INPUT_CFG, 'max_downloaded_videos_per_channel': settings['videos_per_channel']}
+        }
+        run_id = f'benchmark-{mode}'
+        summary = pipeline.run_pipeline(
+            input_file,
+            run_id=run_id,
+            run_locally=True,
+            actors_per_node=args.actors_per_node,
+            prefetch_concurrency=args.prefetch_concurrency,
+            download_concurrency=args.download_concurrency,
+            task_queue=SQLiteTaskQueue(os.path.join(settings['work_dir'], 'tasks.sqlite'), run_id=run_id, retry_backoff_s=0),
+            transcode_fn=fakes.transcode,
+            **fakes.get_clients(youtube),
+            **MODES[mode]
+        )
+    return summary
+
+
+def print_summary(mode: str, summary: dict) -> None:
+    peak_rss_B = ' '.join(f'peak_rss_{name}={rss_B / 2**20:.0f}MiB' for name, rss_B in summary['peak_rss_B'].items() if rss_B is not None)
+    print(f"{mode:<10} downloaded={summary['n_downloaded']} videos={summary['profile']['videos']} "
+          f"downloaded/s={summary['n_downloaded'] / summary['elapsed_s']:.2f} time={summary['elapsed_s']:.1f}s {peak_rss_B}")
+    for stage, stats in summary['profile']['stages'].items():
+        print(f"    {stage:<20} n={stats['count']:<5} p50={stats['p50_s']:.3f}s p99={stats['p99_s']:.3f}s")
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Run the pipeline end to end on local fakes of YouTube and AWS.')
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--videos-per-channel', type=int, default=60)
+    parser.add_argument('--extract-latency-s', type=float, default=0.1)
+    parser.add_argument('--transcript-latency-s', type=float, default=0.05)
+    parser.add_argument('--download-latency-s', type=float, default=0.2)
+    parser.add_argument('--transcode-s-per-M', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--aws-latency-s', type=float, default=0.005)
+    parser.add_argument('--prefetch-concurrency', type=int, default=16)
+    parser.add_argument('--download-concurrency', type=int, default=4)
+    parser.add_argument('--actors-per-node', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    # Set in the process of a mode
+    parser.add_argument('--run-mode', choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument('--settings', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode is not None:
+        summary = run_mode(args.run_mode, json.loads(args.settings), args)
+        print('RESULT ' + json.dumps(summary, default=str))
+        sys.exit(0)
+
+    for mode in args.modes:
+        if mode == 'ray' and importlib.util.find_spec('flask') is None:
+            print(f'{mode:<10} skipped, requires moto[server]')
+            continue
+        with tempfile.TemporaryDirectory() as work_dir:
+            settings = {
+                'seed': args.seed,
+                'channels': args.channels,
+                'videos_per_channel': args.videos_per_channel,
+                'extract_latency_s': args.extract_latency_s,
+                'transcript_latency_s': args.transcript_latency_s,
+                'download_latency_s': args.download_latency_s,
+                'transcode_s_per_M': args.transcode_s_per_M,
+                'extract_error_rate': args.error_rate,
+                'download_error_rate': args.error_rate,
+                'aws_latency_s': args.aws_latency_s,
+                'work_dir': work_dir
+            }
+            completed = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.end_to_end', *sys.argv[1:], '--run-mode', mode, '--settings', json.dumps(settings)],
+                capture_output=True, text=True
+            )
+        results = [line for line in completed.stdout.splitlines() if line.startswith('RESULT ')]
+        if completed.returncode != 0 or len(results) == 0:
+            print(f'{mode:<10} failed\n{completed.stdout[-4000:]}\n{completed.stderr[-4000:]}')
+            continue
+        print_summary(mode, json.loads(results[-1][len('RESULT '):]))
@@ -0,0 +1,258 @@
+"""
+Local fakes of YouTube and helpers of the AWS stand-ins for the offline benchmarks.
+
+FakeYouTube serves synthetic channel listings, `extract_info` dicts, transcripts and audio files. Latencies, error
+rates, audio sizes and transcoding CPU time are set by the settings, and every video is generated from the seed and
+its ID, so all processes of a run see the same videos. `get_clients` returns the extractor, the transcript fetch and
+the channel listing to pass to `run_pipeline`, which hands them to the workers. `install` sets the work directory
+of the run and delays every AWS request by `aws_latency_s` in the current process, Ray workers install it with
+`worker_setup_hook`, from the settings in the `YT_DL_FAKE_YOUTUBE` environment variable, and `transcode` stands in
+for ffmpeg in the transcoding processes. AWS is replaced by moto in the benchmarks, `RoundTrip` delays and counts
+its requests, `measure` times a benchmark step with its requests and `create_table` creates a table with string keys.
+"""
+import functools
+import json
+import os
+import random
+import time
+
+from yt_dlp.utils import DownloadError
+
+from yt_dl.aws_helpers import AWSClientPool
+from yt_dl.worker_context import WorkerContext
+
+ENV_VAR = 'YT_DL_FAKE_YOUTUBE'
+DEFAULT_SETTINGS = {
+    'seed': 0,
+    'channels': 4,
+    'videos_per_channel': 60,
+    # Median and spread of the video durations, lognormal
+    'median_duration_M': 15,
+    'duration_sigma': 0.6,
+    'median_wpm': 170,
+    'listing_page_latency_s': 0.05,
+    'extract_latency_s': 0.1,
+    'transcript_latency_s': 0.05,
+    'download_latency_s': 0.2,
+    'bandwidth_MBps': 20,
+    'audio_KB_per_M': 32,
+    'transcode_s_per_M': 0.01,
+    'extract_error_rate': 0.02,
+    'download_error_rate': 0.02,
+    'missing_transcript_rate': 0.05,
+    'aws_latency_s': 0.005,
+    # Response caches and shards of the run
+    'work_dir': None
+}
+PAGE_SIZE = 30
+SEGMENT_S = 3
+
+
+class RoundTrip:
+
+    def __init__(self, latency_s: float) -> None:
+        self.latency_s = latency_s
+        self.requests = 0
+
+    def before_call(self, **kwargs) -> None:
+        # Stands in for the network round trip of an AWS request
+        self.requests += 1
+        time.sleep(self.latency_s)
+
+
+def measure(name: str, fn, round_trip: RoundTrip, n_items: int = None):
+    # Time `fn` and count the AWS requests it sends, returns its result
+    n_requests = round_trip.requests
+    st = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - st
+    throughput = f' items/s={n_items / elapsed:.1f}' if n_items is not None else ''
+    print(f'{name:<22}{throughput} requests={round_trip.requests - n_requests} time={elapsed:.2f}s')
+    return result
+
+
+def create_table(table_name: str, key_schema: list) -> None:
+    # `key_schema` lists the names and key types of the string keys
+    AWSClientPool.resource('dynamodb').create_table(
+        TableName=table_name,
+        KeySchema=[{'AttributeName': name, 'KeyType': key_type} for name, key_type in key_schema],
+        AttributeDefinitions=[{'AttributeName': name, 'AttributeType': 'S'} for name, _ in key_schema],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def burn_cpu(seconds: float) -> None:
+    # Busy loop, transcoding keeps a CPU busy
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+class FakeYouTube:
+
+    def __init__(self, settings: dict) -> None:
+        self.settings = {**DEFAULT_SETTINGS, **settings}
+
+    @staticmethod
+    def get_channel_name(channel: int) -> str:
+        return f'fakechannel{channel:03d}'
+
+    @classmethod
+    def get_channels(cls, n_channels: int) -> list:
+        # Channels in the format of the input file
+        return [[f'@{cls.get_channel_name(channel)}', f'https://www.youtube.com/@{cls.get_channel_name(channel)}'] for channel in range(n_channels)]
+
+    @staticmethod
+    def get_video_id(channel: int, i: int) -> str:
+        return f'c{channel:03d}v{i:06d}'
+
+    def _rng(self, video_id: str, purpose: str) -> random.Random:
+        return random.Random(f"{self.settings['seed']}:{video_id}:{purpose}")
+
+    def get_duration_s(self, video_id: str) -> int:
+        rng = self._rng(video_id, 'duration')
+        return max(30, int(self.settings['median_duration_M'] * 60 * rng.lognormvariate(0, self.settings['duration_sigma'])))
+
+    def get_audio_size_B(self, video_id: str) -> int:
+        return int(self.get_duration_s(video_id) / 60 * self.settings['audio_KB_per_M'] * 2**10)
+
+    def iter_channel_videos(self, channel_url: str, page_sleep_s: float = 1):
+        # Listing of the newest videos first, one round trip per page
+        channel = int(channel_url.split('@fakechannel')[-1])
+        for i in range(self.settings['videos_per_channel']):
+            if i % PAGE_SIZE == 0:
+                time.sleep(self.settings['listing_page_latency_s'])
+            video_id = self.get_video_id(channel, i)
+            minutes, seconds = divmod(self.get_duration_s(video_id), 60)
+            yield {'videoId': video_id, 'lengthText': {'simpleText': f'{minutes}:{seconds:02d}'}}
+
+    def get_info(self, video_id: str) -> dict:
+        time.sleep(self.settings['extract_latency_s'])
+        if self._rng(video_id, 'extract_error').random() < self.settings['extract_error_rate']:
+            raise DownloadError(f'ERROR: [youtube] {video_id}: Video unavailable')
+        rng = self._rng(video_id, 'info')
+        channel_name = self.get_channel_name(int(video_id[1:4]))
+        return {
+            'id': video_id,
+            'title': f'Video {video_id}',
+            'uploader_url': f'https://www.youtube.com/@{channel_name}',
+            'duration': self.get_duration_s(video_id),
+            'view_count': rng.randint(100, 10**6),
+            'like_count': rng.randint(0, 10**4),
+            'upload_date': f'2024{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}'
+        }
+
+    def fetch_transcript(self, video_id: str, cap_lng: str, proxy: str = None) -> tuple:
+        time.sleep(self.settings['transcript_latency_s'])
+        rng = self._rng(video_id, 'transcript')
+        if rng.random() < self.settings['missing_transcript_rate']:
+            return None, 'Captions unavailable', True
+        # Segments of a few words at the speaking rate of the video
+        words_per_segment = max(1, round(rng.gauss(self.settings['median_wpm'], 30) * SEGMENT_S / 60))
+        return [
+            {'text': ' '.join(f'word{(start_s + j) % 97}' for j in range(words_per_segment)), 'start': float(start_s), 'duration': float(SEGMENT_S)}
+            for start_s in range(0, self.get_duration_s(video_id), SEGMENT_S)
+        ], '', True
+
+    def download_audio(self, video_id: str, path: str) -> int:
+        # Network transfer time of the audio file, then the file is written
+        size_B = self.get_audio_size_B(video_id)
+        time.sleep(self.settings['download_latency_s'] + size_B / (self.settings['bandwidth_MBps'] * 2**20))
+        if self._rng(video_id, 'download_error').random() < self.settings['download_error_rate']:
+            raise DownloadError(f'ERROR: [download] {video_id}: HTTP Error 500: Internal Server Error')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'wb') as audio_file:
+            audio_file.write(os.urandom(size_B))
+        return size_B
+
+    def transcode(self, input_path: str, output_path: str) -> None:
+        # Output of about half the size of the input, after the CPU time of the audio duration
+        size_B = os.path.getsize(input_path)
+        burn_cpu(size_B / 2**10 / self.settings['audio_KB_per_M'] * self.settings['transcode_s_per_M'])
+        with open(input_path, 'rb') as input_file, open(output_path, 'wb') as output_file:
+            output_file.write(input_file.read(size_B // 2))
+
+
+class FakeYoutubeDL:
+    """ Stand-in of yt_dlp.YoutubeDL serving FakeYouTube videos, with the extractor API used by yt_dl. """
+
+    def __init__(self, params: dict = None, auto_init: bool = True, youtube: FakeYouTube = None) -> None:
+        self.params = params or dict()
+        self.youtube = youtube
+        self._progress_hooks = list()
+        self._postprocessor_hooks = list()
+
+    def add_progress_hook(self, hook) -> None:
+        self._progress_hooks.append(hook)
+
+    def add_postprocessor_hook(self, hook) -> None:
+        self._postprocessor_hooks.append(hook)
+
+    @staticmethod
+    def sanitize_info(info: dict, remove_private_keys: bool = False) -> dict:
+        return info
+
+    def _get_path(self, video_id: str, ext: str) -> str:
+        return self.params.get('outtmpl', '%(id)s.%(ext)s') % {'id': video_id, 'ext': ext}
+
+    def extract_info(self, url: str, download: bool = True, **kwargs) -> dict:
+        video_id = url.split('v=')[-1]
+        info = self.youtube.get_info(video_id)
+        if download is True:
+            # The best audio as served, converted to FLAC if postprocessors are configured
+            raw_path = self._get_path(video_id, 'webm')
+            size_B = self.youtube.download_audio(video_id, raw_path)
+            for hook in self._progress_hooks:
+                hook({'status': 'finished', 'filename': raw_path, 'total_bytes': size_B})
+            filepath = raw_path
+            if len(self.params.get('postprocessors', [])) > 0:
+                for hook in self._postprocessor_hooks:
+                    hook({'status': 'started', 'postprocessor': 'ExtractAudio'})
+                filepath = self._get_path(video_id, 'flac')
+                self.youtube.transcode(raw_path, filepath)
+                os.remove(raw_path)
+                for hook in self._postprocessor_hooks:
+                    hook({'status': 'finished', 'postprocessor': 'ExtractAudio'})
+            info['requested_downloads'] = [{'filepath': filepath}]
+        return info
+
+    def download(self, urls: list) -> int:
+        for url in urls:
+            self.extract_info(url, download=True)
+        return 0
+
+
+def transcode(input_path: str, output_path: str, ffmpeg_path: str, postprocessor_args: list, delete_input: bool = True) -> float:
+    # Stand-in of AudioTranscoder.transcode, runs in the spawned transcoding processes
+    st = time.perf_counter()
+    FakeYouTube(json.loads(os.environ[ENV_VAR])).transcode(input_path, output_path)
+    if delete_input is True:
+        os.remove(input_path)
+    return time.perf_counter() - st
+
+
+def get_clients(youtube: FakeYouTube) -> dict:
+    # YouTube clients of run_pipeline, sent along to the Ray workers
+    return {
+        'ydl_cls': functools.partial(FakeYoutubeDL, youtube=youtube),
+        'fetch_transcript_fn': youtube.fetch_transcript,
+        'iter_channel_videos_fn': youtube.iter_channel_videos
+    }
+
+
+def install(settings: dict) -> FakeYouTube:
+    # Set up the run in this process, child processes get the settings from the environment
+    settings = {**DEFAULT_SETTINGS, **settings}
+    os.environ[ENV_VAR] = json.dumps(settings)
+    youtube = FakeYouTube(settings)
+    if settings['work_dir'] is not None:
+        WorkerContext.RESPONSE_CACHE_PATHS = {run_locally: os.path.join(settings['work_dir'], 'cache', 'responses.sqlite') for run_locally in (True, False)}
+        WorkerContext.SHARD_DIRS = {run_locally: os.path.join(settings['work_dir'], 'shards') for run_locally in (True, False)}
+    if settings['aws_latency_s'] > 0:
+        AWSClientPool.register_event_handler('before-call', RoundTrip(settings['aws_latency_s']).before_call)
+    return youtube
+
+
+def worker_setup_hook() -> None:
+    # Ray worker processes set up the run of the driver
+    install(json.loads(os.environ[ENV_VAR]))
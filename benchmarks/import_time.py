@@ -0,0 +1,51 @@
+"""
+Benchmark of the import time of the yt_dl modules, as paid by every new Ray worker process.
+
+Each module is imported in a fresh interpreter with `python -X importtime`. Reports the median total import time
+over the repeats and which of the heavy dependencies the import loaded. The `eager` row imports all modules, as
+importing the package did before its attributes were loaded lazily.
+
+Run from the repository root:
+    python -m benchmarks.import_time --repeats 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+TARGETS = {
+    'package': 'import yt_dl',
+    'downloader': 'import yt_dl.downloader',
+    'ray_engine': 'import yt_dl.ray_engine',
+    'generators': 'import yt_dl.generators',
+    'eager': 'import yt_dl.aws_helpers, yt_dl.downloader, yt_dl.generators, yt_dl.prefetch, yt_dl.profiling, '
+             'yt_dl.scheduler, yt_dl.task_queue, yt_dl.worker_context, yt_dl.ray_engine, yt_dl.staged_engine'
+}
+HEAVY_DEPENDENCIES = ('pandas', 'bs4', 'scrapetube', 'fp', 'yt_dlp', 'youtube_transcript_api', 'boto3', 'ray', 'numpy')
+
+
+def import_time(statement: str) -> tuple:
+    # Total import time in seconds and the top level packages that were imported
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], capture_output=True, text=True, check=True).stderr
+    total_us, modules = 0, set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        modules.add(name.strip())
+        # Top level imports are not indented
+        if not name.startswith('  '):
+            total_us += int(cumulative_us)
+    return total_us / 1e6, modules
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Measure the import time of the yt_dl modules with -X importtime.')
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, statement in TARGETS.items():
+        runs = [import_time(statement) for _ in range(args.repeats)]
+        loaded = [dependency for dependency in HEAVY_DEPENDENCIES if dependency in runs[0][1]]
+        print(f'{name:<11} import={statistics.median(total_s for total_s, _ in runs):.3f}s loaded={",".join(loaded) or "-"}')
@@ -0,0 +1,123 @@
+"""
+Benchmark of the prefetch stage on a local stand-in of the metadata and transcript requests.
+
+MetadataPrefetcher runs with a fake `prepare_fn` that sleeps for a random latency per video, rejects a share of the
+videos and fails another share, and a SQLite task queue. Videos are prefetched one by one, as the download workers
+used to, and with `--concurrency` videos in flight. Checks that the number of videos in flight never exceeds the
+concurrency, that exactly the passing videos are emitted, in the order they finish, that rejected videos are done and
+failed ones failed in the task queue, and that an error of the video ID stream is raised to the consumer.
+
+Run from the repository root:
+    python -m benchmarks.prefetch_stage --videos 200 --concurrency 16 --latency-ms 50
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from yt_dl.prefetch import MetadataPrefetcher
+from yt_dl.task_queue import SQLiteTaskQueue
+
+ORDER_TOLERANCE_S = 0.01
+
+
+class FakePrepare:
+
+    def __init__(self, latency_s: float, reject_rate: float, error_rate: float, seed: int = 0) -> None:
+        self.latency_s = latency_s
+        self.reject_rate = reject_rate
+        self.error_rate = error_rate
+        self.seed = seed
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.finished_at = dict()
+        self._lock = threading.Lock()
+
+    def get_outcome(self, video_id: str) -> str:
+        draw = random.Random(f'{self.seed}:{video_id}').random()
+        if draw < self.error_rate:
+            return 'failed'
+        if draw < self.error_rate + self.reject_rate:
+            return 'rejected'
+        return 'passed'
+
+    def __call__(self, video_id: str, input_cfg: dict, context) -> dict:
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # Latencies vary, so videos finish out of their input order
+            time.sleep(self.latency_s * random.Random(video_id).uniform(0.2, 1.8))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.finished_at[video_id] = time.perf_counter()
+        outcome = self.get_outcome(video_id)
+        if outcome == 'failed':
+            raise RuntimeError(f'{video_id}: HTTP Error 500')
+        return {'video_id': video_id} if outcome == 'passed' else None
+
+
+def failing_ids(video_ids: list, fail_after: int):
+    # Video IDs of a task queue that fails part way through
+    for i, video_id in enumerate(video_ids):
+        if i == fail_after:
+            raise RuntimeError('Task queue unavailable')
+        yield video_id
+
+
+def run(video_ids: list, concurrency: int, args: argparse.Namespace, work_dir: str) -> tuple:
+    task_queue = SQLiteTaskQueue(os.path.join(work_dir, f'tasks-{concurrency}.sqlite'), run_id='prefetch', retry_backoff_s=0)
+    task_queue.add(video_ids)
+    task_queue.seal()
+    prepare_fn = FakePrepare(args.latency_ms / 1000, args.reject_rate, args.error_rate)
+    prefetcher = MetadataPrefetcher(dict(), max_concurrency=concurrency, context=SimpleNamespace(), prepare_fn=prepare_fn, task_queue=task_queue)
+    st = time.perf_counter()
+    emitted = [prepared['video_id'] for prepared in prefetcher.iter_prefetched(task_queue.iter_leased())]
+    elapsed_s = time.perf_counter() - st
+
+    # Bounded concurrency, only passing videos, in the order they finished
+    assert prepare_fn.max_in_flight <= concurrency, f'{prepare_fn.max_in_flight} videos in flight'
+    outcomes = {video_id: prepare_fn.get_outcome(video_id) for video_id in video_ids}
+    assert sorted(emitted) == sorted(video_id for video_id, outcome in outcomes.items() if outcome == 'passed')
+    # Videos finishing in the same wait of the event loop are emitted in any order
+    finished_at = [prepare_fn.finished_at[video_id] for video_id in emitted]
+    assert all(later >= earlier - ORDER_TOLERANCE_S for earlier, later in zip(finished_at, finished_at[1:])), \
+        'videos are not emitted in the order they finish'
+    counts = task_queue.counts()
+    assert counts[task_queue.DONE] == sum(outcome == 'rejected' for outcome in outcomes.values())
+    assert counts[task_queue.PENDING] + counts[task_queue.FAILED] == sum(outcome == 'failed' for outcome in outcomes.values())
+    return elapsed_s, len(emitted), prepare_fn.max_in_flight
+
+
+def check_stream_error(video_ids: list, concurrency: int) -> None:
+    prefetcher = MetadataPrefetcher(dict(), max_concurrency=concurrency, context=SimpleNamespace(), prepare_fn=FakePrepare(0.001, 0, 0))
+    try:
+        for _ in prefetcher.iter_prefetched(failing_ids(video_ids, len(video_ids) // 2)):
+            pass
+    except RuntimeError as exc:
+        print(f'stream error raised to the consumer: {exc}')
+        return
+    raise AssertionError('the error of the video ID stream was not raised')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the prefetch stage against a local stand-in.')
+    parser.add_argument('--videos', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--reject-rate', type=float, default=0.4)
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    args = parser.parse_args()
+
+    video_ids = [f'{i:011d}' for i in range(args.videos)]
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = {concurrency: run(video_ids, concurrency, args, work_dir) for concurrency in (1, args.concurrency)}
+    for concurrency, (elapsed_s, n_emitted, max_in_flight) in results.items():
+        print(f'concurrency={concurrency:<4} time={elapsed_s:.2f}s videos/s={args.videos / elapsed_s:.1f} '
+              f'emitted={n_emitted} max_in_flight={max_in_flight}')
+    check_stream_error(video_ids, args.concurrency)
@@ -0,0 +1,82 @@
+"""
+Benchmark of the request router against a simulated throttling host.
+
+The host allows `--host-limit` requests per second per client address (the direct connection or a proxy) over
+a sliding one-second window and answers HTTP 429 above it. Many threads send requests directly without limits,
+through the adaptive rate limiter only, and through the rate limiter with a proxy pool. Reports the sustained
+successful requests per second and the share of requests that ended throttled.
+
+Run from the repository root:
+    python -m benchmarks.rate_limiting --requests 400 --threads 16 --host-limit 20 --proxies 4
+"""
+import argparse
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from yt_dl.rate_limiting import (ProxyPool, RateLimiter, RequestRouter,
+                                 ThrottledError)
+
+HOST = RequestRouter.YOUTUBE_HOST
+
+
+class ThrottlingHost:
+
+    def __init__(self, limit_per_s: float, latency_s: float = 0.01) -> None:
+        self.limit_per_s = limit_per_s
+        self.latency_s = latency_s
+        self.requests = defaultdict(deque)
+        self.lock = threading.Lock()
+
+    def request(self, proxy: str) -> str:
+        time.sleep(self.latency_s)
+        with self.lock:
+            now = time.monotonic()
+            window = self.requests[proxy]
+            while len(window) > 0 and window[0] < now - 1:
+                window.popleft()
+            window.append(now)
+            if len(window) > self.limit_per_s:
+                raise Exception('HTTP Error 429: Too Many Requests')
+        return 'ok'
+
+
+def measure(name: str, n_requests: int, n_threads: int, send_fn) -> None:
+    outcomes = defaultdict(int)
+
+    def send(_):
+        try:
+            send_fn()
+            outcomes['ok'] += 1
+        except (ThrottledError, Exception):
+            outcomes['throttled'] += 1
+
+    st = time.time()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(send, range(n_requests)))
+    elapsed = time.time() - st
+    print(f'{name:<16} ok={outcomes["ok"]:<5} throttled={outcomes["throttled"]:<5} '
+          f'ok/s={outcomes["ok"] / elapsed:.1f} time={elapsed:.2f}s')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Send requests to a simulated throttling host.')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--host-limit', type=float, default=20)
+    parser.add_argument('--proxies', type=int, default=4)
+    args = parser.parse_args()
+
+    host = ThrottlingHost(args.host_limit)
+    measure('direct', args.requests, args.threads, lambda: host.request(None))
+
+    host = ThrottlingHost(args.host_limit)
+    limited = RequestRouter(RateLimiter({HOST: args.host_limit * 1.5}), ProxyPool())
+    measure('rate-limited', args.requests, args.threads, lambda: limited.call(HOST, host.request))
+
+    host = ThrottlingHost(args.host_limit)
+    proxies = [f'http://proxy{i}' for i in range(args.proxies)]
+    routed = RequestRouter(RateLimiter({HOST: args.host_limit * (args.proxies + 1)}), ProxyPool(proxies))
+    measure('proxy-pool', args.requests, args.threads, lambda: routed.call(HOST, host.request))
@@ -0,0 +1,71 @@
+"""
+Benchmark of the S3 transfer layer against a moto stand-in of S3.
+
+Each request is delayed by `--latency-ms` to stand in for the network round trip. Per-channel report objects are
+uploaded one by one with `upload_object`, as reports were uploaded before, and in bulk with `upload_many`, then
+uploaded again unchanged with `skip_unchanged`, and loaded one by one and with `load_many`. Reports the objects per
+second and the number of requests. A JSONL object of `--records` records is then read whole and streamed with
+`iter_object`, reporting the peak memory allocated while reading. The stand-in keeps the response body in memory,
+which is included in both peaks. Runs entirely locally.
+
+Run from the repository root:
+    python -m benchmarks.s3_transfers --objects 200 --object-KB 20 --latency-ms 20 --records 200000
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.fakes import RoundTrip, measure
+from yt_dl.aws_helpers import AWSClientPool, S3Helper
+
+BUCKET = 'ytdlreports'
+
+
+def report_body(i: int, size_B: int) -> bytes:
+    row = f'{i:011d},Video {i},600,1000,10\n'
+    return ('video_id,video_title,video_duration,video_view_count,video_like_count\n' + row * (size_B // len(row))).encode('utf-8')
+
+
+def measure_memory(name: str, fn) -> None:
+    tracemalloc.start()
+    st = time.perf_counter()
+    n_records = fn()
+    elapsed = time.perf_counter() - st
+    peak_B = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'{name:<22} records={n_records} peak={peak_B / 2**20:.1f}MiB time={elapsed:.2f}s')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Upload and load report objects one by one and in bulk, and stream a JSONL object.')
+    parser.add_argument('--objects', type=int, default=200)
+    parser.add_argument('--object-KB', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--records', type=int, default=200000)
+    args = parser.parse_args()
+
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        s3_hlp_instance = S3Helper()
+        round_trip = RoundTrip(args.latency_ms / 1000)
+        AWSClientPool.register_event_handler('before-call.s3', round_trip.before_call)
+
+        objects = {f'channel{i}/successsfully_downloaded.csv': report_body(i, args.object_KB * 2**10) for i in range(args.objects)}
+        measure('upload_object', lambda: [s3_hlp_instance.upload_object(body, BUCKET, key) for key, body in objects.items()], round_trip, len(objects))
+        measure('upload_many', lambda: s3_hlp_instance.upload_many(objects, BUCKET, skip_unchanged=True), round_trip, len(objects))
+        uploaded = measure('upload_many_unchanged', lambda: s3_hlp_instance.upload_many(objects, BUCKET, skip_unchanged=True), round_trip, len(objects))
+        assert sum(uploaded.values()) == 0
+        measure('load_object_bytes', lambda: [s3_hlp_instance.load_object_bytes(BUCKET, key) for key in objects], round_trip, len(objects))
+        loaded = measure('load_many', lambda: s3_hlp_instance.load_many(objects, BUCKET), round_trip, len(objects))
+        assert loaded == objects
+
+        records = (json.dumps({'video_id': f'{i:011d}', 'start': i * 2.5, 'text': f'segment {i} of the transcript'}) for i in range(args.records))
+        s3_hlp_instance.upload_object('\n'.join(records), BUCKET, 'benchmark/records.jsonl')
+        round_trip.latency_s = 0
+        measure_memory('read_whole', lambda: len([json.loads(line) for line in s3_hlp_instance.load_object_bytes(BUCKET, 'benchmark/records.jsonl').splitlines()]))
+        measure_memory('iter_object', lambda: sum(1 for _ in s3_hlp_instance.iter_object(BUCKET, 'benchmark/records.jsonl')))
@@ -0,0 +1,65 @@
+"""
+Microbenchmark of the per-video setup overhead in Downloader.run.
+
+"before" rebuilds the boto3 resource and client, re-reads the yt_dl YAML configuration and creates a new
+YoutubeDL for every video, as Downloader.run used to. "after" resolves the same resources through the
+cached WorkerContext. No requests are sent, only the setup cost is measured.
+
+Run from the repository root:
+    python -m benchmarks.setup_overhead --videos 200
+"""
+import argparse
+import time
+
+import boto3
+import yt_dlp as youtube_dl
+
+from yt_dl import WorkerContext
+from yt_dl.secrets import AWSCredentials
+from yt_dl.utils import load_yaml_config
+
+
+def setup_before(run_locally: bool) -> None:
+    dynamodb = boto3.resource('dynamodb',
+        aws_access_key_id = AWSCredentials.AWS_ACCESS_KEY,
+        aws_secret_access_key = AWSCredentials.AWS_SECRET_KEY,
+        region_name = AWSCredentials.AWS_REGION_NAME
+        )
+    dynamodb.Table('VideoChannelInfoTable')
+    boto3.client('s3',
+        aws_access_key_id = AWSCredentials.AWS_ACCESS_KEY,
+        aws_secret_access_key = AWSCredentials.AWS_SECRET_KEY,
+        region_name = AWSCredentials.AWS_REGION_NAME
+        )
+    cfg_name = 'yt_dl_local_config' if run_locally is True else 'yt_dl_remote_config'
+    yt_dl_cfg = load_yaml_config(f"yt_dl/configs/{cfg_name}.yaml")
+    with youtube_dl.YoutubeDL(yt_dl_cfg):
+        pass
+
+
+def setup_after(run_locally: bool) -> None:
+    context = WorkerContext.get(run_locally=run_locally)
+    context.dynamo_hlp_instance.dynamodb_table
+    context.s3_hlp_instance.s3_client
+    context.ydl
+
+
+def measure(name: str, setup_fn, videos: int, run_locally: bool) -> float:
+    st = time.perf_counter()
+    for _ in range(videos):
+        setup_fn(run_locally)
+    per_video_ms = (time.perf_counter() - st) / videos * 1000
+    print(f'{name:<8} {per_video_ms:8.2f} ms/video')
+    return per_video_ms
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Measure per-video setup overhead of the downloader.')
+    parser.add_argument('--videos', type=int, default=200)
+    parser.add_argument('--run-locally', action='store_true')
+    args = parser.parse_args()
+
+    before_ms = measure('before', setup_before, args.videos, args.run_locally)
+    after_ms = measure('after', setup_after, args.videos, args.run_locally)
+    print(f'speedup  {before_ms / after_ms:8.1f}x')
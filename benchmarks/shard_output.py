@@ -0,0 +1,118 @@
+"""
+Benchmark of the sharded output mode against loose per-video objects, on a moto stand-in of S3.
+
+Each request is delayed by `--latency-ms` to stand in for the network round trip. Generated audio files, SRT
+transcripts and report metadata of `--videos` videos are stored by `--threads` upload threads through
+Downloader._store_outputs, once as per-video objects and once packed into tar shards of `--shard-size-MB`. All
+outputs are then read back as a training job would, by listing and loading the per-video objects, and by streaming
+the shard indexes and loading whole shards. Reports the time and the number of requests of both directions, and
+checks a ranged read of one sample from its shard. Runs entirely locally.
+
+Run from the repository root:
+    python -m benchmarks.shard_output --videos 300 --audio-KB 512 --shard-size-MB 32 --latency-ms 20
+"""
+import argparse
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import boto3
+from moto import mock_aws
+
+from benchmarks.fakes import RoundTrip, measure
+from yt_dl.aws_helpers import AWSClientPool, S3Helper
+from yt_dl.downloader import Downloader
+from yt_dl.sharding import ShardReader, ShardWriter
+
+BUCKET = 'ytdldata'
+N_CHANNELS = 10
+
+
+class BenchmarkContext:
+
+    def __init__(self, work_dir: str) -> None:
+        self.s3_hlp_instance = S3Helper()
+        self.work_dir = work_dir
+        self.shard_writer = None
+        self._lock = threading.Lock()
+
+    def get_shard_writer(self, shard_size_MB: float = None) -> ShardWriter:
+        # One writer shared by the upload threads, as in WorkerContext
+        with self._lock:
+            if self.shard_writer is None:
+                self.shard_writer = ShardWriter(self.s3_hlp_instance, work_dir=self.work_dir, max_shard_size_B=int(shard_size_MB * 2**20))
+            return self.shard_writer
+
+
+def make_prepared(i: int, shard_size_MB: float) -> dict:
+    prepared = {
+        'video_id': f'{i:011d}',
+        'channel_id': f'channel{i % N_CHANNELS}',
+        'duration_s': 600,
+        'transcript_format': 'srt',
+        'video_transcript': [{'start': j * 2.5, 'duration': 2.5, 'text': f'segment {j} of video {i}'} for j in range(240)]
+    }
+    if shard_size_MB is not None:
+        prepared['shard_size_MB'] = shard_size_MB
+        prepared['metadata'] = {'channel_id': prepared['channel_id'], 'video_id': prepared['video_id'], 'video_wpm': Decimal('151.2'),
+                                'video_duration': Decimal(600), 'video_title': f'Video {i}', 'video_view_count': 1000, 'video_like_count': 10}
+    return prepared
+
+
+def write(n_videos: int, audio_B: int, n_threads: int, audio_dir: str, context: BenchmarkContext, shard_size_MB: float) -> None:
+
+    def store(i: int) -> int:
+        # Downloads leave the transcoded audio on disk, it is deleted once stored
+        audio_path = os.path.join(audio_dir, f'{i:011d}.flac')
+        with open(audio_path, 'wb') as audio_file:
+            audio_file.write(os.urandom(audio_B))
+        return Downloader._store_outputs(make_prepared(i, shard_size_MB), audio_path, context)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(store, range(n_videos)))
+    if context.shard_writer is not None:
+        context.shard_writer.flush()
+
+
+def read_objects(s3_hlp_instance: S3Helper) -> int:
+    keys = [key for key in s3_hlp_instance.list_keys(BUCKET) if not key.startswith(f'{ShardWriter.PREFIX}/')]
+    return sum(len(content) for content in s3_hlp_instance.load_many(keys, BUCKET).values())
+
+
+def read_shards(s3_hlp_instance: S3Helper) -> int:
+    shard_keys = sorted(set(entry['shard'] for entry in ShardReader(s3_hlp_instance).iter_index()))
+    return sum(len(content) for content in s3_hlp_instance.load_many(shard_keys, BUCKET).values())
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Store and read back video outputs as per-video objects and as tar shards.')
+    parser.add_argument('--videos', type=int, default=300)
+    parser.add_argument('--audio-KB', type=int, default=512)
+    parser.add_argument('--shard-size-MB', type=float, default=32)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    with mock_aws(), tempfile.TemporaryDirectory() as tmp_dir:
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        round_trip = RoundTrip(args.latency_ms / 1000)
+        AWSClientPool.register_event_handler('before-call.s3', round_trip.before_call)
+        context = BenchmarkContext(os.path.join(tmp_dir, 'shards'))
+
+        measure('write_objects', lambda: write(args.videos, args.audio_KB * 2**10, args.threads, tmp_dir, context, None), round_trip)
+        measure('write_shards', lambda: write(args.videos, args.audio_KB * 2**10, args.threads, tmp_dir, context, args.shard_size_MB), round_trip)
+        objects_B = measure('read_objects', lambda: read_objects(context.s3_hlp_instance), round_trip)
+        shards_B = measure('read_shards', lambda: read_shards(context.s3_hlp_instance), round_trip)
+
+        # Random access to one sample through the index
+        shard_reader = ShardReader(context.s3_hlp_instance)
+        entries = list(shard_reader.iter_index())
+        assert len(entries) == args.videos
+        entry = entries[len(entries) // 2]
+        transcript = shard_reader.load_member(entry, 'srt')
+        assert transcript == context.s3_hlp_instance.load_object_bytes(BUCKET, f"{entry['channel_id']}/srt_files/{entry['key']}.srt")
+        print(f'samples={len(entries)} shards={len(set(entry["shard"] for entry in entries))} '
+              f'objects_MB={objects_B / 2**20:.1f} shards_MB={shards_B / 2**20:.1f}')
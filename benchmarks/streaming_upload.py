@@ -0,0 +1,50 @@
+"""
+Benchmark of the streaming audio mode of the downloader.
+
+A synthetic audio source (ffmpeg lavfi sine generator) is transcoded with the yt_dl postprocessor
+arguments and streamed into a multipart upload on a moto S3 stand-in. Reports throughput, the number
+of uploaded parts and the peak RSS of the process, which stays bounded by the part buffer regardless
+of the audio duration. Requires ffmpeg on PATH.
+
+Run from the repository root:
+    python -m benchmarks.streaming_upload --duration-M 60
+"""
+import argparse
+import resource
+import time
+
+import boto3
+from moto import mock_aws
+
+from yt_dl import S3Helper
+from yt_dl.streaming import AudioStreamer
+from yt_dl.utils import load_yt_dl_config
+
+BUCKET = 'ytdldata'
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Stream synthetic audio through ffmpeg into S3.')
+    parser.add_argument('--duration-M', type=float, default=60)
+    parser.add_argument('--part-size-MB', type=int, default=8)
+    args = parser.parse_args()
+
+    yt_dl_cfg = load_yt_dl_config(run_locally=False)
+    yt_dl_cfg['ffmpeg_location'] = None
+    audio_source = {'input_args': ['-f', 'lavfi', '-i', f'anoisesrc=duration={args.duration_M * 60}:sample_rate=44100']}
+
+    with mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket=BUCKET)
+        s3_hlp_instance = S3Helper()
+        s3_hlp_instance.MULTIPART_PART_SIZE = args.part_size_MB * 2**20
+
+        st = time.time()
+        uploaded_bytes = AudioStreamer.stream_to_s3(audio_source, yt_dl_cfg, s3_hlp_instance, BUCKET, 'benchmark/audio.flac')
+        elapsed = time.time() - st
+
+        head = s3_hlp_instance.s3_client.head_object(Bucket=BUCKET, Key='benchmark/audio.flac')
+        assert head['ContentLength'] == uploaded_bytes
+        peak_rss_MB = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'audio={args.duration_M:.0f}min size={uploaded_bytes / 2**20:.1f}MB parts={head["ETag"].split("-")[-1].strip(chr(34))} '
+              f'time={elapsed:.2f}s throughput={uploaded_bytes / 2**20 / elapsed:.1f}MB/s peak_rss={peak_rss_MB:.0f}MB')
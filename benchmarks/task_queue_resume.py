@@ -0,0 +1,161 @@
+"""
+Benchmark of the task queue that pipeline runs resume from.
+
+A run is interrupted after a share of its videos, leaving the videos in flight leased, and resumed by a new
+driver. A share of the attempts fail and are retried after their backoff. Reports the number of leases taken
+by each driver, which stays proportional to the remaining videos, and the task throughput for the SQLite
+backend and the DynamoDB backend on a moto stand-in. `--workers` workers then pull the tasks of a sealed run
+concurrently, as the stateless Ray pullers do. Checks that no worker stops while pending tasks are left and reports
+the number of tasks leased by each worker. Runs entirely locally.
+
+Run from the repository root:
+    python -m benchmarks.task_queue_resume --videos 1000 --interrupt-after 0.5 --failure-rate 0.05 --workers 8
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+
+import boto3
+from moto import mock_aws
+
+from yt_dl import DynamoDBTaskQueue, SQLiteTaskQueue, TaskQueue
+from yt_dl.aws_helpers import AWSClientPool
+
+IN_FLIGHT = 8
+# Processing time of a task in the multi-worker case
+TASK_S = 0.02
+
+
+def create_table(table_name: str) -> None:
+    boto3.resource('dynamodb', region_name='us-east-1').create_table(
+        TableName=table_name,
+        KeySchema=[
+            {'AttributeName': 'run_id', 'KeyType': 'HASH'},
+            {'AttributeName': 'video_id', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'run_id', 'AttributeType': 'S'},
+            {'AttributeName': 'video_id', 'AttributeType': 'S'},
+            {'AttributeName': 'run_state', 'AttributeType': 'S'},
+            {'AttributeName': 'available_at', 'AttributeType': 'N'}
+        ],
+        GlobalSecondaryIndexes=[{
+            'IndexName': DynamoDBTaskQueue.RUN_STATE_INDEX,
+            'KeySchema': [
+                {'AttributeName': 'run_state', 'KeyType': 'HASH'},
+                {'AttributeName': 'available_at', 'KeyType': 'RANGE'}
+            ],
+            'Projection': {'ProjectionType': 'ALL'}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+
+def serialize_aws_requests() -> None:
+    # The in-process moto stand-in is not thread-safe, requests are served one at a time, workers still race for tasks
+    lock = threading.Lock()
+
+    def acquire(**kwargs) -> None:
+        # A value returned by a before-call handler would replace the response
+        lock.acquire()
+
+    AWSClientPool.register_event_handler('before-call', acquire)
+    AWSClientPool.register_event_handler('after-call', lambda **kwargs: lock.release())
+
+
+def run_driver(task_queue: TaskQueue, failure_rate: float, max_tasks: int = None) -> int:
+    # Process leased videos, keeping the last ones in flight unfinished if the driver is interrupted
+    n_leased, in_flight = 0, list()
+    while task_queue.is_finished() is False:
+        for video_id in task_queue.iter_leased(poll_interval_s=0):
+            n_leased += 1
+            in_flight.append(video_id)
+            if max_tasks is not None and n_leased == max_tasks:
+                return n_leased
+            if len(in_flight) == IN_FLIGHT:
+                video_id = in_flight.pop(0)
+                task_queue.record_response({'video_id': video_id, 'status': True, 'uploaded_bytes': 0,
+                                            'error': 'Download failed' if random.random() < failure_rate else None})
+        for video_id in in_flight:
+            task_queue.record_response({'video_id': video_id, 'status': True, 'uploaded_bytes': 0})
+        in_flight = list()
+    return n_leased
+
+
+def measure(name: str, create_queue, video_ids: list, interrupt_after: float, failure_rate: float) -> None:
+    st = time.time()
+    task_queue = create_queue()
+    task_queue.fill(video_ids)
+    n_first = run_driver(task_queue, failure_rate, max_tasks=int(len(video_ids) * interrupt_after))
+    remaining = task_queue.counts()
+
+    # A new driver of the run releases the leases of the interrupted one
+    task_queue = create_queue()
+    task_queue.reset_leases()
+    n_resumed = run_driver(task_queue, failure_rate)
+    elapsed = time.time() - st
+
+    counts = task_queue.counts()
+    assert counts[TaskQueue.DONE] + counts[TaskQueue.FAILED] == len(video_ids)
+    print(f'{name:<9} first_leases={n_first} remaining_at_resume={remaining[TaskQueue.PENDING] + remaining[TaskQueue.LEASED]} '
+          f'resumed_leases={n_resumed} done={counts[TaskQueue.DONE]} failed={counts[TaskQueue.FAILED]} '
+          f'time={elapsed:.2f}s tasks/s={len(video_ids) / elapsed:.0f}')
+
+
+def measure_workers(name: str, create_queue, video_ids: list, n_workers: int) -> None:
+    # Workers pull from the same sealed run, each with its own queue instance as on a cluster
+    task_queue = create_queue()
+    task_queue.fill(video_ids)
+    n_leased, pending_at_exit = [0] * n_workers, [None] * n_workers
+
+    def work(worker: int) -> None:
+        worker_queue = create_queue()
+        for video_id in worker_queue.iter_leased(poll_interval_s=0.1):
+            time.sleep(TASK_S)
+            worker_queue.complete(video_id)
+            n_leased[worker] += 1
+        pending_at_exit[worker] = worker_queue.counts()[TaskQueue.PENDING]
+
+    st = time.time()
+    threads = [threading.Thread(target=work, args=(worker,)) for worker in range(n_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - st
+
+    # No worker stops while pending tasks are left to the others
+    assert task_queue.counts()[TaskQueue.DONE] == len(video_ids) == sum(n_leased)
+    assert max(pending_at_exit) == 0, f'workers stopped with pending tasks: {pending_at_exit}'
+    print(f'{name:<9} workers={n_workers} leases_per_worker={sorted(n_leased)} time={elapsed:.2f}s tasks/s={len(video_ids) / elapsed:.0f}')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Interrupt and resume a run from the task queue.')
+    parser.add_argument('--videos', type=int, default=1000)
+    parser.add_argument('--interrupt-after', type=float, default=0.5)
+    parser.add_argument('--failure-rate', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    random.seed(0)
+    video_ids = [f'{i:011d}' for i in range(args.videos)]
+    queue_kwargs = {'run_id': 'benchmark', 'max_attempts': 3, 'retry_backoff_s': 0}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        measure('sqlite', lambda: SQLiteTaskQueue(os.path.join(tmp_dir, 'tasks.sqlite'), **queue_kwargs),
+                video_ids, args.interrupt_after, args.failure_rate)
+        measure_workers('sqlite', lambda: SQLiteTaskQueue(os.path.join(tmp_dir, 'workers.sqlite'), **queue_kwargs),
+                        video_ids, args.workers)
+
+    with mock_aws():
+        create_table('TaskQueueTable')
+        measure('dynamodb', lambda: DynamoDBTaskQueue('TaskQueueTable', **queue_kwargs),
+                video_ids, args.interrupt_after, args.failure_rate)
+        serialize_aws_requests()
+        measure_workers('dynamodb', lambda: DynamoDBTaskQueue('TaskQueueTable', **{**queue_kwargs, 'run_id': 'workers'}),
+                        video_ids, args.workers)
@@ -0,0 +1,73 @@
+"""
+Simulation benchmark of the task order on the makespan of a run.
+
+Videos of synthetic duration distributions are generated interleaved across channels, as TaskGenerator emits them,
+and processed by workers that pull the next task whenever they finish one, as the task queue hands them out. The
+processing time of a video grows with its duration. Compares the generation order, a random shuffle and the
+longest-first order of TaskScheduler, reporting the makespan, its ratio to the lower bound (the larger of the
+average load per worker and the longest video) and the idle tail, the time between the first worker running out of
+work and the end of the run, during which nodes sit idle without being reclaimed.
+
+Run from the repository root:
+    python -m benchmarks.task_scheduling --videos 400 --channels 20 --workers 24
+"""
+import argparse
+import heapq
+import random
+
+from yt_dl.scheduler import TaskScheduler
+
+# Download and transcode time per second of audio and fixed time per video
+PROCESSING_S_PER_S = 0.05
+OVERHEAD_S = 5
+
+
+def synthetic_durations(distribution: str, n_videos: int, rng: random.Random) -> list:
+    if distribution == 'lognormal':
+        return [min(4 * 60 * 60, rng.lognormvariate(6.8, 0.8)) for _ in range(n_videos)]
+    if distribution == 'heavy-tail':
+        # Mostly short videos and a few streams of several hours
+        return [rng.uniform(60 * 60, 3 * 60 * 60) if rng.random() < 0.05 else rng.uniform(5 * 60, 30 * 60) for _ in range(n_videos)]
+    return [rng.uniform(60, 3 * 60 * 60) for _ in range(n_videos)]
+
+
+def generated_tasks(durations: list, n_channels: int) -> list:
+    # Round-robin across channels, as the channel enumeration interleaves them
+    channels = [list() for _ in range(n_channels)]
+    for i, duration_s in enumerate(durations):
+        channels[i % n_channels].append({'video_id': f'{i:011d}', 'channel_id': f'channel{i % n_channels}', 'duration_s': duration_s})
+    return [task for tasks in zip(*channels) for task in tasks]
+
+
+def simulate(tasks: list, n_workers: int) -> tuple:
+    # Each task goes to the worker that becomes free first
+    workers = [0.0] * n_workers
+    for task in tasks:
+        heapq.heapreplace(workers, workers[0] + OVERHEAD_S + task['duration_s'] * PROCESSING_S_PER_S)
+    return max(workers), min(workers)
+
+
+def measure(name: str, tasks: list, n_workers: int) -> None:
+    makespan, first_idle = simulate(tasks, n_workers)
+    processing_s = [OVERHEAD_S + task['duration_s'] * PROCESSING_S_PER_S for task in tasks]
+    lower_bound = max(sum(processing_s) / n_workers, max(processing_s))
+    print(f'  {name:<12} makespan={makespan / 60:7.1f}M ratio={makespan / lower_bound:.3f} idle_tail={(makespan - first_idle) / 60:6.1f}M')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Simulate the makespan of a run for several task orders.')
+    parser.add_argument('--videos', type=int, default=400)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=24)
+    parser.add_argument('--window', type=int, default=TaskScheduler.WINDOW_SIZE)
+    args = parser.parse_args()
+
+    for distribution in ('lognormal', 'heavy-tail', 'uniform'):
+        rng = random.Random(0)
+        tasks = generated_tasks(synthetic_durations(distribution, args.videos, rng), args.channels)
+        print(f'{distribution}: {len(tasks)} videos, {sum(task["duration_s"] for task in tasks) / 60 / 60:.0f}H')
+        measure('generated', tasks, args.workers)
+        measure('shuffled', rng.sample(tasks, len(tasks)), args.workers)
+        measure('lpt-window', list(TaskScheduler(window_size=args.window).iter_scheduled(tasks)), args.workers)
+        measure('lpt-full', list(TaskScheduler(window_size=len(tasks)).iter_scheduled(tasks)), args.workers)
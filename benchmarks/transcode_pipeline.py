@@ -0,0 +1,119 @@
+"""
+Benchmark of split download and transcoding stages.
+
+Generated WAV files stand in for the raw best audio. Fetching a file sleeps for its size divided by
+`--bandwidth-MBps` before copying it, mimicking a network download, and uploads are skipped. The combined mode
+runs download and ffmpeg transcoding one after another in each of `--download-concurrency` workers, as yt_dl
+postprocessing does, the staged mode runs them in StagedEngine with separate download threads and transcoding
+processes. Reports the throughput and the share of time the download slots spent downloading. Requires ffmpeg.
+
+Run from the repository root:
+    python -m benchmarks.transcode_pipeline --videos 24 --duration-s 120 --bandwidth-MBps 8 --download-concurrency 4
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from yt_dl.downloader import Downloader
+from yt_dl.staged_engine import StagedEngine
+from yt_dl.streaming import AudioStreamer, AudioTranscoder
+from yt_dl.utils import load_yt_dl_config
+
+SAMPLE_RATE = 44100
+
+
+class BenchmarkContext:
+    yt_dl_cfg = {'ffmpeg_location': None, 'postprocessor_args': load_yt_dl_config(run_locally=True)['postprocessor_args']}
+
+
+def generate_audio(path: str, duration_s: float, rng: np.random.Generator) -> None:
+    # Stereo 16 bit tone with noise, noise keeps the FLAC encoder busy
+    t = np.arange(int(duration_s * SAMPLE_RATE)) / SAMPLE_RATE
+    signal = 0.3 * np.sin(2 * np.pi * 440 * t)[:, None] + 0.05 * rng.standard_normal((len(t), 2))
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes((np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes())
+
+
+def make_network_stages(source_dir: str, work_dir: str, bandwidth_Bps: float, fetch_times: list):
+
+    def fetch_raw_audio(prepared: dict, context) -> dict:
+        st = time.perf_counter()
+        source_path = os.path.join(source_dir, f"{prepared['video_id']}.wav")
+        time.sleep(os.path.getsize(source_path) / bandwidth_Bps)
+        raw_path = os.path.join(work_dir, 'raw', f"{prepared['video_id']}.wav")
+        shutil.copyfile(source_path, raw_path)
+        fetch_times.append(time.perf_counter() - st)
+        return {**prepared, 'raw_path': raw_path, 'audio_path': os.path.join(work_dir, f"{prepared['video_id']}.flac")}
+
+    def upload(fetched: dict, context, transcode_s: float = 0) -> dict:
+        uploaded_bytes = os.path.getsize(fetched['audio_path'])
+        os.remove(fetched['audio_path'])
+        return {'video_id': fetched['video_id'], 'status': True, 'uploaded_bytes': uploaded_bytes, 'transcode_s': transcode_s}
+    return fetch_raw_audio, upload
+
+
+def combined(tasks: list, download_concurrency: int, transcode_concurrency: int) -> list:
+    # Each worker downloads and then transcodes, as the yt_dl postprocessor does
+    ffmpeg_path = AudioStreamer.get_ffmpeg_path(None)
+    postprocessor_args = BenchmarkContext.yt_dl_cfg['postprocessor_args']
+
+    def process(task: dict) -> dict:
+        fetched = Downloader.fetch_raw_audio(task, BenchmarkContext)
+        transcode_s = AudioTranscoder.transcode(fetched['raw_path'], fetched['audio_path'], ffmpeg_path, postprocessor_args)
+        return Downloader.upload(fetched, BenchmarkContext, transcode_s)
+
+    with ThreadPoolExecutor(max_workers=download_concurrency) as executor:
+        return list(executor.map(process, tasks))
+
+
+def staged(tasks: list, download_concurrency: int, transcode_concurrency: int) -> list:
+    engine = StagedEngine(None, context=BenchmarkContext, download_concurrency=download_concurrency,
+                          transcode_concurrency=transcode_concurrency)
+    return list(engine.run(tasks, method='download'))
+
+
+def measure(name: str, run_fn, tasks: list, download_concurrency: int, transcode_concurrency: int, fetch_times: list) -> None:
+    fetch_times.clear()
+    st = time.perf_counter()
+    responses = run_fn(tasks, download_concurrency, transcode_concurrency)
+    elapsed = time.perf_counter() - st
+    assert all(response['status'] for response in responses), responses
+    print(f'{name:<9} time={elapsed:.2f}s videos/s={len(responses) / elapsed:.2f} '
+          f'network_util={sum(fetch_times) / elapsed / download_concurrency:.0%} '
+          f'transcode_s={sum(response["transcode_s"] for response in responses):.2f}')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Download and transcode generated audio files combined and in stages.')
+    parser.add_argument('--videos', type=int, default=24)
+    parser.add_argument('--duration-s', type=float, default=120)
+    parser.add_argument('--bandwidth-MBps', type=float, default=8)
+    parser.add_argument('--download-concurrency', type=int, default=4)
+    parser.add_argument('--transcode-concurrency', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    if shutil.which('ffmpeg') is None:
+        parser.error('ffmpeg is required on the PATH')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir, work_dir = os.path.join(tmp_dir, 'source'), os.path.join(tmp_dir, 'work')
+        for path in (source_dir, os.path.join(work_dir, 'raw')):
+            os.makedirs(path)
+        rng = np.random.default_rng(0)
+        for i in range(args.videos):
+            generate_audio(os.path.join(source_dir, f'{i:011d}.wav'), args.duration_s, rng)
+        tasks = [{'video_id': f'{i:011d}'} for i in range(args.videos)]
+
+        fetch_times = list()
+        Downloader.fetch_raw_audio, Downloader.upload = make_network_stages(source_dir, work_dir, args.bandwidth_MBps * 2**20, fetch_times)
+        measure('combined', combined, tasks, args.download_concurrency, args.transcode_concurrency, fetch_times)
+        measure('staged', staged, tasks, args.download_concurrency, args.transcode_concurrency, fetch_times)
@@ -0,0 +1,82 @@
+"""
+Benchmark of transcript encoding for upload.
+
+Compares the former string-based SRT conversion followed by `.encode('utf-8')` with
+TranscriptHelper.write_transcript writing straight into a bytes buffer, reporting
+throughput and peak traced memory (tracemalloc) on large synthetic transcripts.
+
+Run from the repository root:
+    python -m benchmarks.transcript_writer --segments 10000 100000
+"""
+import argparse
+import random
+import string
+import time
+import tracemalloc
+from io import BytesIO
+
+from yt_dl.video_utilities import TranscriptHelper
+
+
+def legacy_convert_to_srt(transcripts: list) -> str:
+    # TranscriptHelper._convert_to_srt before the streaming writer
+    def convert_time(seconds: float) -> str:
+        hours = int(seconds // 3600)
+        seconds %= 3600
+        minutes = int(seconds // 60)
+        seconds = seconds % 60
+        milliseconds = int((seconds - int(seconds)) * 1000)
+        return f"{hours:02d}:{minutes:02d}:{int(seconds):02d},{milliseconds:03d}"
+
+    def format_transcript(counter: int, transcript: dict) -> str:
+        return f"{counter}\n" \
+               f"{convert_time(transcript['start'])} --> {convert_time(transcript['start'] + transcript['duration'])}\n" \
+               f"{transcript['text']}\n\n"
+
+    return ''.join(format_transcript(i + 1, transcript) for i, transcript in enumerate(transcripts))
+
+
+def legacy_body(transcripts: list, transcript_format: str) -> int:
+    return len(legacy_convert_to_srt(transcripts).encode('utf-8'))
+
+
+def streaming_body(transcripts: list, transcript_format: str) -> int:
+    return TranscriptHelper.write_transcript(transcripts, BytesIO(), transcript_format)
+
+
+def synthetic_transcript(n_segments: int, rng: random.Random) -> list:
+    sequences, start = [], 0.0
+    for _ in range(n_segments):
+        words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 9))) for _ in range(rng.randint(1, 14))]
+        duration = round(rng.uniform(0.5, 6.0), 3)
+        sequences.append({'text': ' '.join(words), 'start': round(start, 3), 'duration': duration})
+        start += duration
+    return sequences
+
+
+def measure(name: str, body_fn, transcripts: list, transcript_format: str) -> None:
+    # Time without tracing, tracemalloc slows allocations down considerably
+    st = time.perf_counter()
+    size = body_fn(transcripts, transcript_format)
+    elapsed = time.perf_counter() - st
+    tracemalloc.start()
+    body_fn(transcripts, transcript_format)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<16} size={size / 2**20:7.2f}MB time={elapsed:6.3f}s '
+          f'throughput={size / 2**20 / elapsed:7.1f}MB/s peak_mem={peak / 2**20:7.2f}MB')
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark transcript encoding.')
+    parser.add_argument('--segments', type=int, nargs='+', default=[10000, 100000])
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for n_segments in args.segments:
+        transcripts = synthetic_transcript(n_segments, rng)
+        print(f'--- {n_segments} segments')
+        measure('legacy srt', legacy_body, transcripts, 'srt')
+        for transcript_format in TranscriptHelper.TRANSCRIPT_FORMATS:
+            measure(f'streaming {transcript_format}', streaming_body, transcripts, transcript_format)
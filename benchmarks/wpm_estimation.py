@@ -0,0 +1,115 @@
+"""
+Benchmark of the words-per-minute estimation on synthetic transcripts.
+
+Compares WordsPerMinuteHelper against the reference fixed-point loop over
+`youtube_wpm.calc_speak_time` with Decimal arithmetic, for single transcripts of
+1k to 100k segments and for a batch of transcripts estimated in one call. The
+transcript analytics computed with the WPM before downloads are checked against
+a per-segment loop, and their added time is reported.
+
+Run from the repository root:
+    python -m benchmarks.wpm_estimation --sizes 1000 10000 100000
+"""
+import argparse
+import math
+import random
+import string
+import time
+from decimal import Decimal
+
+from youtube_wpm.__main__ import calc_seconds_per_word, calc_speak_time
+
+from yt_dl.video_utilities import TranscriptAnalytics, VideoMetadataUtilities, WordsPerMinuteHelper
+
+TOLERANCE_WPM = 0.01
+
+
+def reference_wpm(sequences: list) -> Decimal:
+    prev_wpm = Decimal(WordsPerMinuteHelper.INITIAL_APPROXIMATE_WPM)
+    inference_spw = calc_seconds_per_word(prev_wpm)
+    for _ in range(WordsPerMinuteHelper.MAX_ITERATION):
+        stats = calc_speak_time(sequences, inference_spw=inference_spw)
+        if abs(stats.wpm - prev_wpm) < WordsPerMinuteHelper.EXIT_WPM_DIFF_THRESHOLD:
+            break
+        inference_spw = calc_seconds_per_word(stats.wpm)
+        prev_wpm = stats.wpm
+    return stats.wpm
+
+
+def reference_metrics(sequences: list, video_duration_s: float) -> dict:
+    # Per-segment loop over the speech segments, with the running end of the covered speech
+    starts, durations, word_cts, _ = WordsPerMinuteHelper._tokenize(sequences)
+    covered_s, covered_end_s, gaps, segment_wpms = 0.0, 0.0, [], []
+    for i, (start, duration, word_ct) in enumerate(zip(starts, durations, word_cts)):
+        if i > 0:
+            gaps.append(start - covered_end_s)
+        covered_s += max(start + duration - max(start, covered_end_s), 0)
+        covered_end_s = max(covered_end_s, start + duration)
+        if duration > 0:
+            segment_wpms.append(word_ct * 60 / duration)
+    mean = sum(segment_wpms) / len(segment_wpms)
+    return {
+        'speech_coverage': min(covered_s / video_duration_s, 1.0),
+        'max_silence_gap_s': max(max(gaps, default=0.0), 0.0),
+        'silence_gap_count': sum(gap >= TranscriptAnalytics.MIN_SILENCE_GAP_S for gap in gaps),
+        'segment_wpm_mean': mean,
+        'segment_wpm_std': math.sqrt(sum((wpm - mean) ** 2 for wpm in segment_wpms) / len(segment_wpms)),
+        'caption_density_per_M': len(starts) / (video_duration_s / 60)
+    }
+
+
+def synthetic_transcript(n_segments: int, rng: random.Random) -> list:
+    sequences, start = [], 0.0
+    for _ in range(n_segments):
+        n_words = rng.randint(0, 14)
+        words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 9))) for _ in range(n_words)]
+        text = ' '.join(words)
+        # Mix in sound tags and speaker names that are not counted as speech
+        if rng.random() < 0.05:
+            text = '[Music]'
+        elif rng.random() < 0.05:
+            text = 'SPEAKER: ' + text
+        duration = round(rng.uniform(0.5, 6.0), 3)
+        sequences.append({'text': text, 'start': round(start, 3), 'duration': duration})
+        start += duration * rng.uniform(0.6, 1.4)
+    return sequences
+
+
+def measure(fn, *args) -> tuple:
+    st = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - st
+
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark words-per-minute estimation.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--batch', type=int, default=100, help='transcripts of 1k segments estimated in one call')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for n_segments in args.sizes:
+        sequences = synthetic_transcript(n_segments, rng)
+        ref, ref_time = measure(reference_wpm, sequences)
+        wpm, wpm_time = measure(WordsPerMinuteHelper.get_video_wpm, sequences)
+        assert abs(float(ref) - wpm) < TOLERANCE_WPM, f'WPM differs: {ref} != {wpm}'
+        print(f'segments={n_segments:<7} reference={ref_time:8.3f}s vectorized={wpm_time:8.3f}s '
+              f'speedup={ref_time / wpm_time:6.1f}x wpm={wpm:.2f} diff={abs(float(ref) - wpm):.2e}')
+
+        # WPM and transcript analytics as checked before downloads
+        video_duration_s = sequences[-1]['start'] + sequences[-1]['duration'] + 30
+        (_, _, metrics), checks_time = measure(VideoMetadataUtilities._check_wpm, sequences, 0, video_duration_s)
+        for name, value in reference_metrics(sequences, video_duration_s).items():
+            assert math.isclose(metrics[name], value, rel_tol=1e-9, abs_tol=1e-9), f'{name} differs: {metrics[name]} != {value}'
+        print(f'segments={n_segments:<7} wpm_and_analytics={checks_time:8.3f}s analytics_overhead={checks_time - wpm_time:+8.3f}s '
+              f"coverage={metrics['speech_coverage']:.3f} max_gap={metrics['max_silence_gap_s']:.1f}s "
+              f"segment_wpm={metrics['segment_wpm_mean']:.0f}+-{metrics['segment_wpm_std']:.0f}")
+
+    batch = [synthetic_transcript(1000, rng) for _ in range(args.batch)]
+    refs, ref_time = measure(lambda: [reference_wpm(sequences) for sequences in batch])
+    wpms, wpm_time = measure(WordsPerMinuteHelper.get_videos_wpm, batch)
+    max_diff = max(abs(float(ref) - wpm) for ref, wpm in zip(refs, wpms))
+    assert max_diff < TOLERANCE_WPM, f'WPM differs by {max_diff}'
+    print(f'batch={args.batch}x1000  reference={ref_time:8.3f}s vectorized={wpm_time:8.3f}s '
+          f'speedup={ref_time / wpm_time:6.1f}x max_diff={max_diff:.2e}')
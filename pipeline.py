@@ -1,58 +1,265 @@
+import threading
 import time
-import os
+from typing import Callable
 
 import ray
-from yt_dl import (Downloader, DynamoDBHelper, ReportGenerator, S3Helper,
-                   TaskGenerator)
+from yt_dl import (ActorPoolEngine, Downloader, DynamoDBHelper,
+                   DynamoDBTaskQueue, MetadataPrefetcher, ReportGenerator,
+                   RunProfile, S3Helper, SQLiteTaskQueue, StageProfiler,
+                   StagedEngine, TaskGenerator, TaskQueue, TaskScheduler,
+                   WorkerContext)
+
+# Interval of the checks of the task queue while only leased tasks are left
+LEASED_POLL_INTERVAL_S = 10
+
+
+def run_task(task, input_cfg: dict, download_method: str, context: WorkerContext) -> dict:
+    # Tasks are video IDs for `run` or prefetched videos for `download`, errors are returned in the response
+    video_id = task if download_method == 'run' else task['video_id']
+    try:
+        if download_method == 'download':
+            return Downloader.download(task, context=context)
+        return Downloader.run(task, input_cfg=input_cfg, context=context)
+    except Exception as exc:
+        return {'video_id': video_id, 'status': False, 'uploaded_bytes': 0, 'error': str(exc)}
 
 
 @ray.remote
-def distributed_downloader(video_id: str, input_cfg: dict):
-    Downloader.run(video_id, input_cfg)
+def distributed_downloader(task_queue: TaskQueue, input_cfg: dict, ydl_cls: Callable = None, fetch_transcript_fn: Callable = None) -> dict:
+    # Ray reuses worker processes, so the context is set up once per worker
+    context = WorkerContext.get(run_locally=False, ydl_cls=ydl_cls, fetch_transcript_fn=fetch_transcript_fn)
+    context.get_request_router(input_cfg, run_id=task_queue.run_id)
+    # Pull video IDs from the task queue until none can be leased
+    n_downloaded = 0
+    for video_id in task_queue.iter_leased():
+        response = run_task(video_id, input_cfg, 'run', context)
+        task_queue.record_response(response)
+        n_downloaded += response['status']
+    # Write the reports and upload the shard still buffered in the worker
+    task_queue.complete_many(context.flush())
+    return {'n_downloaded': n_downloaded, 'profile': StageProfiler.drain()}
 
 
-if __name__=='__main__':
+def run_pipeline(input_file: dict, run_id: str, run_locally: bool = False, use_ray: bool = True, use_actors: bool = True,
+                 actors_per_node: int = 2, max_in_flight_per_actor: int = 2, use_prefetch: bool = True,
+                 prefetch_concurrency: int = 16, split_transcode: bool = True, download_concurrency: int = 4,
+                 transcode_concurrency: int = None, max_queued_transcodes: int = None, report_format: str = 'csv',
+                 incremental_reports: bool = False, metrics_port: int = None, task_queue: TaskQueue = None,
+                 transcode_fn: Callable = None, ydl_cls: Callable = None, fetch_transcript_fn: Callable = None,
+                 iter_channel_videos_fn: Callable = None) -> dict:
+    # Generate the tasks of the input file, download them and generate the reports, returns a summary of the run.
+    # The settings are described in __main__. `task_queue`, `transcode_fn` and the YouTube clients, `ydl_cls`,
+    # `fetch_transcript_fn` and `iter_channel_videos_fn`, replace the defaults, e.g. by local fakes in benchmarks
 
-    RUN_LOCALLY: bool = False
-    USE_RAY: bool = True
-    
     # Initialize dynamo and s3 helper instances
     dynamo_hlp_instance = DynamoDBHelper(table_name = 'VideoChannelInfoTable')
+    stats_hlp_instance = DynamoDBHelper(table_name = 'ChannelStatsTable')
     s3_hlp_instance = S3Helper()
 
-    # Load input configuration file
-    input_file = s3_hlp_instance.load_object(            
-            bucket="ytdlinput", 
-            key="input.json"
-        )
-    
-    # Generate tasks
-    video_ids = TaskGenerator.extract_channel_video_urls(input_file.get('channels'), dynamo_hlp_instance, shuffle=True)
-    print(f'>>> {len(video_ids)} videos will be downloaded!')
-
     # Load input configuration
     input_cfg = input_file.get('configuration')
 
+    # Initialize the task queue of the run, in SQLite locally and in DynamoDB on AWS
+    if task_queue is None and run_locally is True:
+        task_queue = SQLiteTaskQueue('./data/queue/tasks.sqlite', run_id=run_id)
+    elif task_queue is None:
+        task_queue = DynamoDBTaskQueue('TaskQueueTable', run_id=run_id)
+    # Leases held by a previous driver of the run are released
+    task_queue.reset_leases()
+
+    # Generate tasks lazily into the queue, interleaved across channels and cut off once channel budgets are covered,
+    # a resumed run skips it once all tasks were generated
+    scheduler = TaskScheduler(input_cfg)
+    if task_queue.is_sealed() is False:
+        tasks = TaskGenerator.extract_channel_tasks(
+            input_file.get('channels'),
+            dynamo_hlp_instance,
+            input_cfg=input_cfg,
+            stats_hlp_instance=stats_hlp_instance,
+            iter_channel_videos_fn=iter_channel_videos_fn
+        )
+        # Queue the longest videos first
+        video_ids = (task['video_id'] for task in scheduler.iter_scheduled(tasks))
+        threading.Thread(target=task_queue.fill, args=(video_ids,), name='task-generation', daemon=True).start()
+    print(f'>>> Tasks of run {run_id}: {task_queue.counts()}')
+
     st = time.time()
-    run_setup = (USE_RAY, RUN_LOCALLY)
-    
-    # Run locally using ray
-    if run_setup == (True, True):
-        ray.init()
-        os.makedirs('./data/audio_files') 
-        [Downloader.run(video_id, input_cfg=input_cfg, run_locally=RUN_LOCALLY) for video_id in video_ids]
+    run_setup = (use_ray, run_locally)
+    run_profile = RunProfile(run_id)
+    if metrics_port is not None:
+        run_profile.serve_prometheus(metrics_port)
+    download_method = 'download' if use_prefetch is True else 'run'
+    context = WorkerContext.get(run_locally=run_locally, ydl_cls=ydl_cls, fetch_transcript_fn=fetch_transcript_fn)
+
+    # Run using ray, locally or on AWS
+    if use_ray is True:
+        if ray.is_initialized() is False:
+            ray.init() if run_locally is True else ray.init(address='auto')
+        if use_actors is True:
+            engine = ActorPoolEngine(
+                input_cfg,
+                run_locally=run_locally,
+                actors_per_node=actors_per_node,
+                max_in_flight_per_actor=max_in_flight_per_actor,
+                run_id=run_id,
+                ydl_cls=ydl_cls,
+                fetch_transcript_fn=fetch_transcript_fn
+            )
     # Run sequentially
-    elif run_setup == (False, True):           
-        for video_id in video_ids:
-            Downloader.run(video_id, input_cfg=input_cfg, run_locally=RUN_LOCALLY)
-    # Run on AWS
-    elif run_setup == (True, False):        
-        ray.init(address='auto') 
-        ray.get([distributed_downloader.remote(video_id, input_cfg=input_cfg) for video_id in video_ids])
-    else:
-        raise NotImplementedError(f'Configuration (USE_RAY, RUN_LOCALLY): {run_setup}, not implemented!')
-    print(f'>>> Time required: {time.time()-st}')
-
-    # Generate reports from the current state of responses table 
-    report_gen = ReportGenerator(dynamo_hlp_instance, s3_hlp_instance)
+    elif run_setup != (False, True):
+        raise NotImplementedError(f'Configuration (use_ray, run_locally): {run_setup}, not implemented!')
+    # Set up the request rate limits and proxies, shared with the workers of the run through a Ray actor on AWS
+    context.get_request_router(input_cfg, run_id=run_id)
+
+    # Every pass downloads the tasks that can be leased, the following ones retry failed tasks after their backoff
+    n_downloaded = 0
+    while task_queue.is_finished() is False:
+        # The tasks generated so far are kept in the unsealed queue, the run is resumed with the same ID
+        if task_queue.generation_error is not None:
+            context.release_request_router()
+            raise RuntimeError(f'Task generation of run {run_id} failed') from task_queue.generation_error
+        # Wait for the retry backoff of pending tasks. Tasks leased by other drivers, or by workers that were lost, are
+        # in flight, the queue is polled until they are done or their lease expires
+        next_available_at = task_queue.next_available_at()
+        if task_queue.is_sealed() is True and next_available_at is None:
+            time.sleep(LEASED_POLL_INTERVAL_S)
+        elif task_queue.is_sealed() is True and next_available_at > time.time():
+            time.sleep(next_available_at - time.time())
+
+        if use_ray is True and use_actors is False:
+            # Stateless tasks pull video IDs from the queue, prefetching is not used
+            num_pullers = max(1, int(ray.cluster_resources().get('CPU', 1)))
+            pullers = [distributed_downloader.options(**scheduler.get_max_resources()).remote(task_queue, input_cfg, ydl_cls, fetch_transcript_fn)
+                       for _ in range(num_pullers)]
+            while len(pullers) > 0:
+                done, pullers = ray.wait(pullers, num_returns=len(pullers), timeout=1)
+                for pulled in ray.get(done):
+                    n_downloaded += pulled['n_downloaded']
+                    run_profile.add_records(pulled['profile'])
+                # Pullers wait for tasks until the queue is sealed, they are cancelled if task generation failed
+                if task_queue.generation_error is not None:
+                    for puller in pullers:
+                        ray.cancel(puller)
+                    break
+            continue
+
+        # Only videos passing the constraints reach the download stage
+        tasks = task_queue.iter_leased()
+        if use_prefetch is True:
+            prefetcher = MetadataPrefetcher(input_cfg, max_concurrency=prefetch_concurrency, context=context, task_queue=task_queue)
+            tasks = prefetcher.iter_prefetched(tasks)
+
+        if use_ray is True:
+            responses = engine.run(tasks, method=download_method)
+        elif split_transcode is True:
+            responses = StagedEngine(
+                input_cfg,
+                context=context,
+                download_concurrency=download_concurrency,
+                transcode_concurrency=transcode_concurrency,
+                max_queued_transcodes=max_queued_transcodes,
+                transcode_fn=transcode_fn
+            ).run(tasks, method=download_method)
+        else:
+            responses = (run_task(task, input_cfg, download_method, context) for task in tasks)
+        for response in responses:
+            task_queue.record_response(response)
+            n_downloaded += response['status']
+            # Collect the stage records of the actors and of the driver
+            run_profile.add_records(response.pop('profile', []) + StageProfiler.drain())
+        # Write the reports and upload the shards still buffered, sharded videos are done once their shard is uploaded
+        if use_ray is True and use_actors is True:
+            task_queue.complete_many(engine.flush())
+        task_queue.complete_many(context.flush())
+        # Leases of samples that were not stored are no longer renewed, they expire and the videos are downloaded again
+        task_queue.release_pending_uploads()
+    run_profile.add_records(StageProfiler.drain())
+    # The workers are done, the rate limiter actor of the run is released
+    context.release_request_router()
+    print(f'>>> {n_downloaded} videos downloaded!')
+    print(f'>>> Tasks of run {run_id}: {task_queue.counts()}')
+    elapsed_s = time.time() - st
+    print(f'>>> Time required: {elapsed_s}')
+
+    # Summarize where the time went and upload the run profile
+    profile_summary = run_profile.summary()
+    for stage, stats in profile_summary['stages'].items():
+        print(f">>> {stage}: n={stats['count']} p50={stats['p50_s']:.2f}s p90={stats['p90_s']:.2f}s p99={stats['p99_s']:.2f}s")
+    print(f">>> {profile_summary['videos_per_s']:.2f} videos/s, {profile_summary['uploaded_MB_per_s']:.2f} MB/s, {profile_summary['retries']} retries")
+    run_profile.upload(s3_hlp_instance)
+    run_profile.close()
+
+    # Summarize the response cache usage of the driver and the actors
+    cache_stats = [context.response_cache.stats()]
+    if use_ray is True and use_actors is True:
+        cache_stats.append(engine.get_cache_stats())
+    print(f">>> Response cache hits: {sum(stats['hits'] for stats in cache_stats)}, misses: {sum(stats['misses'] for stats in cache_stats)}")
+    # Peak memory of the driver, with its transcoding processes, and of the largest actor
+    peak_rss_B = {'driver': StageProfiler.get_peak_rss_B()}
+    if use_ray is True and use_actors is True:
+        peak_rss_B['actors'] = engine.get_peak_rss_B()
+    print(f">>> Peak RSS: {', '.join(f'{name} {rss_B / 2**20:.0f} MiB' for name, rss_B in peak_rss_B.items() if rss_B is not None)}")
+
+    # Write the rejections of task generation still buffered, then generate reports from the current state of responses table 
+    dynamo_hlp_instance.flush()
+    report_gen = ReportGenerator(dynamo_hlp_instance, s3_hlp_instance, report_format=report_format, incremental=incremental_reports)
     report_gen.generate_reports()
+
+    return {
+        'n_downloaded': n_downloaded,
+        'elapsed_s': elapsed_s,
+        'task_counts': task_queue.counts(),
+        'profile': profile_summary,
+        'cache_stats': cache_stats,
+        'peak_rss_B': peak_rss_B
+    }
+
+
+if __name__=='__main__':
+
+    RUN_LOCALLY: bool = False
+    # Runs with the same ID resume from their task queue, a new ID starts a new run
+    RUN_ID: str = 'initial-run'
+    USE_RAY: bool = True
+    # Ray execution settings
+    USE_ACTORS: bool = True
+    ACTORS_PER_NODE: int = 2
+    MAX_IN_FLIGHT_PER_ACTOR: int = 2
+    # Prefetch metadata and transcripts ahead of the downloads
+    USE_PREFETCH: bool = True
+    PREFETCH_CONCURRENCY: int = 16
+    # Without Ray, download raw audio and transcode it with ffmpeg in separate stages, by default one process per CPU
+    SPLIT_TRANSCODE: bool = True
+    DOWNLOAD_CONCURRENCY: int = 4
+    TRANSCODE_CONCURRENCY: int = None
+    MAX_QUEUED_TRANSCODES: int = None
+    # Report settings, incremental reports merge only the rows updated since the previous run
+    REPORT_FORMAT: str = 'csv'
+    INCREMENTAL_REPORTS: bool = False
+    # Per-stage run profile uploaded next to the reports, served as Prometheus metrics if a port is set
+    METRICS_PORT: int = None
+
+    # Load input configuration file
+    input_file = S3Helper().load_object(
+            bucket="ytdlinput",
+            key="input.json"
+        )
+
+    run_pipeline(
+        input_file,
+        run_id=RUN_ID,
+        run_locally=RUN_LOCALLY,
+        use_ray=USE_RAY,
+        use_actors=USE_ACTORS,
+        actors_per_node=ACTORS_PER_NODE,
+        max_in_flight_per_actor=MAX_IN_FLIGHT_PER_ACTOR,
+        use_prefetch=USE_PREFETCH,
+        prefetch_concurrency=PREFETCH_CONCURRENCY,
+        split_transcode=SPLIT_TRANSCODE,
+        download_concurrency=DOWNLOAD_CONCURRENCY,
+        transcode_concurrency=TRANSCODE_CONCURRENCY,
+        max_queued_transcodes=MAX_QUEUED_TRANSCODES,
+        report_format=REPORT_FORMAT,
+        incremental_reports=INCREMENTAL_REPORTS,
+        metrics_port=METRICS_PORT
+    )
@@ -1,3 +1,54 @@
-from .aws_helpers import DynamoDBHelper, S3Helper
-from .downloader import Downloader
-from .generators import ReportGenerator, TaskGenerator
+import importlib
+from typing import TYPE_CHECKING
+
+# Public names and their modules, modules are imported on first access (PEP 562) so that workers only load
+# the dependencies of the code paths they run
+_LAZY_ATTRIBUTES = {
+    'DynamoDBHelper': 'aws_helpers',
+    'S3Helper': 'aws_helpers',
+    'Downloader': 'downloader',
+    'ReportGenerator': 'generators',
+    'TaskGenerator': 'generators',
+    'MetadataPrefetcher': 'prefetch',
+    'RunProfile': 'profiling',
+    'StageProfiler': 'profiling',
+    'TaskScheduler': 'scheduler',
+    'ShardReader': 'sharding',
+    'ShardWriter': 'sharding',
+    'DynamoDBTaskQueue': 'task_queue',
+    'SQLiteTaskQueue': 'task_queue',
+    'TaskQueue': 'task_queue',
+    'WorkerContext': 'worker_context',
+    'ActorPoolEngine': 'ray_engine',
+    'DownloaderActor': 'ray_engine',
+    'StagedEngine': 'staged_engine',
+}
+
+__all__ = list(_LAZY_ATTRIBUTES)
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_LAZY_ATTRIBUTES[name]}', __name__), name)
+    # Cache in the module namespace, later lookups do not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
+
+
+if TYPE_CHECKING:
+    from .aws_helpers import DynamoDBHelper, S3Helper
+    from .downloader import Downloader
+    from .generators import ReportGenerator, TaskGenerator
+    from .prefetch import MetadataPrefetcher
+    from .profiling import RunProfile, StageProfiler
+    from .scheduler import TaskScheduler
+    from .sharding import ShardReader, ShardWriter
+    from .task_queue import DynamoDBTaskQueue, SQLiteTaskQueue, TaskQueue
+    from .worker_context import WorkerContext
+    from .ray_engine import ActorPoolEngine, DownloaderActor
+    from .staged_engine import StagedEngine
@@ -1,44 +1,339 @@
+import atexit
+import codecs
+import hashlib
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from mypy_boto3_dynamodb.service_resource import Table
 from .secrets import AWSCredentials
 
 
+class AWSClientPool:
+    """ Process-wide pool of boto3 clients and resources shared by all helper instances, so that the session,
+    credential resolution and HTTP connection pool are set up once per worker instead of once per video.
+    """
+
+    MAX_POOL_CONNECTIONS = 50
+
+    _session = None
+    _clients = dict()
+    _event_handlers = list()
+    _local = threading.local()
+    _lock = threading.Lock()
+
+    @classmethod
+    def _get_session(cls) -> boto3.session.Session:
+        if cls._session is None:
+            cls._session = boto3.session.Session(
+                aws_access_key_id = AWSCredentials.AWS_ACCESS_KEY, 
+                aws_secret_access_key = AWSCredentials.AWS_SECRET_KEY,
+                region_name = AWSCredentials.AWS_REGION_NAME
+            )
+        return cls._session
+
+    @classmethod
+    def client(cls, service_name: str):
+        # Clients are thread-safe, one instance per service is shared by all threads
+        with cls._lock:
+            if service_name not in cls._clients:
+                cls._clients[service_name] = cls._register_event_handlers(cls._get_session().client(
+                    service_name, 
+                    config=Config(max_pool_connections=cls.MAX_POOL_CONNECTIONS)
+                ))
+            return cls._clients[service_name]
+
+    @classmethod
+    def resource(cls, service_name: str):
+        # Resources are not thread-safe, one instance per service is kept for each thread
+        resources = cls._local.__dict__.setdefault('resources', dict())
+        if service_name not in resources:
+            with cls._lock:
+                resources[service_name] = cls._get_session().resource(
+                    service_name, 
+                    config=Config(max_pool_connections=cls.MAX_POOL_CONNECTIONS)
+                )
+                cls._register_event_handlers(resources[service_name].meta.client)
+        return resources[service_name]
+
+    @classmethod
+    def _register_event_handlers(cls, client):
+        for event_name, handler in cls._event_handlers:
+            client.meta.events.register(event_name, handler)
+        return client
+
+    @classmethod
+    def register_event_handler(cls, event_name: str, handler) -> None:
+        # Register a botocore event handler on the shared clients and on all clients and resources created later
+        with cls._lock:
+            cls._event_handlers.append((event_name, handler))
+            for client in cls._clients.values():
+                client.meta.events.register(event_name, handler)
+
+
 class S3Helper:    
     """ S3 helper class with basic functionalities that can be extended based on further needs. 
+
+    Files are uploaded with a tuned `TransferConfig`, in parts of `MULTIPART_PART_SIZE` bytes sent by up to
+    `MAX_CONCURRENCY` threads per file. Bulk uploads and loads run in a thread pool of `MAX_TRANSFER_WORKERS` threads
+    shared by all helper instances of the process. Uploads of objects that did not change since the last upload can be
+    skipped, the SHA-256 of the body is stored in the object metadata and compared before uploading.
     """
 
-    def __init__(self) -> boto3.client:
-        self.s3_client = boto3.client('s3', 
-        aws_access_key_id = AWSCredentials.AWS_ACCESS_KEY, 
-        aws_secret_access_key = AWSCredentials.AWS_SECRET_KEY,
-        region_name = AWSCredentials.AWS_REGION_NAME
+    MULTIPART_THRESHOLD = 16 * 2**20
+    MULTIPART_PART_SIZE = 8 * 2**20
+    MULTIPART_MAX_BUFFERED_PARTS = 4
+    MAX_CONCURRENCY = 8
+    MAX_TRANSFER_WORKERS = 16
+    STREAM_CHUNK_SIZE = 2**20
+    CHECKSUM_METADATA_KEY = 'sha256'
+
+    _executor = None
+    _lock = threading.Lock()
+
+    def __init__(self, transfer_config: TransferConfig = None) -> boto3.client:
+        self.s3_client = AWSClientPool.client('s3')
+        self.transfer_config = transfer_config or TransferConfig(
+            multipart_threshold=self.MULTIPART_THRESHOLD,
+            multipart_chunksize=self.MULTIPART_PART_SIZE,
+            max_concurrency=self.MAX_CONCURRENCY
         )
 
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        # Transfer threads are shared by all helper instances, the pool lives as long as the process
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.MAX_TRANSFER_WORKERS, thread_name_prefix='s3-transfer')
+            return cls._executor
+
     def upload_file(self, filename: str, bucket: str, key: str, delete_filename: bool = True) -> None:
-        # Upload file from filesystem
+        # Upload file from filesystem, large files in parallel parts
         self.s3_client.upload_file(
             Filename=filename,
             Bucket=bucket,
             Key=key,
+            Config=self.transfer_config
         )
         # Delete the file if uploaded successfully
         if delete_filename == True:
             os.remove(filename)
 
-    def upload_object(self, body: str, bucket: str, key: str) -> None:
-        # Upload object from memory
-        self.s3_client.put_object(
-            Body=body,
+    def _is_unchanged(self, bucket: str, key: str, checksum: str) -> bool:
+        try:
+            head = self.s3_client.head_object(Bucket=bucket, Key=key)
+        except self.s3_client.exceptions.ClientError as exc:
+            if exc.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return head.get('Metadata', {}).get(self.CHECKSUM_METADATA_KEY) == checksum
+
+    @classmethod
+    def _get_checksum(cls, body) -> str:
+        # SHA-256 of bytes or of a seekable file-like body, which is read in chunks and rewound
+        if not hasattr(body, 'read'):
+            return hashlib.sha256(body).hexdigest()
+        start = body.tell()
+        checksum = hashlib.sha256()
+        for chunk in iter(lambda: body.read(cls.STREAM_CHUNK_SIZE), b''):
+            checksum.update(chunk)
+        body.seek(start)
+        return checksum.hexdigest()
+
+    @staticmethod
+    def _get_size(body) -> int:
+        if not hasattr(body, 'read'):
+            return len(body)
+        start = body.tell()
+        size = body.seek(0, os.SEEK_END) - start
+        body.seek(start)
+        return size
+
+    def upload_object(self, body: str, bucket: str, key: str, skip_unchanged: bool = False) -> int:
+        # Upload object from memory or from a seekable file-like body, which is sent without a copy. Returns the
+        # uploaded bytes, 0 if the object is unchanged and skipped
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        request = {'Body': body, 'Bucket': bucket, 'Key': key}
+        if skip_unchanged is True:
+            checksum = self._get_checksum(body)
+            if self._is_unchanged(bucket, key, checksum):
+                return 0
+            request['Metadata'] = {self.CHECKSUM_METADATA_KEY: checksum}
+        size = self._get_size(body)
+        self.s3_client.put_object(**request)
+        return size
+
+    def upload_many(self, objects: dict, bucket: str, skip_unchanged: bool = False) -> dict:
+        # Upload objects from memory in the shared transfer pool, `objects` maps keys to bodies
+        futures = {
+            key: self._get_executor().submit(self.upload_object, body, bucket, key, skip_unchanged)
+            for key, body in objects.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def load_many(self, keys: Iterable[str], bucket: str, missing_ok: bool = False) -> dict:
+        # Load raw object contents in the shared transfer pool, missing objects are None if `missing_ok`
+
+        def load(key: str) -> bytes:
+            try:
+                return self.load_object_bytes(bucket=bucket, key=key)
+            except self.s3_client.exceptions.NoSuchKey:
+                if missing_ok is True:
+                    return None
+                raise
+        futures = {key: self._get_executor().submit(load, key) for key in keys}
+        return {key: future.result() for key, future in futures.items()}
+
+    @staticmethod
+    def _read_part(stream, part_size: int) -> bytes:
+        # Read a full part, streams such as pipes may return less than requested
+        chunks, size = [], 0
+        while size < part_size:
+            chunk = stream.read(part_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)
+
+    def upload_stream(self, stream, bucket: str, key: str, part_size: int = None, max_buffered_parts: int = None) -> int:
+        # Upload a binary stream of unknown length with a multipart upload, at most `max_buffered_parts`
+        # parts are held in memory and uploaded in the background while the stream is being read
+        part_size = part_size or self.MULTIPART_PART_SIZE
+        max_buffered_parts = max_buffered_parts or self.MULTIPART_MAX_BUFFERED_PARTS
+        upload_id = self.s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        buffered_parts = threading.BoundedSemaphore(max_buffered_parts)
+
+        def upload_part(part_number: int, body: bytes) -> dict:
+            try:
+                response = self.s3_client.upload_part(
+                    Body=body,
+                    Bucket=bucket,
+                    Key=key,
+                    PartNumber=part_number,
+                    UploadId=upload_id
+                )
+                return {'PartNumber': part_number, 'ETag': response['ETag']}
+            finally:
+                buffered_parts.release()
+
+        total_size = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max_buffered_parts) as executor:
+                futures = []
+                while True:
+                    buffered_parts.acquire()
+                    body = self._read_part(stream, part_size)
+                    # The first part is always uploaded, S3 does not complete uploads without parts
+                    if len(body) == 0 and len(futures) > 0:
+                        buffered_parts.release()
+                        break
+                    futures.append(executor.submit(upload_part, len(futures) + 1, body))
+                    total_size += len(body)
+                    if len(body) < part_size:
+                        break
+                parts = [future.result() for future in futures]
+            self.s3_client.complete_multipart_upload(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except BaseException:
+            self.s3_client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+        return total_size
+
+    def load_object_bytes(self, bucket: str, key: str) -> bytes:
+        # Load raw object content from S3
+        return self.s3_client.get_object(
+            Bucket=bucket,
+            Key=key
+        )['Body'].read()
+
+    def load_object_range(self, bucket: str, key: str, start: int, length: int) -> bytes:
+        # Load `length` bytes of an object from `start` with a ranged GET
+        if length == 0:
+            return b''
+        return self.s3_client.get_object(
             Bucket=bucket,
             Key=key,
-        )
+            Range=f'bytes={start}-{start + length - 1}'
+        )['Body'].read()
+
+    def list_keys(self, bucket: str, prefix: str = '') -> Iterator[str]:
+        # Keys under the prefix, listed page by page
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
+    @staticmethod
+    def _iter_json_values(chunks: Iterator[bytes]) -> Iterator:
+        # Decode the elements of a JSON array, or a single JSON value, from a stream of chunks,
+        # only the undecoded tail of the stream is held in memory
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        buffer, position, exhausted, in_array = '', 0, False, None
+        while True:
+            # Skip whitespace and separators between values
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if in_array is None and position < len(buffer):
+                in_array = buffer[position] == '['
+                position += int(in_array)
+                continue
+            if in_array is True and position < len(buffer) and buffer[position] == ']':
+                return
+            if position < len(buffer):
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if exhausted is True:
+                        raise
+                    value, end = None, None
+                # A value that is not followed by a delimiter may continue in the next chunk, e.g. a number
+                if end is not None and (exhausted is True or (end < len(buffer) and buffer[end] in ' \t\r\n,]')):
+                    yield value
+                    position = end
+                    if in_array is False:
+                        return
+                    continue
+            elif exhausted is True:
+                if in_array is True:
+                    raise json.JSONDecodeError('Unterminated array', buffer, position)
+                return
+            chunk = next(chunks, None)
+            exhausted = chunk is None
+            buffer = buffer[position:] + text_decoder.decode(chunk or b'', final=exhausted)
+            position = 0
 
-    def load_object(self, bucket: str, key: str) -> dict:
+    def iter_object(self, bucket: str, key: str) -> Iterator:
+        # Stream the records of a JSONL object or the elements of a JSON array without loading the whole body
+        file_type = key.split('.')[-1]
+        body = self.s3_client.get_object(
+            Bucket=bucket,
+            Key=key
+        )['Body']
+        if file_type == 'jsonl':
+            for line in body.iter_lines(chunk_size=self.STREAM_CHUNK_SIZE):
+                if line.strip():
+                    yield json.loads(line)
+        elif file_type == 'json':
+            yield from self._iter_json_values(body.iter_chunks(chunk_size=self.STREAM_CHUNK_SIZE))
+        else:
+            raise NotImplementedError(f'Object streaming for filetype {file_type} is not implemented!')
+
+    def load_object(self, bucket: str, key: str):
         # Parse the file type
         file_type = key.split('.')[-1]
+        if file_type == 'jsonl':
+            return list(self.iter_object(bucket=bucket, key=key))
         # Load object from S3
         obj = self.s3_client.get_object(
             Bucket=bucket,
@@ -50,17 +345,154 @@ class S3Helper:
             raise NotImplementedError(f'Object conversion for filetype {file_type} is not implemented!')
         
 
+class BufferedWriteError(Exception):
+    """Raised by `BufferedItemWriter.flush` when items could not be written, `video_ids` holds the video IDs of the items."""
+
+    def __init__(self, table_name: str, items: list, reason: str) -> None:
+        self.video_ids = [item.get('video_id') for item in items]
+        super().__init__(f'{len(items)} items of {table_name} not written ({reason}), video IDs: {self.video_ids}')
+
+
+class BufferedItemWriter:
+    """ Buffered writer of one DynamoDB table, items are written in the background with `BatchWriteItem`.
+
+    Items are buffered in the worker and written by a background thread in batches of `BATCH_SIZE` items, as soon
+    as a full batch is buffered or every `flush_interval_s` seconds. Unprocessed items and the items of failed batches
+    are buffered again and retried with exponential backoff. A buffered item replaces a buffered item with the same
+    key, as one batch cannot write a key twice. Writers block when `max_buffered_items` are buffered and are flushed
+    when the process exits. Items still not written after `MAX_ATTEMPTS` attempts are raised by the next `flush` as a
+    `BufferedWriteError` with their video IDs.
+    """
+
+    BATCH_SIZE = 25
+    FLUSH_INTERVAL_S = 1
+    MAX_BUFFERED_ITEMS = 1000
+    MAX_ATTEMPTS = 8
+    RETRY_BACKOFF_S = 0.05
+
+    def __init__(self, table_name: str, key_names: list, flush_interval_s: float = None, max_buffered_items: int = None) -> None:
+        self.table_name = table_name
+        self.key_names = key_names
+        self.flush_interval_s = flush_interval_s or self.FLUSH_INTERVAL_S
+        self.max_buffered_items = max_buffered_items or self.MAX_BUFFERED_ITEMS
+        self._items = dict()
+        # Failed attempts of the buffered items that are retried, by key
+        self._attempts = dict()
+        self._n_writing = 0
+        self._n_flushing = 0
+        self._failed_items = list()
+        self._failure_reason = None
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+        atexit.register(self.close)
+
+    def _get_key(self, item: dict) -> tuple:
+        return tuple(item[key_name] for key_name in self.key_names)
+
+    def put(self, item: dict) -> None:
+        with self._cond:
+            if self._closed is True:
+                raise RuntimeError(f'Buffered writer of {self.table_name} is closed')
+            # Apply backpressure when the writes do not keep up
+            self._cond.wait_for(lambda: len(self._items) < self.max_buffered_items)
+            key = self._get_key(item)
+            self._items[key] = item
+            self._attempts.pop(key, None)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'{self.table_name}-writer', daemon=True)
+                self._thread.start()
+            if len(self._items) >= self.BATCH_SIZE:
+                self._cond.notify_all()
+
+    def flush(self) -> None:
+        # Wait until all buffered items are written or failed
+        with self._cond:
+            self._n_flushing += 1
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: len(self._items) == 0 and self._n_writing == 0)
+            self._n_flushing -= 1
+            if len(self._failed_items) > 0:
+                failed_items, self._failed_items = self._failed_items, list()
+                raise BufferedWriteError(self.table_name, failed_items, self._failure_reason)
+
+    def close(self) -> None:
+        # Write the buffered items and stop the background thread
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _requeue(self, items: list, reason: str) -> int:
+        # Buffer the unwritten items again, unless a newer item with the same key was put in the meantime, and fail
+        # the items that used up their attempts. Returns the highest number of attempts of the requeued items
+        max_attempts = 0
+        for item in items:
+            key = self._get_key(item)
+            if key in self._items:
+                continue
+            attempts = self._attempts.pop(key, 0) + 1
+            if attempts >= self.MAX_ATTEMPTS:
+                self._failed_items.append(item)
+                self._failure_reason = reason
+                continue
+            self._items[key] = item
+            self._attempts[key] = attempts
+            max_attempts = max(max_attempts, attempts)
+        return max_attempts
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: len(self._items) >= self.BATCH_SIZE or self._n_flushing > 0 or self._closed,
+                    timeout=self.flush_interval_s
+                )
+                if len(self._items) == 0:
+                    if self._closed is True:
+                        return
+                    continue
+                batch = [self._items.pop(key) for key in list(self._items)[:self.BATCH_SIZE]]
+                self._n_writing += len(batch)
+                self._cond.notify_all()
+            try:
+                unprocessed, reason = self._write_batch(batch), 'unprocessed'
+            except Exception as exc:
+                unprocessed, reason = batch, str(exc)
+            with self._cond:
+                self._n_writing -= len(batch)
+                # Written items are done, the others are retried
+                for key in {self._get_key(item) for item in batch} - {self._get_key(item) for item in unprocessed}:
+                    self._attempts.pop(key, None)
+                max_attempts = self._requeue(unprocessed, reason)
+                self._cond.notify_all()
+            if max_attempts > 0:
+                time.sleep(self.RETRY_BACKOFF_S * 2**(max_attempts - 1))
+
+    def _write_batch(self, items: list) -> list:
+        # The client of the resource serializes the items as the table does, returns the unprocessed items
+        client = AWSClientPool.resource('dynamodb').meta.client
+        response = client.batch_write_item(RequestItems={self.table_name: [{'PutRequest': {'Item': item}} for item in items]})
+        return [request['PutRequest']['Item'] for request in response.get('UnprocessedItems', dict()).get(self.table_name, [])]
+
+
 class DynamoDBHelper:
     """ DynamoDB helper class with basic functionalities that can be extended based on further needs. 
     """
 
     def __init__(self, table_name: str) -> Table:
-        dynamodb = boto3.resource('dynamodb', 
-            aws_access_key_id = AWSCredentials.AWS_ACCESS_KEY, 
-            aws_secret_access_key = AWSCredentials.AWS_SECRET_KEY,
-            region_name = AWSCredentials.AWS_REGION_NAME
-            )
-        self.dynamodb_table = dynamodb.Table(table_name) 
+        self.table_name = table_name
+        self._local = threading.local()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+
+    @property
+    def dynamodb_table(self) -> Table:
+        # Bind the table to the pooled resource of the calling thread
+        if getattr(self._local, 'table', None) is None:
+            self._local.table = AWSClientPool.resource('dynamodb').Table(self.table_name)
+        return self._local.table
 
     def import_item(self, item: dict):
         # Import one item to the table
@@ -68,17 +500,69 @@ class DynamoDBHelper:
             Item=item
         )
 
+    @property
+    def buffered_writer(self) -> BufferedItemWriter:
+        # One writer per table is shared by all threads of the worker
+        with self._writer_lock:
+            if self._writer is None:
+                key_names = [key['AttributeName'] for key in self.dynamodb_table.key_schema]
+                self._writer = BufferedItemWriter(self.table_name, key_names)
+            return self._writer
+
+    def import_item_buffered(self, item: dict) -> None:
+        # Import one item in the background, see `flush`
+        self.buffered_writer.put(item)
+
+    def flush(self) -> None:
+        # Wait until the items imported in the background are written
+        if self._writer is not None:
+            self._writer.flush()
+
+    def get_item(self, key: dict, projection_expression: str = None) -> dict:
+        # Get one item by its primary key, None if it does not exist. Only the attributes of the projection expression are read if given
+        get_expressions = {"ProjectionExpression": projection_expression} if projection_expression is not None else dict()
+        return self.dynamodb_table.get_item(
+            Key=key,
+            **get_expressions
+        ).get('Item')
+
+    def transact_write_items(self, transact_items: list) -> None:
+        # Write the items all or none, the table name is added to every action
+        self.dynamodb_table.meta.client.transact_write_items(
+            TransactItems=[{action: {"TableName": self.table_name, **params} for action, params in item.items()} for item in transact_items]
+        )
+
+    def update_item(self, key: dict, update_expressions: dict) -> dict:
+        # Update one item in place with the update expressions
+        return self.dynamodb_table.update_item(
+            Key=key,
+            **update_expressions
+        )
+
     def query_items(self, query_expressions: dict):
         # Query items from the table matching the query expressions 
         return self.dynamodb_table.query(
             **query_expressions
         )
     
-    def query_all_table_items(self):
-        # Query all items from table
-        response = self.dynamodb_table.scan()
+    def query_all_items(self, query_expressions: dict) -> list:
+        # Query all items matching the query expressions, following pagination
+        response = self.dynamodb_table.query(**query_expressions)
         items = response['Items']
         while 'LastEvaluatedKey' in response:
-            response = self.dynamodb_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
+            response = self.dynamodb_table.query(ExclusiveStartKey=response['LastEvaluatedKey'], **query_expressions)
             items.extend(response['Items'])
-        return items
\ No newline at end of file
+        return items
+    
+    def scan_pages(self, scan_expressions: dict = None) -> Iterator[list]:
+        # Scan the table lazily, yielding the items page by page
+        scan_expressions = scan_expressions or dict()
+        response = self.dynamodb_table.scan(**scan_expressions)
+        yield response['Items']
+        while 'LastEvaluatedKey' in response:
+            response = self.dynamodb_table.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scan_expressions)
+            yield response['Items']
+    
+    def query_all_table_items(self):
+        # Query all items from table
+        return [item for page in self.scan_pages() for item in page]
\ No newline at end of file
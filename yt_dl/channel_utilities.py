@@ -1,8 +1,12 @@
-import pandas as pd
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterator
+
 import requests
-import scrapetube
 from boto3.dynamodb.conditions import Key
-from bs4 import BeautifulSoup
+from botocore.exceptions import ClientError
 
 from .aws_helpers import DynamoDBHelper
 
@@ -13,75 +17,197 @@ class ChannelMetadataHelper:
 
     @staticmethod
     def _get_channel_id(channel_url: str) -> str:
+        # Imported on use, only needed when generating tasks
+        from bs4 import BeautifulSoup
         resp = requests.get(channel_url)
         soup = BeautifulSoup(resp.text, 'html.parser')
         return soup.select_one('meta[property="og:url"]')['content'].strip('/').split('/')[-1]
     
     @staticmethod
     def _get_channel_videos(channel_url: str) -> list:
+        import scrapetube
         videos = scrapetube.get_channel(channel_url=channel_url)
         return list(videos)
 
+    @staticmethod
+    def _iter_channel_videos(channel_url: str, page_sleep_s: float = 1) -> Iterator[dict]:
+        # Videos are yielded as the pages of the upload history are fetched
+        import scrapetube
+        return scrapetube.get_channel(channel_url=channel_url, sleep=page_sleep_s)
+
 class ChannelPerformanceUtilities():
     """A utilities class for checking channel performance constraints.
+
+    Channel performance is kept as one aggregate record per channel in the channel stats table
+    (downloaded seconds, success count, attempt count and status), updated atomically with ADD expressions
+    whenever a download report is written, so checking a channel is a single `GetItem`. Every counted video has a
+    marker item in the same table, keyed `<channel_id>#<video_id>`, written in one transaction with the update of the
+    record, so retried tasks do not count twice and the record stays the same size however many videos are counted.
+    Records written before the markers may hold the IDs of their counted videos in `counted_video_ids`, the set is
+    still checked by the updates but no longer extended, and left out of reads. Records are cached in the worker for
+    `STATS_CACHE_TTL_S` seconds.
     """
 
     CHECK_AFTER_N_VIDEOS = 5
+    # Status of the reports of videos rejected from the channel listing, they are not download attempts
+    REJECTED_STATUS = 'Rejected'
+    STATS_CACHE_TTL_S = 30
     INACTIVE_CHANNELS = []
+    # Attributes of the aggregate record read by the checks
+    STATS_PROJECTION = 'channel_id, downloaded_seconds, success_count, attempt_count, channel_status, reason'
 
-    @classmethod
-    def _check_channel_responses(cls, response_df: pd.DataFrame, input_cfg):
+    _stats_cache = dict()
+    _stats_cache_lock = threading.Lock()
 
-        successfull_dl_df = response_df.loc[response_df['download_status'] == True]
+    @staticmethod
+    def _get_counted_key(channel_id: str, video_id: str) -> dict:
+        # Key of the marker item of a counted video
+        return {"channel_id": f'{channel_id}#{video_id}'}
 
+    @classmethod
+    def _cache_channel_stats(cls, channel_id: str, channel_stats: dict) -> None:
+        with cls._stats_cache_lock:
+            cls._stats_cache[channel_id] = (time.time() + cls.STATS_CACHE_TTL_S, channel_stats)
+
+    @classmethod
+    def check_channel_stats(cls, channel_stats: dict, input_cfg: dict) -> str:
+        # Failure message of the first channel limit the aggregate record exceeds, None if it is within the limits
         # Check total downloaded hours
-        total_dl_h = round(successfull_dl_df['video_duration'].sum() / 60 / 60, 2)
+        total_dl_h = round(channel_stats.get('downloaded_seconds', 0) / 60 / 60, 2)
         if total_dl_h > input_cfg['max_download_H_per_channel']:
             return 'Max hours per channel exceeded'
 
         # Check total downloaded videos
-        total_dl_v = successfull_dl_df.shape[1]
+        total_dl_v = channel_stats.get('success_count', 0)
         if total_dl_v > input_cfg['max_downloaded_videos_per_channel']:
             return 'Max downloaded videos per channel exceeded'
         
         # Get download success ratio
-        if response_df.shape[0] >= cls.CHECK_AFTER_N_VIDEOS:
-            succ_ratio = response_df.shape[0] / total_dl_v
+        total_attempts = channel_stats.get('attempt_count', 0)
+        if total_attempts >= cls.CHECK_AFTER_N_VIDEOS:
+            succ_ratio = total_dl_v / total_attempts
             if succ_ratio < input_cfg['min_successful_download_ration']:
                 return 'Minimum success rate not achieved'
+
+    @classmethod
+    def _backfill_channel_stats(cls, dynamo_hlp_instance: DynamoDBHelper, stats_hlp_instance: DynamoDBHelper, channel_id: str) -> dict:
+        # Build the aggregate record from the channel history, needed once for channels recorded before the stats table.
+        # Only Active reports are attempts, rejections from the listing are recorded with REJECTED_STATUS
+        items = dynamo_hlp_instance.query_all_items({
+            "KeyConditionExpression": Key('channel_id').eq(channel_id),
+            "ProjectionExpression": 'video_id, download_status, video_duration, channel_status, reason'
+        })
+        active_items = [item for item in items if item.get('channel_status') == 'Active']
+        inactive_items = [item for item in items if item.get('channel_status') == 'Inactive']
+        channel_stats = {
+            "channel_id": channel_id,
+            "downloaded_seconds": sum(Decimal(item.get('video_duration', 0)) for item in active_items if item['download_status'] == True),
+            "success_count": sum(1 for item in active_items if item['download_status'] == True),
+            "attempt_count": len(active_items),
+            "channel_status": "Inactive" if len(inactive_items) > 0 else "Active"
+        }
+        if len(inactive_items) > 0:
+            channel_stats["reason"] = inactive_items[0].get('reason')
+        # Mark the counted videos before the record is created, markers written again by a concurrent backfill are the same
+        with stats_hlp_instance.dynamodb_table.batch_writer() as batch:
+            for item in active_items:
+                batch.put_item(Item=cls._get_counted_key(channel_id, item['video_id']))
+        try:
+            stats_hlp_instance.dynamodb_table.put_item(
+                Item=channel_stats,
+                ConditionExpression='attribute_not_exists(channel_id)'
+            )
+        except ClientError as exc:
+            # Another worker created the record in the meantime
+            if exc.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            channel_stats = stats_hlp_instance.get_item({"channel_id": channel_id}, projection_expression=cls.STATS_PROJECTION)
+        return channel_stats
+
+    @classmethod
+    def get_channel_stats(cls, dynamo_hlp_instance: DynamoDBHelper, stats_hlp_instance: DynamoDBHelper, channel_id: str) -> dict:
+        # Serve from the worker cache while fresh
+        with cls._stats_cache_lock:
+            expires_at, channel_stats = cls._stats_cache.get(channel_id, (0, None))
+        if expires_at > time.time():
+            return channel_stats
+
+        channel_stats = stats_hlp_instance.get_item({"channel_id": channel_id}, projection_expression=cls.STATS_PROJECTION)
+        if channel_stats is None:
+            channel_stats = cls._backfill_channel_stats(dynamo_hlp_instance, stats_hlp_instance, channel_id)
+        cls._cache_channel_stats(channel_id, channel_stats)
+        return channel_stats
+
+    @classmethod
+    def update_channel_stats(cls, stats_hlp_instance: DynamoDBHelper, channel_id: str, video_id: str, download_status: bool, video_duration: Decimal) -> None:
+        # Atomically add the outcome of one video to the channel aggregate and mark the video, unless it was already counted
+        try:
+            stats_hlp_instance.transact_write_items([
+                {"Put": {
+                    "Item": cls._get_counted_key(channel_id, video_id),
+                    "ConditionExpression": 'attribute_not_exists(channel_id)'
+                }},
+                {"Update": {
+                    "Key": {"channel_id": channel_id},
+                    "UpdateExpression": 'ADD attempt_count :one, success_count :succ, downloaded_seconds :dur '
+                                        'SET channel_status = if_not_exists(channel_status, :active)',
+                    # Videos counted in the ID set of older records
+                    "ConditionExpression": 'NOT contains(counted_video_ids, :video_id)',
+                    "ExpressionAttributeValues": {
+                        ":one": 1,
+                        ":succ": 1 if download_status else 0,
+                        ":dur": Decimal(str(video_duration)) if download_status else Decimal(0),
+                        ":video_id": video_id,
+                        ":active": "Active"
+                    }
+                }}
+            ])
+        except ClientError as exc:
+            # A retried task reported the video again
+            reasons = [reason.get('Code') for reason in exc.response.get('CancellationReasons', [])]
+            if exc.response['Error']['Code'] != 'TransactionCanceledException' or 'ConditionalCheckFailed' not in reasons:
+                raise
+        cls._cache_channel_stats(channel_id, stats_hlp_instance.get_item({"channel_id": channel_id}, projection_expression=cls.STATS_PROJECTION))
+
+    @classmethod
+    def mark_channel_inactive(cls, stats_hlp_instance: DynamoDBHelper, channel_id: str, reason: str) -> None:
+        stats_hlp_instance.update_item(
+            key={"channel_id": channel_id},
+            update_expressions={
+                "UpdateExpression": 'SET channel_status = :inactive, reason = :reason',
+                "ExpressionAttributeValues": {
+                    ":inactive": "Inactive",
+                    ":reason": reason
+                }
+            }
+        )
+        cls._cache_channel_stats(channel_id, stats_hlp_instance.get_item({"channel_id": channel_id}, projection_expression=cls.STATS_PROJECTION))
         
     @classmethod
-    def check_channel_constraints(cls, dynamo_hlp_instance: DynamoDBHelper, channel_id: str, video_id: str, input_cfg: dict) -> bool:
+    def check_channel_constraints(cls, dynamo_hlp_instance: DynamoDBHelper, stats_hlp_instance: DynamoDBHelper, channel_id: str, video_id: str, input_cfg: dict) -> bool:
         
+        # Load channel aggregate
+        channel_stats = cls.get_channel_stats(dynamo_hlp_instance, stats_hlp_instance, channel_id)
+
         # Check if channel is active
-        response = dynamo_hlp_instance.query_items({
-            "KeyConditionExpression": Key('channel_id').eq(channel_id),
-            "FilterExpression": Key('channel_status').eq('Inactive')
-        })
-        if response['Count'] > 0:
+        if channel_stats.get('channel_status') == 'Inactive':
             cls.INACTIVE_CHANNELS.append(channel_id)
             return False
 
-        # Load past responses
-        response = dynamo_hlp_instance.query_items({
-            "KeyConditionExpression": Key('channel_id').eq(channel_id),
-            "FilterExpression": Key('channel_status').eq('Active'),
-            "ProjectionExpression": 'download_status, video_duration'
-        })
-        if response['Count'] > 0:
-            # Check constraints
-            constraint_failure_msg = cls._check_channel_responses(pd.DataFrame(response['Items']), input_cfg)
-            if constraint_failure_msg is not None:
-                # Import download request status
-                dynamo_hlp_instance.import_item(
-                    item = {
-                        "channel_id": channel_id,
-                        "video_id": video_id,
-                        "update_time": pd.Timestamp.now().strftime('%Y-%m-%d %H:%m:%S'),
-                        "download_status": False,  # Sample download success status
-                        "channel_status": "Inactive",
-                        "reason": constraint_failure_msg
-                })
-                return False
+        # Check constraints
+        constraint_failure_msg = cls.check_channel_stats(channel_stats, input_cfg)
+        if constraint_failure_msg is not None:
+            # Import download request status in the background
+            dynamo_hlp_instance.import_item_buffered(
+                item = {
+                    "channel_id": channel_id,
+                    "video_id": video_id,
+                    "update_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    "download_status": False,  # Sample download success status
+                    "channel_status": "Inactive",
+                    "reason": constraint_failure_msg
+            })
+            cls.mark_channel_inactive(stats_hlp_instance, channel_id, constraint_failure_msg)
+            return False
         # Constraints met
         return True
@@ -1,9 +1,13 @@
-import yt_dlp as youtube_dl
+import os
+from io import BytesIO
 
-from .aws_helpers import DynamoDBHelper, S3Helper
 from .channel_utilities import ChannelPerformanceUtilities
-from .utils import load_yt_dl_config
-from .video_utilities import VideoMetadataUtilities
+from .profiling import StageProfiler
+from .rate_limiting import RequestRouter
+from .sharding import ShardWriter
+from .streaming import AudioStreamer
+from .video_utilities import TranscriptHelper, VideoMetadataUtilities
+from .worker_context import WorkerContext
 
 
 
@@ -14,49 +18,219 @@ class Downloader:
     """
 
     YT_BASE_URL = 'https://www.youtube.com/watch?v='
+    # Heavy info fields that are not used after extraction are not cached
+    CACHED_INFO_DROP_KEYS = ('formats', 'thumbnails', 'automatic_captions', 'subtitles', 'heatmap')
+    # Signed media URLs expire after about six hours
+    AUDIO_SOURCE_MAX_AGE_S = 3 * 60 * 60
+    # Report fields describing the request rather than the video are not stored in the shards
+    SHARD_DROP_REPORT_KEYS = ('update_time', 'channel_status', 'download_status', 'reason')
 
     @classmethod
-    def run(cls, video_id: str, input_cfg: dict, run_locally: bool = False):
-        
-        # Initialize dynamo and s3 helper instances
-        dynamo_hlp_instance = DynamoDBHelper(table_name = 'VideoChannelInfoTable')
-        s3_hlp_instance = S3Helper()
-
-        # Load yt_dl configuration and set random proxy
-        yt_dl_cfg = load_yt_dl_config(run_locally=run_locally)
-        
-        with youtube_dl.YoutubeDL(yt_dl_cfg) as ydl:
-            video_url = cls.YT_BASE_URL + video_id
-            
-            # Get channel ID
-            video_metadata = ydl.extract_info(video_url, download = False)
-            channel_id = video_metadata['uploader_url'].split('@')[-1].strip()
-
-            # Check current channel performance
-            cnsts_passed = ChannelPerformanceUtilities.check_channel_constraints(dynamo_hlp_instance, channel_id, video_id, input_cfg)
-            if cnsts_passed == False:
-                return
-                
-            # Check metadata constraints
-            cnsts_passed, cnsts_failure_msg, video_srt_content, calc_metadata = VideoMetadataUtilities.check_video_constraints(video_id, input_cfg, video_metadata)
-            VideoMetadataUtilities.upload_dl_metadata_report(dynamo_hlp_instance, channel_id, video_id, video_metadata, cnsts_failure_msg, calc_metadata)
-            if cnsts_passed == False:
-                return 
-            
-            # Download video
-            ydl.download([video_url,])
-
-        # Upload video file
-        file_path = f"./data/audio_files/{video_id}.flac" if run_locally else f"/tmp/audio_files/{video_id}.flac"
-        s3_hlp_instance.upload_file(
-            filename=file_path,
-            bucket="ytdldata",
-            key=f"{channel_id}/audio_files/{video_id}.flac"
+    def _extract_info(cls, video_id: str, context: WorkerContext, max_age_s: float = None) -> dict:
+        video_url = cls.YT_BASE_URL + video_id
+
+        def extract_info(proxy: str) -> dict:
+            ydl = context.get_ydl(proxy)
+            return ydl.sanitize_info(ydl.extract_info(video_url, download = False))
+
+        def fetch_info() -> dict:
+            video_metadata = context.get_request_router().call(RequestRouter.YOUTUBE_HOST, extract_info)
+            return {key: value for key, value in video_metadata.items() if key not in cls.CACHED_INFO_DROP_KEYS}
+        with StageProfiler.stage('extract_info'):
+            return context.response_cache.get_or_fetch('info', (video_id,), fetch_info, max_age_s=max_age_s)
+
+    @classmethod
+    def prepare(cls, video_id: str, input_cfg: dict, context: WorkerContext) -> dict:
+        # Fetch metadata and transcript and check constraints, returns None if the video is rejected
+        with StageProfiler.video(video_id, phase='prepare'):
+            return cls._prepare(video_id, input_cfg, context)
+
+    @classmethod
+    def _prepare(cls, video_id: str, input_cfg: dict, context: WorkerContext) -> dict:
+        request_router = context.get_request_router(input_cfg)
+        dynamo_hlp_instance = context.dynamo_hlp_instance
+        stats_hlp_instance = context.stats_hlp_instance
+        shard_output = input_cfg.get('shard_output', False) is True
+        # Sharded outputs are packed from the audio file on disk, audio is not streamed
+        stream_audio = input_cfg.get('stream_audio', False) is True and shard_output is False
+
+        video_url = cls.YT_BASE_URL + video_id
+
+        # Get channel ID
+        video_metadata = cls._extract_info(video_id, context, max_age_s=cls.AUDIO_SOURCE_MAX_AGE_S if stream_audio else None)
+        channel_id = video_metadata['uploader_url'].split('@')[-1].strip()
+
+        # Check current channel performance
+        with StageProfiler.stage('channel_constraints'):
+            cnsts_passed = ChannelPerformanceUtilities.check_channel_constraints(dynamo_hlp_instance, stats_hlp_instance, channel_id, video_id, input_cfg)
+        if cnsts_passed == False:
+            return None
+
+        # Check metadata constraints
+        cnsts_passed, cnsts_failure_msg, video_transcript, calc_metadata = VideoMetadataUtilities.check_video_constraints(
+            video_id, input_cfg, video_metadata, context.response_cache, request_router, context.fetch_transcript_fn
         )
-    
-        # Upload transcript file
-        s3_hlp_instance.upload_object(
-            body=video_srt_content.encode('utf-8'),
-            bucket="ytdldata",
-            key=f"{channel_id}/srt_files/{video_id}.srt"
-        )
\ No newline at end of file
+        with StageProfiler.stage('dynamo_write'):
+            report = VideoMetadataUtilities.upload_dl_metadata_report(dynamo_hlp_instance, stats_hlp_instance, channel_id, video_id, video_metadata, cnsts_failure_msg, calc_metadata)
+        if cnsts_passed == False:
+            return None
+
+        prepared = {
+            'video_id': video_id,
+            'video_url': video_url,
+            'channel_id': channel_id,
+            'duration_s': video_metadata.get('duration'),
+            'video_transcript': video_transcript,
+            'transcript_format': input_cfg.get('transcript_format', 'srt')
+        }
+        # Keep the selected audio input to stream it without writing to disk
+        if stream_audio is True:
+            prepared['audio_source'] = AudioStreamer.get_audio_source(video_metadata)
+        # Pack the outputs into shards, with the metadata of the download report
+        if shard_output is True:
+            prepared['shard_size_MB'] = input_cfg.get('shard_size_MB', ShardWriter.SHARD_SIZE_MB)
+            prepared['metadata'] = {key: value for key, value in report.items() if key not in cls.SHARD_DROP_REPORT_KEYS}
+        return prepared
+
+    @staticmethod
+    def _add_stored_video_ids(response: dict, prepared: dict, context: WorkerContext) -> dict:
+        # A sharded video is pending until its shard is uploaded, responses carry the videos of the uploaded shards
+        if 'shard_size_MB' in prepared:
+            response['pending_upload'] = True
+        stored_video_ids = context.drain_stored_video_ids()
+        if len(stored_video_ids) > 0:
+            response['stored_video_ids'] = stored_video_ids
+        return response
+
+    @classmethod
+    def download(cls, prepared: dict, context: WorkerContext) -> dict:
+        # Download a video that passed the constraint checks and upload its audio and transcript
+        with StageProfiler.video(prepared['video_id'], phase='download'):
+            response = cls._download(prepared, context)
+            StageProfiler.add_bytes(uploaded_bytes=response['uploaded_bytes'])
+        return cls._add_stored_video_ids(response, prepared, context)
+
+    @staticmethod
+    def get_audio_file_path(video_id: str, context: WorkerContext) -> str:
+        return f"./data/audio_files/{video_id}.flac" if context.run_locally else f"/tmp/audio_files/{video_id}.flac"
+
+    @staticmethod
+    def _upload_audio_file(file_path: str, channel_id: str, video_id: str, s3_hlp_instance) -> int:
+        # Upload the audio file and delete it
+        file_size = os.path.getsize(file_path)
+        with StageProfiler.stage('s3_upload'):
+            s3_hlp_instance.upload_file(
+                filename=file_path,
+                bucket="ytdldata",
+                key=f"{channel_id}/audio_files/{video_id}.flac"
+            )
+        return file_size
+
+    @staticmethod
+    def _upload_transcript(prepared: dict, s3_hlp_instance) -> int:
+        # Upload transcript file, encoded straight into one bytes buffer
+        transcript_format = prepared['transcript_format']
+        transcript_body = BytesIO()
+        transcript_size = TranscriptHelper.write_transcript(prepared['video_transcript'], transcript_body, transcript_format)
+        transcript_body.seek(0)
+        with StageProfiler.stage('s3_upload'):
+            s3_hlp_instance.upload_object(
+                body=transcript_body,
+                bucket="ytdldata",
+                key=f"{prepared['channel_id']}/{transcript_format}_files/{prepared['video_id']}.{transcript_format}"
+            )
+        return transcript_size
+
+    @staticmethod
+    def _write_shard_sample(prepared: dict, file_path: str, context: WorkerContext) -> int:
+        # Add the audio file, the transcript and the metadata to the worker's current shard, and delete the audio file
+        transcript_format = prepared['transcript_format']
+        transcript_body = BytesIO()
+        TranscriptHelper.write_transcript(prepared['video_transcript'], transcript_body, transcript_format)
+        shard_writer = context.get_shard_writer(prepared['shard_size_MB'])
+        with StageProfiler.stage('s3_upload'):
+            return shard_writer.add_sample(
+                prepared['video_id'],
+                files={
+                    'flac': file_path,
+                    transcript_format: transcript_body.getvalue(),
+                    'json': ShardWriter.encode_json(prepared['metadata'])
+                },
+                fields={'channel_id': prepared['channel_id'], 'duration_s': prepared['duration_s']}
+            )
+
+    @classmethod
+    def _store_outputs(cls, prepared: dict, file_path: str, context: WorkerContext) -> int:
+        # Upload the audio file and the transcript as objects, or pack them into a shard
+        if 'shard_size_MB' in prepared:
+            return cls._write_shard_sample(prepared, file_path, context)
+        return (cls._upload_audio_file(file_path, prepared['channel_id'], prepared['video_id'], context.s3_hlp_instance)
+                + cls._upload_transcript(prepared, context.s3_hlp_instance))
+
+    @classmethod
+    def _download(cls, prepared: dict, context: WorkerContext) -> dict:
+        s3_hlp_instance = context.s3_hlp_instance
+        request_router = context.get_request_router()
+        video_id, channel_id = prepared['video_id'], prepared['channel_id']
+        response = {'video_id': video_id, 'status': False, 'uploaded_bytes': 0}
+
+        if 'audio_source' in prepared:
+            # Stream audio through ffmpeg into a multipart upload, transcoding overlaps the upload
+            request_router.rate_limiter.acquire(RequestRouter.MEDIA_HOST)
+            with StageProfiler.stage('stream_upload'):
+                response['uploaded_bytes'] += AudioStreamer.stream_to_s3(
+                    audio_source=prepared['audio_source'],
+                    yt_dl_cfg=context.yt_dl_cfg,
+                    s3_hlp_instance=s3_hlp_instance,
+                    bucket="ytdldata",
+                    key=f"{channel_id}/audio_files/{video_id}.flac"
+                )
+            response['uploaded_bytes'] += cls._upload_transcript(prepared, s3_hlp_instance)
+        else:
+            # Download video, the ffmpeg postprocessing time is recorded by the yt_dl hooks
+            with StageProfiler.stage('download', exclude=('postprocess',)):
+                request_router.call(RequestRouter.MEDIA_HOST, lambda proxy: context.get_ydl(proxy).download([prepared['video_url'],]))
+
+            # Upload video file and transcript
+            response['uploaded_bytes'] += cls._store_outputs(prepared, cls.get_audio_file_path(video_id, context), context)
+
+        response['status'] = True
+        return response
+
+    @classmethod
+    def fetch_raw_audio(cls, prepared: dict, context: WorkerContext) -> dict:
+        # Network stage of a split download, the best audio as served is transcoded separately with AudioTranscoder
+        with StageProfiler.video(prepared['video_id'], phase='download'):
+            with StageProfiler.stage('download'):
+                info = context.get_request_router().call(
+                    RequestRouter.MEDIA_HOST,
+                    lambda proxy: context.get_ydl(proxy, raw=True).extract_info(prepared['video_url'], download=True)
+                )
+        return {
+            **prepared,
+            'raw_path': info['requested_downloads'][0]['filepath'],
+            'audio_path': cls.get_audio_file_path(prepared['video_id'], context)
+        }
+
+    @classmethod
+    def upload(cls, fetched: dict, context: WorkerContext, transcode_s: float = 0) -> dict:
+        # Upload stage of a split download, once the raw audio was transcoded
+        video_id = fetched['video_id']
+        with StageProfiler.video(video_id, phase='upload'):
+            StageProfiler.add_stage_time('postprocess', transcode_s)
+            response = {'video_id': video_id, 'status': False, 'uploaded_bytes': 0}
+            response['uploaded_bytes'] += cls._store_outputs(fetched, fetched['audio_path'], context)
+            response['status'] = True
+            StageProfiler.add_bytes(uploaded_bytes=response['uploaded_bytes'])
+        return cls._add_stored_video_ids(response, fetched, context)
+
+    @classmethod
+    def run(cls, video_id: str, input_cfg: dict, run_locally: bool = False, context: WorkerContext = None) -> dict:
+
+        # Reuse the worker's AWS helper instances, yt_dl configuration and extractor
+        context = context or WorkerContext.get(run_locally=run_locally)
+
+        prepared = cls.prepare(video_id, input_cfg, context)
+        if prepared is None:
+            return {'video_id': video_id, 'status': False, 'uploaded_bytes': 0}
+        return cls.download(prepared, context)
@@ -1,13 +1,22 @@
 
-import random
-from io import StringIO
+import json
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Iterable, Iterator
 
 import pandas as pd
-from boto3.dynamodb.conditions import Key
-from tqdm.auto import tqdm
+from boto3.dynamodb.conditions import Attr, Key
 
 from .aws_helpers import DynamoDBHelper, S3Helper
-from .channel_utilities import ChannelMetadataHelper
+from .channel_utilities import (ChannelMetadataHelper,
+                                ChannelPerformanceUtilities)
+from .utils import get_video_length
+from .video_utilities import VideoMetadataUtilities
 
 
 class ReportGenerator:
@@ -16,57 +25,132 @@ class ReportGenerator:
 
     This class provides methods to retrieve data from the reports table, process it, and generate reports.
 
+    Scan pages are consumed as a stream and rows are grouped per channel in a single pass, keeping only the report
+    columns. Per-channel CSV or Parquet reports are uploaded in parallel, reports that did not change since the previous
+    upload are skipped. In incremental mode only rows updated since the watermark of the previous report, set back by
+    `WATERMARK_SAFETY_S` for reports written while the previous one was generated, are read and merged into the existing
+    per-channel reports, which are loaded in parallel. Rows read again replace their previous version.
     """
 
     SUCC_DOW_REPORT_COLUMNS = ['video_id', 'video_title', 'video_duration', 'video_view_count', 'video_like_count']
     FAILED_DOW_REPORT_COLUMNS = ['video_id', 'reason']
+    REPORTS_BUCKET = 'ytdlreports'
+    WATERMARK_KEY = 'report_watermark.json'
+    REPORT_FORMATS = ('csv', 'parquet')
+    UPDATE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    # Update times have a one second resolution and buffered reports are written late
+    WATERMARK_SAFETY_S = 5 * 60
 
-    def __init__(self, dynamo_hlp_instance: DynamoDBHelper, s3_hlp_instance: S3Helper) -> None:
+    def __init__(self, dynamo_hlp_instance: DynamoDBHelper, s3_hlp_instance: S3Helper, report_format: str = 'csv', incremental: bool = False) -> None:
 
         # Initialize dynamo helper instance 
         self.dynamo_hlp_instance = dynamo_hlp_instance
         # Initialize s3 helper instance
         self.s3_hlp_instance = s3_hlp_instance
-        
-    
-    @classmethod
-    def _unpack_responses(cls, reports):
-        succ_videos = dict()
-        failed_videos = dict()
-        reports_csv = pd.DataFrame(reports)
-        for channel_id in reports_csv['channel_id'].unique():
-            
-            channel_csv = reports_csv.loc[reports_csv['channel_id']==channel_id]
-            succ_videos[channel_id] = channel_csv.loc[channel_csv['download_status']==True][cls.SUCC_DOW_REPORT_COLUMNS]
-            failed_videos[channel_id] = channel_csv.loc[channel_csv['download_status']==True][cls.FAILED_DOW_REPORT_COLUMNS]
-        return succ_videos, failed_videos
+        if report_format not in self.REPORT_FORMATS:
+            raise NotImplementedError(f'Report format {report_format} is not implemented!')
+        if report_format == 'parquet':
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError('Parquet reports require pyarrow, install it with `pip install pyarrow`') from None
+        self.report_format = report_format
+        self.incremental = incremental
     
-    def _import_response(self, response: pd.DataFrame, key: str) -> None:
-        csv_buffer=StringIO()
-        response.to_csv(csv_buffer)
-        content = csv_buffer.getvalue()
-        # Upload the response object
+    def _load_watermark(self) -> str:
+        # Set back by the safety margin, rows updated in the margin are read again
+        try:
+            watermark = self.s3_hlp_instance.load_object(bucket=self.REPORTS_BUCKET, key=self.WATERMARK_KEY)['update_time']
+        except self.s3_hlp_instance.s3_client.exceptions.NoSuchKey:
+            return None
+        return (datetime.strptime(watermark, self.UPDATE_TIME_FORMAT) - timedelta(seconds=self.WATERMARK_SAFETY_S)).strftime(self.UPDATE_TIME_FORMAT)
+
+    def _save_watermark(self, watermark: str) -> None:
         self.s3_hlp_instance.upload_object(
-            body=content,
-            bucket='ytdlreports',
-            key=key
+            body=json.dumps({'update_time': watermark}),
+            bucket=self.REPORTS_BUCKET,
+            key=self.WATERMARK_KEY
         )
-        
-    def _import_dl_responses(self, succ_dl_chs_responses, failed_dl_chs_responses):
-        # Import successfully downloaded videos responses
-        for channel_id, response in succ_dl_chs_responses.items():
-            self._import_response(response, f'{channel_id}/successsfully_downloaded.csv')
-        # Import unsuccessfully downloaded videos responses
-        for channel_id, response in failed_dl_chs_responses.items():
-            self._import_response(response, f'{channel_id}/unsuccesssfully_downloaded.csv')
+
+    def _iter_responses(self, watermark: str = None) -> Iterator[dict]:
+        # Read only the report columns, and only rows updated since the watermark if given
+        columns = sorted(set(['channel_id', 'download_status', 'update_time'] + self.SUCC_DOW_REPORT_COLUMNS + self.FAILED_DOW_REPORT_COLUMNS))
+        scan_expressions = {
+            "ProjectionExpression": ', '.join(f'#c{i}' for i in range(len(columns))),
+            "ExpressionAttributeNames": {f'#c{i}': column for i, column in enumerate(columns)}
+        }
+        if watermark is not None:
+            scan_expressions["FilterExpression"] = Attr('update_time').gte(watermark)
+        for page in self.dynamo_hlp_instance.scan_pages(scan_expressions):
+            yield from page
+
+    @classmethod
+    def _unpack_responses(cls, reports: Iterable[dict]) -> tuple:
+        # Group rows by channel and status in a single pass
+        succ_videos = defaultdict(list)
+        failed_videos = defaultdict(list)
+        watermark = None
+        for report in reports:
+            if report.get('download_status') == True:
+                succ_videos[report['channel_id']].append([report.get(column) for column in cls.SUCC_DOW_REPORT_COLUMNS])
+            else:
+                failed_videos[report['channel_id']].append([report.get(column) for column in cls.FAILED_DOW_REPORT_COLUMNS])
+            if report.get('update_time') is not None:
+                watermark = max(watermark or report['update_time'], report['update_time'])
+        succ_videos = {channel_id: pd.DataFrame(rows, columns=cls.SUCC_DOW_REPORT_COLUMNS) for channel_id, rows in succ_videos.items()}
+        failed_videos = {channel_id: pd.DataFrame(rows, columns=cls.FAILED_DOW_REPORT_COLUMNS) for channel_id, rows in failed_videos.items()}
+        return succ_videos, failed_videos, watermark
+
+    def _serialize_response(self, response: pd.DataFrame) -> bytes:
+        if self.report_format == 'parquet':
+            return response.to_parquet(index=False)
+        return response.to_csv(index=False).encode('utf-8')
+
+    def _deserialize_response(self, content: bytes) -> pd.DataFrame:
+        if self.report_format == 'parquet':
+            return pd.read_parquet(BytesIO(content))
+        return pd.read_csv(BytesIO(content), dtype={'video_id': str})
+
+    def _merge_with_existing(self, response: pd.DataFrame, existing_content: bytes, superseded_ids: set) -> pd.DataFrame:
+        # Merge the new rows into the previous report, newer rows win and videos whose status changed are dropped
+        response = response.drop_duplicates(subset='video_id', keep='last')
+        if existing_content is None:
+            return response
+        existing = self._deserialize_response(existing_content)
+        existing = existing.loc[~existing['video_id'].isin(superseded_ids)]
+        return pd.concat([existing, response], ignore_index=True).drop_duplicates(subset='video_id', keep='last')
+
+    def _import_dl_responses(self, succ_dl_chs_responses: dict, failed_dl_chs_responses: dict) -> dict:
+        uploads = dict()
+        for channel_id in set(succ_dl_chs_responses) | set(failed_dl_chs_responses):
+            succ_response = succ_dl_chs_responses.get(channel_id, pd.DataFrame(columns=self.SUCC_DOW_REPORT_COLUMNS))
+            failed_response = failed_dl_chs_responses.get(channel_id, pd.DataFrame(columns=self.FAILED_DOW_REPORT_COLUMNS))
+            # Successfully downloaded videos responses
+            if len(succ_response) > 0 or (self.incremental is True and len(failed_response) > 0):
+                uploads[f'{channel_id}/successsfully_downloaded.{self.report_format}'] = (succ_response, set(failed_response['video_id']))
+            # Unsuccessfully downloaded videos responses
+            if len(failed_response) > 0 or (self.incremental is True and len(succ_response) > 0):
+                uploads[f'{channel_id}/unsuccesssfully_downloaded.{self.report_format}'] = (failed_response, set(succ_response['video_id']))
+        # Load the previous reports in parallel to merge into
+        existing = self.s3_hlp_instance.load_many(uploads, bucket=self.REPORTS_BUCKET, missing_ok=True) if self.incremental is True else dict()
+        objects = {
+            key: self._serialize_response(self._merge_with_existing(response, existing.get(key), superseded_ids))
+            for key, (response, superseded_ids) in uploads.items()
+        }
+        # Import in parallel, reports that did not change since the previous run are skipped
+        return self.s3_hlp_instance.upload_many(objects, bucket=self.REPORTS_BUCKET, skip_unchanged=True)
 
     def generate_reports(self):
-        # Query all table items
-        responses = self.dynamo_hlp_instance.query_all_table_items()
+        # Stream the table items, only the ones updated after the previous report in incremental mode
+        watermark = self._load_watermark() if self.incremental is True else None
+        responses = self._iter_responses(watermark)
         # Unpack the responses by channel
-        succ_dl_chs_responses, failed_dl_chs_responses = self._unpack_responses(responses)
+        succ_dl_chs_responses, failed_dl_chs_responses, new_watermark = self._unpack_responses(responses)
         # Import  to S3 bucket
         self._import_dl_responses(succ_dl_chs_responses, failed_dl_chs_responses)
+        # Advance the watermark once all reports are uploaded
+        if new_watermark is not None:
+            self._save_watermark(new_watermark)
 
 
 class TaskGenerator():
@@ -75,32 +159,188 @@ class TaskGenerator():
     checking previous task executions, and skipping tasks that have already been executed.
 
     This class facilitates the creation and management of tasks related to video extraction processes.
+
+    Channels are enumerated concurrently in a thread pool, page by page, into bounded per-channel queues, and
+    video IDs are interleaved round-robin across channels as they arrive, so downloads can start while enumeration
+    continues. Given the input configuration and the channel stats table, channels that exhausted their budget
+    are skipped and enumeration of a channel stops once enough candidates were emitted to fill its remaining budget.
+    Videos whose listed duration is out of the configured range are rejected before a task is created, their reports
+    are written in batches, and channels whose past videos speak too slowly can be skipped with `skip_low_wpm_channels`.
+    A channel whose enumeration fails raises its error to the consumer, so the task queue is not sealed without it.
+    `iter_channel_videos_fn` replaces the channel listing, e.g. by a local fake.
     """
+
+    MAX_ENUMERATION_WORKERS = 8
+    MAX_BUFFERED_PER_CHANNEL = 256
+    POLL_INTERVAL_S = 0.05
+    # Heuristic, only a fraction of the candidates pass the video constraints, so a channel emits this many times the
+    # candidates needed to cover its remaining budget. Tuned per run with `candidate_overfetch_factor` in the input
+    # configuration: lower values list fewer pages, higher ones leave fewer budgets unfilled when most videos are rejected
+    CANDIDATE_OVERFETCH_FACTOR = 10
         
     @staticmethod
-    def extract_channel_video_urls(channels: list, dynamo_hlp_instance: DynamoDBHelper, shuffle: bool = False) -> list:
+    def _get_channel_history(channel_id: str, dynamo_hlp_instance: DynamoDBHelper) -> list:
+        # Load all past responses of the channel with one paginated partition query
+        return dynamo_hlp_instance.query_all_items({
+            "KeyConditionExpression": Key('channel_id').eq(channel_id),
+            "ProjectionExpression": 'video_id, video_wpm'
+        })
 
-        res_tasks_id = list()
-        for channel_id, channel_url in tqdm(channels, desc='channels'):
-            channel_id = channel_id.replace('@', '') if '@' in channel_id else channel_id
-            videos_metadata = ChannelMetadataHelper._get_channel_videos(channel_url)
+    @classmethod
+    def _get_attempted_video_ids(cls, channel_id: str, dynamo_hlp_instance: DynamoDBHelper) -> set:
+        return {item['video_id'] for item in cls._get_channel_history(channel_id, dynamo_hlp_instance)}
 
-            for video_metadata in tqdm(videos_metadata, desc='videos', leave=False):
-                video_id = video_metadata.get('videoId')
+    @staticmethod
+    def _is_low_wpm_channel(channel_history: list, input_cfg: dict) -> bool:
+        # The median WPM of the videos with a transcript is below the minimum, once enough videos were measured
+        wpms = sorted(float(item['video_wpm']) for item in channel_history if float(item.get('video_wpm') or 0) > 0)
+        if len(wpms) < ChannelPerformanceUtilities.CHECK_AFTER_N_VIDEOS:
+            return False
+        return wpms[len(wpms) // 2] < input_cfg['min_wpm']
+
+    @staticmethod
+    def _get_duration_failure_message(duration_s: int, input_cfg: dict) -> str:
+        # The duration is missing from the listing for live streams, it is checked after extraction
+        if input_cfg is None or duration_s == 0:
+            return None
+        return VideoMetadataUtilities.get_duration_failure_message(duration_s, input_cfg)
 
-                # Check past responses
-                res = dynamo_hlp_instance.query_items({
-                    "KeyConditionExpression": Key('channel_id').eq(channel_id) & Key('video_id').eq(video_id),
-                    "ProjectionExpression": 'download_status'
-                })
+    @staticmethod
+    def _record_rejection(dynamo_hlp_instance: DynamoDBHelper, channel_id: str, video_id: str, duration_s: int, reason: str) -> None:
+        # Import the response in the background, rejections are not download attempts of the channel and are not
+        # counted by the backfill of the channel stats
+        dynamo_hlp_instance.import_item_buffered(
+            item = {
+                "channel_id": channel_id,
+                "video_id": video_id,
+                "video_duration": duration_s,
+                "update_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                "channel_status": ChannelPerformanceUtilities.REJECTED_STATUS,
+                "download_status": False,
+                "reason": reason
+            }
+        )
+
+    @staticmethod
+    def _get_listed_duration(video_metadata: dict) -> int:
+        # Duration shown in the channel listing, missing for live streams
+        length_text = (video_metadata.get('lengthText') or dict()).get('simpleText')
+        return get_video_length(length_text) if length_text else 0
+
+    @staticmethod
+    def _get_channel_budget(channel_id: str, input_cfg: dict, dynamo_hlp_instance: DynamoDBHelper, stats_hlp_instance: DynamoDBHelper) -> tuple:
+        # Number of videos and seconds the channel can still download, None if not bounded
+        if input_cfg is None or stats_hlp_instance is None:
+            return None, None
+        channel_stats = ChannelPerformanceUtilities.get_channel_stats(dynamo_hlp_instance, stats_hlp_instance, channel_id)
+        if channel_stats.get('channel_status') == 'Inactive' or ChannelPerformanceUtilities.check_channel_stats(channel_stats, input_cfg) is not None:
+            return 0, 0
+        # Limits are checked before each download, so the last accepted video may exceed them
+        remaining_videos = input_cfg['max_downloaded_videos_per_channel'] + 1 - int(channel_stats.get('success_count', 0))
+        remaining_s = (input_cfg['max_download_H_per_channel'] * 60 * 60 - float(channel_stats.get('downloaded_seconds', 0))
+                       + input_cfg['max_audio_duration_M'] * 60)
+        return remaining_videos, remaining_s
+
+    @staticmethod
+    def _put(channel_queue: queue.Queue, item, stop_event: threading.Event) -> bool:
+        # Block while the channel queue is full, unless the consumer stopped
+        while not stop_event.is_set():
+            try:
+                channel_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    @classmethod
+    def _enumerate_channel(cls, channel_id: str, channel_url: str, input_cfg: dict, dynamo_hlp_instance: DynamoDBHelper,
+                           stats_hlp_instance: DynamoDBHelper, channel_queue: queue.Queue, stop_event: threading.Event,
+                           iter_channel_videos_fn: Callable = None) -> None:
+        iter_channel_videos_fn = iter_channel_videos_fn or ChannelMetadataHelper._iter_channel_videos
+        try:
+            remaining_videos, remaining_s = cls._get_channel_budget(channel_id, input_cfg, dynamo_hlp_instance, stats_hlp_instance)
+            if remaining_videos == 0:
+                return
+
+            # Check past responses
+            channel_history = cls._get_channel_history(channel_id, dynamo_hlp_instance)
+            if input_cfg is not None and input_cfg.get('skip_low_wpm_channels', False) is True and cls._is_low_wpm_channel(channel_history, input_cfg):
+                print(f'>>> Channel {channel_id} skipped, low WPM')
+                return
+            attempted_video_ids = {item['video_id'] for item in channel_history}
+            overfetch_factor = (input_cfg or dict()).get('candidate_overfetch_factor') or cls.CANDIDATE_OVERFETCH_FACTOR
+
+            n_candidates, candidates_s = 0, 0
+            for video_metadata in iter_channel_videos_fn(channel_url):
+                video_id = video_metadata.get('videoId')
 
                 # Skip if already tried
-                if res['Count'] > 0:
+                if video_id in attempted_video_ids:
                     continue
 
-                res_tasks_id.append(video_id)
-        
-        if shuffle is True:
-            random.shuffle(res_tasks_id)
-            
-        return res_tasks_id
+                # Reject videos out of the duration range without extracting them
+                duration_s = cls._get_listed_duration(video_metadata)
+                dur_failure_msg = cls._get_duration_failure_message(duration_s, input_cfg)
+                if dur_failure_msg is not None:
+                    cls._record_rejection(dynamo_hlp_instance, channel_id, video_id, duration_s, dur_failure_msg)
+                    continue
+
+                task = {'video_id': video_id, 'channel_id': channel_id, 'duration_s': duration_s, 'channel_remaining_s': remaining_s}
+                if cls._put(channel_queue, task, stop_event) is False:
+                    return
+                n_candidates += 1
+                candidates_s += duration_s
+
+                # Stop once the remaining budget is covered by the emitted candidates
+                if remaining_videos is not None and (n_candidates >= remaining_videos * overfetch_factor
+                                                     or candidates_s >= remaining_s * overfetch_factor):
+                    return
+        except Exception as exc:
+            # The error is raised by the consumer, so task generation fails instead of missing the channel
+            print(f'>>> Enumeration of channel {channel_id} failed: {exc}')
+            cls._put(channel_queue, exc, stop_event)
+        finally:
+            # Mark the end of the channel
+            cls._put(channel_queue, None, stop_event)
+
+    @classmethod
+    def extract_channel_video_urls(cls, channels: list, dynamo_hlp_instance: DynamoDBHelper, input_cfg: dict = None,
+                                   stats_hlp_instance: DynamoDBHelper = None, max_workers: int = None, iter_channel_videos_fn: Callable = None) -> Iterator[str]:
+        for task in cls.extract_channel_tasks(channels, dynamo_hlp_instance, input_cfg, stats_hlp_instance, max_workers, iter_channel_videos_fn):
+            yield task['video_id']
+
+    @classmethod
+    def extract_channel_tasks(cls, channels: list, dynamo_hlp_instance: DynamoDBHelper, input_cfg: dict = None,
+                              stats_hlp_instance: DynamoDBHelper = None, max_workers: int = None, iter_channel_videos_fn: Callable = None) -> Iterator[dict]:
+        # Tasks carry the channel, the listed duration and the remaining seconds budget of the channel for the scheduler
+        stop_event = threading.Event()
+        channel_queues = [queue.Queue(maxsize=cls.MAX_BUFFERED_PER_CHANNEL) for _ in channels]
+        executor = ThreadPoolExecutor(max_workers=max_workers or cls.MAX_ENUMERATION_WORKERS, thread_name_prefix='channels')
+        try:
+            for (channel_id, channel_url), channel_queue in zip(channels, channel_queues):
+                channel_id = channel_id.replace('@', '') if '@' in channel_id else channel_id
+                executor.submit(cls._enumerate_channel, channel_id, channel_url, input_cfg, dynamo_hlp_instance,
+                                stats_hlp_instance, channel_queue, stop_event, iter_channel_videos_fn)
+
+            # Interleave the channels, taking at most one video of each per round
+            active_queues = list(channel_queues)
+            while len(active_queues) > 0:
+                n_taken = 0
+                for channel_queue in list(active_queues):
+                    try:
+                        task = channel_queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    n_taken += 1
+                    if isinstance(task, Exception):
+                        raise task
+                    if task is None:
+                        active_queues.remove(channel_queue)
+                    else:
+                        yield task
+                # All channels are still fetching pages
+                if n_taken == 0:
+                    time.sleep(cls.POLL_INTERVAL_S)
+        finally:
+            stop_event.set()
+            executor.shutdown(wait=False, cancel_futures=True)
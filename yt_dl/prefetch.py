@@ -0,0 +1,122 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterable, Iterator
+
+from .downloader import Downloader
+from .task_queue import TaskQueue
+from .worker_context import WorkerContext
+
+
+class MetadataPrefetcher:
+    """
+    Asyncio prefetch stage that fetches video metadata and transcripts for many videos at once
+    and evaluates the channel and video constraints ahead of the download stage.
+
+    The number of videos being prefetched at the same time is bounded by a semaphore. yt_dlp,
+    youtube_transcript_api and boto3 are blocking libraries, so every step runs in a thread pool
+    sized to the semaphore while the event loop schedules them. Only videos passing all constraints
+    are emitted, so rejected videos never occupy a download worker.
+
+    `prepare_fn` defaults to `Downloader.prepare` and can be replaced, e.g. with a function that talks
+    to a local HTTP stand-in serving recorded fixtures. If a task queue is given, rejected videos are
+    completed and failed ones are failed in it, since they never reach the download stage.
+    """
+
+    def __init__(self, input_cfg: dict, run_locally: bool = False, max_concurrency: int = 16,
+                 context: WorkerContext = None, prepare_fn: Callable = None, task_queue: TaskQueue = None) -> None:
+        self.input_cfg = input_cfg
+        self.max_concurrency = max_concurrency
+        self.context = context or WorkerContext.get(run_locally=run_locally)
+        self.prepare_fn = prepare_fn or Downloader.prepare
+        self.task_queue = task_queue
+
+    def _prepare(self, video_id: str) -> dict:
+        try:
+            prepared = self.prepare_fn(video_id, self.input_cfg, self.context)
+        except Exception as exc:
+            if self.task_queue is not None:
+                self.task_queue.fail(video_id, str(exc))
+            raise
+        if prepared is None and self.task_queue is not None:
+            self.task_queue.complete(video_id)
+        return prepared
+
+    async def _prefetch_video(self, video_id: str, semaphore: asyncio.Semaphore, executor: ThreadPoolExecutor) -> dict:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(executor, self._prepare, video_id)
+        except Exception as exc:
+            print(f'>>> Prefetch of video {video_id} failed: {exc}')
+            return None
+        finally:
+            semaphore.release()
+
+    async def stream(self, video_ids: Iterable[str]) -> AsyncIterator[dict]:
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        # Video IDs may come from a lazy generator that blocks, they are pulled in a separate thread
+        video_ids = iter(video_ids)
+        end_of_ids = object()
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='prefetch') as executor, \
+             ThreadPoolExecutor(max_workers=1, thread_name_prefix='prefetch-ids') as ids_executor:
+            pending = set()
+            next_id, ids_exhausted = None, False
+            while True:
+                if next_id is None and ids_exhausted is False:
+                    # Wait for a free slot before pulling the next video
+                    await semaphore.acquire()
+                    next_id = loop.run_in_executor(ids_executor, next, video_ids, end_of_ids)
+                waiting = pending | ({next_id} if next_id is not None else set())
+                if len(waiting) == 0:
+                    break
+                done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+                # Start prefetching the pulled video
+                if next_id in done:
+                    video_id, next_id = next_id.result(), None
+                    if video_id is end_of_ids:
+                        ids_exhausted = True
+                        semaphore.release()
+                    else:
+                        pending.add(asyncio.ensure_future(self._prefetch_video(video_id, semaphore, executor)))
+
+                # Emit the finished videos
+                for task in done & pending:
+                    pending.remove(task)
+                    if task.result() is not None:
+                        yield task.result()
+
+    async def _collect(self, video_ids: Iterable[str]) -> list:
+        return [prepared async for prepared in self.stream(video_ids)]
+
+    def prefetch(self, video_ids: Iterable[str]) -> list:
+        # Prefetch all videos and return the ones passing the constraints
+        return asyncio.run(self._collect(video_ids))
+
+    def iter_prefetched(self, video_ids: Iterable[str], max_buffered: int = None) -> Iterator[dict]:
+        # Run the stage in a background event loop and hand over the passing videos as they finish,
+        # so that the download stage can start before prefetching is done
+        max_buffered = max_buffered or self.max_concurrency
+        buffer = queue.Queue(maxsize=max_buffered)
+        end_of_stream = object()
+        produce_errors = list()
+
+        async def produce():
+            try:
+                async for prepared in self.stream(video_ids):
+                    await asyncio.get_running_loop().run_in_executor(None, buffer.put, prepared)
+            except Exception as exc:
+                produce_errors.append(exc)
+            finally:
+                buffer.put(end_of_stream)
+
+        thread = threading.Thread(target=asyncio.run, args=(produce(),), name='prefetch-loop', daemon=True)
+        thread.start()
+        while (prepared := buffer.get()) is not end_of_stream:
+            yield prepared
+        thread.join()
+        # The stream stopped early, e.g. the task queue failed, the error is raised to the consumer
+        if len(produce_errors) > 0:
+            raise produce_errors[0]
@@ -0,0 +1,297 @@
+import contextvars
+import io
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Iterator
+
+from .aws_helpers import AWSClientPool, S3Helper
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class StageProfiler:
+    """
+    Process-wide recorder of per-video stage durations, bytes moved and retries.
+
+    A record is opened for the video being processed with `video()` and kept in a context variable, so that
+    stages timed deep in the helpers with `stage()` are attributed to it without passing it around, also when
+    several videos are processed in parallel threads. Outside of a video, timing is a no-op. Finished records
+    are kept until the process hands them over with `drain()`.
+    """
+
+    STAGES = (
+        'extract_info', 'channel_constraints', 'transcript_fetch', 'wpm', 'dynamo_write',
+        'download', 'postprocess', 'stream_upload', 's3_upload'
+    )
+
+    _current = contextvars.ContextVar('video_profile', default=None)
+    _records = list()
+    _lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def video(cls, video_id: str, phase: str) -> Iterator[dict]:
+        record = {
+            'video_id': video_id,
+            'phase': phase,
+            'stages': defaultdict(float),
+            'downloaded_bytes': 0,
+            'uploaded_bytes': 0,
+            'retries': 0
+        }
+        token = cls._current.set(record)
+        st = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['total_s'] = time.perf_counter() - st
+            record['stages'] = dict(record['stages'])
+            cls._current.reset(token)
+            with cls._lock:
+                cls._records.append(record)
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name: str, exclude: tuple = ()) -> Iterator[None]:
+        # Time spent in the excluded stages while this one runs is not counted twice
+        record = cls._current.get()
+        if record is None:
+            yield
+            return
+        excluded_st = sum(record['stages'].get(excluded, 0) for excluded in exclude)
+        st = time.perf_counter()
+        try:
+            yield
+        finally:
+            excluded_s = sum(record['stages'].get(excluded, 0) for excluded in exclude) - excluded_st
+            record['stages'][name] += time.perf_counter() - st - excluded_s
+
+    @classmethod
+    def add_stage_time(cls, name: str, seconds: float) -> None:
+        record = cls._current.get()
+        if record is not None:
+            record['stages'][name] += seconds
+
+    @classmethod
+    def add_bytes(cls, downloaded_bytes: int = 0, uploaded_bytes: int = 0) -> None:
+        record = cls._current.get()
+        if record is not None:
+            record['downloaded_bytes'] += downloaded_bytes
+            record['uploaded_bytes'] += uploaded_bytes
+
+    @classmethod
+    def add_retries(cls, retries: int = 1) -> None:
+        record = cls._current.get()
+        if record is not None:
+            record['retries'] += retries
+
+    @classmethod
+    def count_aws_retries(cls, parsed: dict = None, **kwargs) -> None:
+        # botocore `after-call` handler, requests retried by botocore report their retry attempts
+        if parsed:
+            cls.add_retries(parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0))
+
+    @classmethod
+    def drain(cls) -> list:
+        # Hand over the finished records, e.g. to send them from a worker to the driver
+        with cls._lock:
+            records, cls._records[:] = list(cls._records), []
+        return records
+
+    @staticmethod
+    def get_peak_rss_B() -> int:
+        # Peak resident set size of this process and of its finished child processes, None where not available
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # Reported in bytes on macOS and in kilobytes on Linux
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+# Count the retries of the pooled AWS clients
+AWSClientPool.register_event_handler('after-call', StageProfiler.count_aws_retries)
+
+
+class YoutubeDLHooks:
+    """
+    Progress and postprocessor hooks and logger of one yt_dl extractor, separating the download time from the ffmpeg
+    postprocessing time and counting the retries it reports. Messages are printed as yt_dl does without a logger.
+    """
+
+    def __init__(self) -> None:
+        self._postprocess_st = None
+
+    def progress_hook(self, status: dict) -> None:
+        if status['status'] == 'finished':
+            StageProfiler.add_bytes(downloaded_bytes=status.get('total_bytes') or status.get('downloaded_bytes') or 0)
+
+    def postprocessor_hook(self, status: dict) -> None:
+        if status['status'] == 'started':
+            self._postprocess_st = time.perf_counter()
+        elif status['status'] == 'finished' and self._postprocess_st is not None:
+            StageProfiler.add_stage_time('postprocess', time.perf_counter() - self._postprocess_st)
+            self._postprocess_st = None
+
+    def debug(self, msg: str) -> None:
+        # yt_dl passes both screen and verbose messages as debug
+        if not msg.startswith('[debug] '):
+            print(msg)
+
+    def info(self, msg: str) -> None:
+        print(msg)
+
+    def warning(self, msg: str) -> None:
+        if 'Retrying' in msg:
+            StageProfiler.add_retries()
+        print(f'WARNING: {msg}')
+
+    def error(self, msg: str) -> None:
+        print(msg)
+
+
+class RunProfile:
+    """
+    Driver side aggregate of the stage records of all workers of a run.
+
+    Records of the prepare and download phases of a video, which may run in different processes, are merged
+    per video. The profile is summarized into per-stage percentiles and run throughput, uploaded next to the
+    reports as JSON (summary) and CSV (per video), and can be served as Prometheus text metrics. pandas and numpy
+    are imported on use, workers only record stages.
+    """
+
+    PERCENTILES = (50, 90, 99)
+    PROFILES_BUCKET = 'ytdlreports'
+
+    def __init__(self, run_id: str) -> None:
+        self.run_id = run_id
+        self.started_at = time.time()
+        self._videos = dict()
+        self._lock = threading.Lock()
+        self._server = None
+
+    def add_records(self, records: list) -> None:
+        with self._lock:
+            for record in records:
+                video = self._videos.setdefault(record['video_id'], {
+                    'video_id': record['video_id'],
+                    'stages': defaultdict(float),
+                    'downloaded_bytes': 0,
+                    'uploaded_bytes': 0,
+                    'retries': 0,
+                    'total_s': 0,
+                    'phases': list()
+                })
+                for stage, seconds in record['stages'].items():
+                    video['stages'][stage] += seconds
+                for key in ('downloaded_bytes', 'uploaded_bytes', 'retries', 'total_s'):
+                    video[key] += record[key]
+                video['phases'].append(record['phase'])
+
+    def to_frame(self) -> 'pd.DataFrame':
+        # One row per video with one column per stage
+        import pandas as pd
+        with self._lock:
+            rows = [
+                {
+                    'video_id': video['video_id'],
+                    'phases': '+'.join(video['phases']),
+                    **{f'{stage}_s': video['stages'].get(stage) for stage in StageProfiler.STAGES},
+                    'total_s': video['total_s'],
+                    'downloaded_bytes': video['downloaded_bytes'],
+                    'uploaded_bytes': video['uploaded_bytes'],
+                    'retries': video['retries']
+                }
+                for video in self._videos.values()
+            ]
+        return pd.DataFrame(rows, columns=['video_id', 'phases', *[f'{stage}_s' for stage in StageProfiler.STAGES],
+                                           'total_s', 'downloaded_bytes', 'uploaded_bytes', 'retries'])
+
+    def summary(self) -> dict:
+        import numpy as np
+        videos = self.to_frame()
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        stages = dict()
+        for stage in StageProfiler.STAGES + ('total',):
+            # Only videos that went through the stage
+            durations = videos[f'{stage}_s'].dropna().to_numpy(dtype=float)
+            if len(durations) == 0:
+                continue
+            stages[stage] = {
+                'count': int(len(durations)),
+                'total_s': float(durations.sum()),
+                **{f'p{q}_s': float(value) for q, value in zip(self.PERCENTILES, np.percentile(durations, self.PERCENTILES))},
+                'max_s': float(durations.max())
+            }
+        return {
+            'run_id': self.run_id,
+            'elapsed_s': elapsed,
+            'videos': int(len(videos)),
+            'videos_per_s': len(videos) / elapsed,
+            'downloaded_bytes': int(videos['downloaded_bytes'].sum()),
+            'uploaded_bytes': int(videos['uploaded_bytes'].sum()),
+            'uploaded_MB_per_s': float(videos['uploaded_bytes'].sum()) / 2**20 / elapsed,
+            'retries': int(videos['retries'].sum()),
+            'stages': stages
+        }
+
+    def upload(self, s3_hlp_instance: S3Helper) -> None:
+        # Upload the summary and the per-video profile next to the reports
+        prefix = f'profiles/{self.run_id}/{time.strftime("%Y%m%d-%H%M%S", time.gmtime(self.started_at))}'
+        buffer = io.StringIO()
+        self.to_frame().to_csv(buffer, index=False)
+        s3_hlp_instance.upload_many({
+            f'{prefix}/profile.json': json.dumps(self.summary(), indent=2),
+            f'{prefix}/videos.csv': buffer.getvalue()
+        }, bucket=self.PROFILES_BUCKET)
+
+    def render_prometheus(self) -> str:
+        # Prometheus text exposition format, stage durations as summaries
+        summary = self.summary()
+        lines = [
+            '# TYPE yt_dl_videos_total counter', f'yt_dl_videos_total {summary["videos"]}',
+            '# TYPE yt_dl_downloaded_bytes_total counter', f'yt_dl_downloaded_bytes_total {summary["downloaded_bytes"]}',
+            '# TYPE yt_dl_uploaded_bytes_total counter', f'yt_dl_uploaded_bytes_total {summary["uploaded_bytes"]}',
+            '# TYPE yt_dl_retries_total counter', f'yt_dl_retries_total {summary["retries"]}',
+            '# TYPE yt_dl_stage_seconds summary'
+        ]
+        for stage, stats in summary['stages'].items():
+            for q in self.PERCENTILES:
+                lines.append(f'yt_dl_stage_seconds{{stage="{stage}",quantile="{q / 100}"}} {stats[f"p{q}_s"]:.6f}')
+            lines.append(f'yt_dl_stage_seconds_sum{{stage="{stage}"}} {stats["total_s"]:.6f}')
+            lines.append(f'yt_dl_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve_prometheus(self, port: int = 9108) -> None:
+        # Serve the metrics at /metrics from a background thread
+        run_profile = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = run_profile.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('', port), MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
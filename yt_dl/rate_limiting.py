@@ -0,0 +1,253 @@
+import random
+import re
+import threading
+import time
+from typing import Callable
+
+import requests
+from youtube_transcript_api._errors import TooManyRequests
+
+from .profiling import StageProfiler
+
+
+class ThrottledError(Exception):
+    """Raised when YouTube keeps throttling a request, the video is retried later instead of being recorded."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket with an adaptive rate.
+
+    Tokens refill at `rate` per second up to `capacity`. The rate is halved when a request is throttled and
+    recovers additively with every successful request up to `max_rate` (AIMD), so the sustained rate settles
+    just below the limit that triggers throttling. Concurrent requests are throttled together, so the rate is
+    halved at most once per `BACKOFF_COOLDOWN_S`.
+    """
+
+    BACKOFF_FACTOR = 0.5
+    BACKOFF_COOLDOWN_S = 1
+    RECOVERY_STEP = 0.02
+
+    def __init__(self, rate: float, capacity: float = None, min_rate: float = None) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.backed_off_at = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        # Take the tokens, returns how long the caller has to wait before using them
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= tokens
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self, tokens: float = 1) -> None:
+        wait_s = self.reserve(tokens)
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+    def report(self, throttled: bool) -> None:
+        with self._lock:
+            if throttled is True:
+                if time.monotonic() - self.backed_off_at >= self.BACKOFF_COOLDOWN_S:
+                    self.rate = max(self.min_rate, self.rate * self.BACKOFF_FACTOR)
+                    self.backed_off_at = time.monotonic()
+            else:
+                self.rate = min(self.max_rate, self.rate + self.RECOVERY_STEP * self.max_rate)
+
+
+class RateLimiterActor:
+    """
+    Ray actor holding the token buckets of all hosts, shared by all workers of a cluster. Made a Ray actor class on
+    first use, see `RateLimiter.get_actor_cls`, so local runs do not import Ray.
+    """
+
+    def __init__(self, rates: dict) -> None:
+        self.buckets = {host: TokenBucket(rate) for host, rate in rates.items()}
+
+    def reserve(self, host: str, tokens: float = 1) -> float:
+        return self.buckets[host].reserve(tokens)
+
+    def report(self, host: str, throttled: bool) -> None:
+        self.buckets[host].report(throttled)
+
+
+class RateLimiter:
+    """
+    Per-host rate limiter. On a Ray cluster the token buckets live in one named RateLimiterActor per run, shared by
+    all workers of the run, each request costs one round trip to it. The actor is owned by the process creating it
+    first, the driver, and is killed with `kill` at the end of the run. Otherwise the buckets are kept in the process.
+    """
+
+    ACTOR_NAME = 'yt_dl_rate_limiter'
+    ACTOR_NAMESPACE = 'yt_dl'
+
+    _actor_cls = None
+
+    def __init__(self, rates: dict, cluster: bool = False, run_id: str = None) -> None:
+        self.rates = rates
+        self.actor = None
+        if cluster is True:
+            # Runs get their own actor, with the rates of their configuration
+            self.actor = self.get_actor_cls().options(
+                name=self.get_actor_name(run_id), namespace=self.ACTOR_NAMESPACE, get_if_exists=True
+            ).remote(rates)
+        self.buckets = {host: TokenBucket(rate) for host, rate in rates.items()}
+
+    @classmethod
+    def get_actor_cls(cls):
+        if cls._actor_cls is None:
+            import ray
+            cls._actor_cls = ray.remote(num_cpus=0)(RateLimiterActor)
+        return cls._actor_cls
+
+    @classmethod
+    def get_actor_name(cls, run_id: str = None) -> str:
+        return f'{cls.ACTOR_NAME}-{run_id}' if run_id is not None else cls.ACTOR_NAME
+
+    def kill(self) -> None:
+        # Release the actor of the run, workers still holding it can not use it afterwards
+        if self.actor is not None:
+            import ray
+            ray.kill(self.actor)
+            self.actor = None
+
+    def acquire(self, host: str) -> None:
+        if host not in self.rates:
+            return
+        if self.actor is not None:
+            import ray
+            wait_s = ray.get(self.actor.reserve.remote(host))
+        else:
+            wait_s = self.buckets[host].reserve()
+        if wait_s > 0:
+            time.sleep(wait_s)
+
+    def report(self, host: str, throttled: bool) -> None:
+        if host not in self.rates:
+            return
+        if self.actor is not None:
+            # Successes only matter for the recovery of the rate, they are not waited for
+            self.actor.report.remote(host, throttled)
+        else:
+            self.buckets[host].report(throttled)
+
+
+class ProxyPool:
+    """
+    Health-scored pool of proxies. `None` stands for the direct connection.
+
+    The health score of a proxy is an exponential moving average of its outcomes. A throttled or failing
+    proxy is benched for an exponentially growing time, and requests go to the healthiest proxies that are
+    not benched, picked at random among the ones close to the best score to spread the load.
+    """
+
+    SCORE_ALPHA = 0.3
+    SCORE_TOLERANCE = 0.1
+    BASE_BENCH_S = 30
+    MAX_BENCH_S = 30 * 60
+
+    def __init__(self, proxies: list = None, include_direct: bool = True) -> None:
+        self.health = dict()
+        self._lock = threading.Lock()
+        self.add_proxies(([None] if include_direct else []) + list(proxies or []))
+
+    @staticmethod
+    def fetch_free_proxies(max_proxies: int = 20, https: bool = True) -> list:
+        # Public proxy lists, proxies are checked by their health score once used
+        from fp.fp import FreeProxy
+        proxy_addresses = FreeProxy(https=https, rand=True).get_proxy_list(repeat=False)
+        return [f'http://{proxy_address}' for proxy_address in proxy_addresses[:max_proxies]]
+
+    def add_proxies(self, proxies: list) -> None:
+        with self._lock:
+            for proxy in proxies:
+                self.health.setdefault(proxy, {'score': 1.0, 'failures': 0, 'benched_until': 0})
+
+    def get(self) -> str:
+        with self._lock:
+            now = time.monotonic()
+            available = [proxy for proxy, health in self.health.items() if health['benched_until'] <= now]
+            if len(available) == 0:
+                # All are benched, use the one released first
+                return min(self.health, key=lambda proxy: self.health[proxy]['benched_until'])
+            best_score = max(self.health[proxy]['score'] for proxy in available)
+            return random.choice([proxy for proxy in available if self.health[proxy]['score'] >= best_score - self.SCORE_TOLERANCE])
+
+    def report(self, proxy: str, ok: bool) -> None:
+        with self._lock:
+            health = self.health[proxy]
+            health['score'] = (1 - self.SCORE_ALPHA) * health['score'] + self.SCORE_ALPHA * (1.0 if ok else 0.0)
+            if ok is True:
+                health['failures'] = 0
+            else:
+                health['failures'] += 1
+                bench_s = min(self.MAX_BENCH_S, self.BASE_BENCH_S * 2 ** (health['failures'] - 1))
+                health['benched_until'] = time.monotonic() + bench_s
+
+
+class RequestRouter:
+    """
+    Routes YouTube requests through the rate limiter of their host and the healthiest proxy.
+
+    A throttled request (HTTP 429 or 403, captcha or bot check) benches its proxy, slows down the host and is
+    retried through another proxy, a request failing because of its proxy benches the proxy and is retried. If it
+    is still throttled after `max_attempts`, a ThrottledError is raised so that the video is retried later instead
+    of being recorded as attempted.
+    """
+
+    YOUTUBE_HOST = 'www.youtube.com'
+    MEDIA_HOST = 'googlevideo.com'
+    DEFAULT_RATES = {YOUTUBE_HOST: 2.0, MEDIA_HOST: 4.0}
+    THROTTLED_PATTERN = re.compile(r'HTTP Error (429|403)|Too Many Requests|not a bot|g-recaptcha', re.IGNORECASE)
+    PROXY_ERROR_PATTERN = re.compile(r'ProxyError|Tunnel connection failed|Connection refused|timed out', re.IGNORECASE)
+
+    def __init__(self, rate_limiter: RateLimiter, proxy_pool: ProxyPool, max_attempts: int = 3) -> None:
+        self.rate_limiter = rate_limiter
+        self.proxy_pool = proxy_pool
+        self.max_attempts = max_attempts
+
+    @classmethod
+    def from_config(cls, input_cfg: dict, cluster: bool = False, run_id: str = None) -> 'RequestRouter':
+        # Request settings of the input configuration, the direct connection only by default
+        requests_cfg = (input_cfg or dict()).get('requests', dict())
+        rate_limiter = RateLimiter({**cls.DEFAULT_RATES, **requests_cfg.get('rate_limits_per_s', dict())}, cluster=cluster, run_id=run_id)
+        proxies = list(requests_cfg.get('proxies', []))
+        if requests_cfg.get('use_free_proxies', False) is True:
+            proxies += ProxyPool.fetch_free_proxies(requests_cfg.get('max_free_proxies', 20))
+        return cls(rate_limiter, ProxyPool(proxies), max_attempts=requests_cfg.get('max_attempts', 3))
+
+    @classmethod
+    def is_throttled(cls, exc: Exception) -> bool:
+        return isinstance(exc, TooManyRequests) or cls.THROTTLED_PATTERN.search(str(exc)) is not None
+
+    @classmethod
+    def is_proxy_error(cls, exc: Exception) -> bool:
+        return isinstance(exc, requests.exceptions.ProxyError) or cls.PROXY_ERROR_PATTERN.search(str(exc)) is not None
+
+    def call(self, host: str, request_fn: Callable):
+        # `request_fn` gets the proxy to use, None for the direct connection
+        for attempt in range(self.max_attempts):
+            self.rate_limiter.acquire(host)
+            proxy = self.proxy_pool.get()
+            try:
+                result = request_fn(proxy)
+            except Exception as exc:
+                if self.is_throttled(exc):
+                    self.rate_limiter.report(host, throttled=True)
+                elif proxy is None or not self.is_proxy_error(exc):
+                    raise
+                self.proxy_pool.report(proxy, ok=False)
+                StageProfiler.add_retries()
+                last_exc = exc
+                continue
+            self.proxy_pool.report(proxy, ok=True)
+            self.rate_limiter.report(host, throttled=False)
+            return result
+        raise ThrottledError(f'{host} throttled {self.max_attempts} attempts: {last_exc}') from last_exc
@@ -0,0 +1,152 @@
+import time
+from typing import Callable, Iterable, Iterator
+
+import ray
+from tqdm.auto import tqdm
+
+from .downloader import Downloader
+from .profiling import StageProfiler
+from .scheduler import TaskScheduler
+from .worker_context import WorkerContext
+
+
+@ray.remote(max_restarts=3)
+class DownloaderActor:
+    """
+    Long-lived Ray actor that keeps a warm worker context (AWS clients, yt_dl configuration and extractor)
+    and downloads the videos it is fed. Responses carry the stage records of the actor under `profile`.
+    """
+
+    def __init__(self, input_cfg: dict, run_locally: bool = False, run_id: str = None, ydl_cls: Callable = None,
+                 fetch_transcript_fn: Callable = None) -> None:
+        self.input_cfg = input_cfg
+        self.context = WorkerContext.get(run_locally=run_locally, ydl_cls=ydl_cls, fetch_transcript_fn=fetch_transcript_fn)
+        self.context.get_request_router(input_cfg, run_id=run_id)
+
+    def run(self, video_id: str) -> dict:
+        response = Downloader.run(video_id, self.input_cfg, context=self.context)
+        # Send the stage records back with the response
+        return {**response, 'profile': StageProfiler.drain()}
+
+    def download(self, prepared: dict) -> dict:
+        response = Downloader.download(prepared, context=self.context)
+        return {**response, 'profile': StageProfiler.drain()}
+
+    def get_cache_stats(self) -> dict:
+        return self.context.response_cache.stats()
+
+    def get_peak_rss_B(self) -> int:
+        return StageProfiler.get_peak_rss_B()
+
+    def flush(self) -> list:
+        return self.context.flush()
+
+
+class ActorPoolEngine:
+    """
+    Execution engine that feeds video IDs to a pool of DownloaderActor instances.
+
+    The number of submitted but unfinished tasks is bounded by a window of `max_in_flight_per_actor` tasks
+    per actor and results are streamed back with `ray.wait` as soon as they finish, so neither the scheduler
+    nor the driver has to hold a reference for every video. A failing video is reported in its own result
+    and does not stop the run. Tasks go to the actor with the fewest seconds of video in flight, and actors
+    reserve the memory needed for the longest video of the configured duration range. Reports and shards buffered
+    in the actors are written by `flush`. `ydl_cls` and `fetch_transcript_fn` replace the YouTube clients of the actors.
+    """
+
+    def __init__(self, input_cfg: dict, run_locally: bool = False, actors_per_node: int = 2,
+                 max_in_flight_per_actor: int = 2, num_cpus_per_actor: float = 1, run_id: str = None,
+                 ydl_cls: Callable = None, fetch_transcript_fn: Callable = None) -> None:
+        self.input_cfg = input_cfg
+        self.run_locally = run_locally
+        self.run_id = run_id
+        self.ydl_cls = ydl_cls
+        self.fetch_transcript_fn = fetch_transcript_fn
+        self.actors_per_node = actors_per_node
+        self.max_in_flight_per_actor = max_in_flight_per_actor
+        self.num_cpus_per_actor = num_cpus_per_actor
+        self.actors = list()
+
+    def get_cache_stats(self) -> dict:
+        # Sum the response cache counters of all actors
+        actors_stats = ray.get([actor.get_cache_stats.remote() for actor in self.actors])
+        return {
+            'hits': sum(stats['hits'] for stats in actors_stats),
+            'misses': sum(stats['misses'] for stats in actors_stats)
+        }
+
+    def flush(self) -> list:
+        # Write the reports and upload the shards still buffered in the actors, returns the IDs of the stored sharded videos
+        return [video_id for stored_video_ids in ray.get([actor.flush.remote() for actor in self.actors]) for video_id in stored_video_ids]
+
+    def get_peak_rss_B(self) -> int:
+        # Largest peak resident set size of the actors
+        peaks_rss_B = [rss_B for rss_B in ray.get([actor.get_peak_rss_B.remote() for actor in self.actors]) if rss_B is not None]
+        return max(peaks_rss_B) if len(peaks_rss_B) > 0 else None
+
+    @staticmethod
+    def _get_num_alive_nodes() -> int:
+        return len([node for node in ray.nodes() if node['Alive']])
+
+    def _create_actors(self) -> None:
+        # Spread the actors over the currently alive nodes
+        num_actors = max(1, self._get_num_alive_nodes() * self.actors_per_node)
+        resources = {**TaskScheduler(self.input_cfg).get_max_resources(), 'num_cpus': self.num_cpus_per_actor}
+        self.actors = [
+            DownloaderActor.options(**resources, scheduling_strategy='SPREAD').remote(
+                self.input_cfg, run_locally=self.run_locally, run_id=self.run_id, ydl_cls=self.ydl_cls,
+                fetch_transcript_fn=self.fetch_transcript_fn
+            )
+            for _ in range(num_actors)
+        ]
+
+    def run(self, tasks: Iterable, method: str = 'run') -> Iterator[dict]:
+        # Tasks are video IDs for `run` or prefetched videos for `download`
+        if len(self.actors) == 0:
+            self._create_actors()
+
+        tasks = iter(tasks)
+        max_in_flight = len(self.actors) * self.max_in_flight_per_actor
+        actors_load = [0] * len(self.actors)
+        in_flight = dict()
+
+        st = time.time()
+        uploaded_bytes = 0
+        progress_bar = tqdm(desc='videos', unit='video')
+
+        while True:
+            # Fill the window, always picking the least loaded actor, weighted by the video duration when known
+            while len(in_flight) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                actor_idx = actors_load.index(min(actors_load))
+                ref = getattr(self.actors[actor_idx], method).remote(task)
+                load = max(1, task.get('duration_s') or 0) if method == 'download' else 1
+                in_flight[ref] = (actor_idx, task if method == 'run' else task['video_id'], load)
+                actors_load[actor_idx] += load
+
+            if len(in_flight) == 0:
+                break
+
+            # Collect the finished tasks
+            ready_refs, _ = ray.wait(list(in_flight), num_returns=1)
+            for ref in ready_refs:
+                actor_idx, video_id, load = in_flight.pop(ref)
+                actors_load[actor_idx] -= load
+                try:
+                    response = ray.get(ref)
+                except ray.exceptions.RayError as exc:
+                    response = {'video_id': video_id, 'status': False, 'uploaded_bytes': 0, 'error': str(exc)}
+
+                # Report live throughput
+                uploaded_bytes += response['uploaded_bytes']
+                elapsed = max(time.time() - st, 1e-6)
+                progress_bar.update(1)
+                progress_bar.set_postfix({
+                    'videos/s': f'{progress_bar.n / elapsed:.2f}',
+                    'MB/s': f'{uploaded_bytes / 2**20 / elapsed:.2f}'
+                })
+                yield response
+
+        progress_bar.close()
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Callable
+
+
+class ResponseCache:
+    """
+    On-disk cache of YouTube responses (extract_info dicts and transcript segments) shared by all processes of a node.
+
+    Entries are stored in SQLite under a content address derived from the response kind and its key parts
+    (video ID, language), as zlib compressed JSON. Entries older than `ttl_s` are treated as missing and
+    the least recently used entries are evicted once the stored size exceeds `max_size_bytes`.
+    Hit and miss counters are kept per instance.
+    """
+
+    EVICTION_CHECK_INTERVAL = 100
+
+    def __init__(self, path: str, ttl_s: float = 7 * 24 * 60 * 60, max_size_bytes: int = 2 * 2**30) -> None:
+        self.path = path
+        self.ttl_s = ttl_s
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        self._counters_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads, one is opened per thread
+        if getattr(self._local, 'connection', None) is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, kind TEXT, value BLOB, size INTEGER, created_at REAL, accessed_at REAL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+            self._local.connection = connection
+        return self._local.connection
+
+    def _count(self, hit: bool) -> None:
+        with self._counters_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @staticmethod
+    def make_key(kind: str, *key_parts: str) -> str:
+        return hashlib.sha256('\x1f'.join((kind,) + tuple(str(part) for part in key_parts)).encode('utf-8')).hexdigest()
+
+    def get(self, kind: str, *key_parts: str, max_age_s: float = None):
+        # Return the cached value or None when missing or expired
+        max_age_s = self.ttl_s if max_age_s is None else min(max_age_s, self.ttl_s)
+        connection = self._get_connection()
+        key = self.make_key(kind, *key_parts)
+        row = connection.execute('SELECT value, created_at FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time() - max_age_s:
+            self._count(hit=False)
+            return None
+        connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        self._count(hit=True)
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, kind: str, value, *key_parts: str) -> None:
+        connection = self._get_connection()
+        blob = zlib.compress(json.dumps(value).encode('utf-8'))
+        now = time.time()
+        connection.execute(
+            'INSERT OR REPLACE INTO entries (key, kind, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (self.make_key(kind, *key_parts), kind, blob, len(blob), now, now)
+        )
+        # Summing the stored size is a full scan, it is checked every few writes only
+        with self._counters_lock:
+            self._writes += 1
+            check_size = (self._writes - 1) % self.EVICTION_CHECK_INTERVAL == 0
+        if check_size:
+            self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection) -> None:
+        # Drop expired entries, then least recently used ones until the cache is back under 90% of its size limit
+        total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        connection.execute('DELETE FROM entries WHERE created_at < ?', (time.time() - self.ttl_s,))
+        rows = connection.execute('SELECT key, size FROM entries ORDER BY accessed_at').fetchall()
+        total_size = sum(size for _, size in rows)
+        evicted_keys = []
+        for key, size in rows:
+            if total_size <= 0.9 * self.max_size_bytes:
+                break
+            evicted_keys.append((key,))
+            total_size -= size
+        connection.executemany('DELETE FROM entries WHERE key = ?', evicted_keys)
+
+    def get_or_fetch(self, kind: str, key_parts: tuple, fetch_fn: Callable, max_age_s: float = None):
+        value = self.get(kind, *key_parts, max_age_s=max_age_s)
+        if value is None:
+            value = fetch_fn()
+            self.set(kind, value, *key_parts)
+        return value
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,61 @@
+import heapq
+import itertools
+from collections import defaultdict
+from typing import Iterable, Iterator
+
+
+class TaskScheduler:
+    """
+    Orders the generated tasks so that the work packs evenly across the workers of a cluster.
+
+    Tasks are dicts with the video ID, the channel ID, the duration shown in the channel listing and the seconds the
+    channel can still download. Within a window of `window_size` tasks the longest task is dispatched first (LPT), so
+    that workers pulling tasks as they finish end the run together instead of waiting on a few long videos picked up
+    last. Once the dispatched seconds of a channel cover its remaining budget, its further tasks are deferred to the
+    end of the run, they are only needed if earlier videos of the channel are rejected.
+    """
+
+    WINDOW_SIZE = 256
+    # ffmpeg transcodes on one CPU, memory grows with the length of the audio
+    NUM_CPUS = 1
+    BASE_MEMORY_B = 512 * 2**20
+    MEMORY_PER_HOUR_B = 256 * 2**20
+
+    def __init__(self, input_cfg: dict = None, window_size: int = None) -> None:
+        self.input_cfg = input_cfg
+        self.window_size = window_size or self.WINDOW_SIZE
+
+    def get_max_resources(self) -> dict:
+        # Ray resource hints of a worker processing the longest video in the configured duration range
+        max_duration_s = self.input_cfg['max_audio_duration_M'] * 60 if self.input_cfg is not None else 0
+        return {
+            'num_cpus': self.NUM_CPUS,
+            'memory': int(self.BASE_MEMORY_B + self.MEMORY_PER_HOUR_B * max_duration_s / 60 / 60)
+        }
+
+    def iter_scheduled(self, tasks: Iterable[dict]) -> Iterator[dict]:
+        window, deferred = list(), list()
+        dispatched_s = defaultdict(float)
+        order = itertools.count()
+
+        def dispatch(task: dict) -> bool:
+            # Defer the task if the channel budget is covered by the tasks dispatched before
+            remaining_s = task.get('channel_remaining_s')
+            if remaining_s is not None and dispatched_s[task['channel_id']] >= remaining_s:
+                deferred.append(task)
+                return False
+            dispatched_s[task['channel_id']] += task.get('duration_s') or 0
+            return True
+
+        for task in tasks:
+            # Longest first, ties in generation order
+            heapq.heappush(window, (-(task.get('duration_s') or 0), next(order), task))
+            if len(window) >= self.window_size:
+                task = heapq.heappop(window)[2]
+                if dispatch(task) is True:
+                    yield task
+        while len(window) > 0:
+            task = heapq.heappop(window)[2]
+            if dispatch(task) is True:
+                yield task
+        yield from sorted(deferred, key=lambda task: -(task.get('duration_s') or 0))
@@ -0,0 +1,163 @@
+import json
+import os
+import tarfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+from io import BytesIO
+from typing import Iterator
+
+from .aws_helpers import S3Helper
+
+
+class ShardWriter:
+    """
+    Packs the outputs of the downloaded videos into WebDataset-style tar shards of about `max_shard_size_B` bytes.
+
+    A sample is a group of files sharing the sample key as basename, e.g. `<video_id>.flac`, `<video_id>.srt` and
+    `<video_id>.json`. Members are stored uncompressed, so every member can be read with a ranged GET. A shard is
+    built on the local disk and, once full, older than `max_shard_age_s` or flushed, uploaded with a multipart upload
+    to `<prefix>/<name>.tar`, followed by its JSONL index `<prefix>/<name>.index.jsonl` with the byte range of every
+    member. An index is only uploaded after its shard, so shards without an index are incomplete. The keys of the
+    samples of uploaded shards are collected until `drain_uploaded`, samples are only stored once their shard is.
+    A timer uploads the shard once it reaches its maximum age, also when no further samples are added.
+    Shard names start with the ID of the writer, one writer is used per worker process and samples are added from
+    any thread.
+    """
+
+    BUCKET = 'ytdldata'
+    PREFIX = 'shards'
+    SHARD_SIZE_MB = 1024
+    # Shards are uploaded well before the task leases of their samples expire
+    SHARD_MAX_AGE_S = 10 * 60
+
+    def __init__(self, s3_hlp_instance: S3Helper, work_dir: str, max_shard_size_B: int = None, bucket: str = None, prefix: str = None,
+                 max_shard_age_s: float = None) -> None:
+        self.s3_hlp_instance = s3_hlp_instance
+        self.work_dir = work_dir
+        self.max_shard_size_B = max_shard_size_B or self.SHARD_SIZE_MB * 2**20
+        self.max_shard_age_s = max_shard_age_s or self.SHARD_MAX_AGE_S
+        self.bucket = bucket or self.BUCKET
+        self.prefix = prefix or self.PREFIX
+        self.writer_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._n_shards = 0
+        self._tar = None
+        self._index = list()
+        self._opened_at = None
+        self._age_timer = None
+        self._uploaded_keys = list()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def encode_json(obj) -> bytes:
+        # Report items hold Decimal values as read from and written to DynamoDB
+        return json.dumps(obj, default=lambda value: float(value) if isinstance(value, Decimal) else str(value)).encode('utf-8')
+
+    def _open(self) -> None:
+        name = f'{self.writer_id}-{self._n_shards:06d}'
+        self._n_shards += 1
+        os.makedirs(self.work_dir, exist_ok=True)
+        self._shard_key = f'{self.prefix}/{name}.tar'
+        self._tar = tarfile.open(os.path.join(self.work_dir, f'{name}.tar'), 'w', format=tarfile.USTAR_FORMAT)
+        self._index = list()
+        self._opened_at = time.time()
+        # Upload the shard once it is too old, even if the worker is idle
+        self._age_timer = threading.Timer(self.max_shard_age_s, self._flush_aged, args=(self._shard_key,))
+        self._age_timer.daemon = True
+        self._age_timer.start()
+
+    def _close(self) -> tuple:
+        # Finish the current shard, returns its path, key and index to upload
+        self._tar.close()
+        self._age_timer.cancel()
+        finished = (self._tar.name, self._shard_key, self._index)
+        self._tar, self._index = None, list()
+        return finished
+
+    def _flush_aged(self, shard_key: str) -> None:
+        # Runs in the timer thread, the shard may have been closed in the meantime
+        with self._lock:
+            finished = self._close() if self._tar is not None and self._shard_key == shard_key else None
+        if finished is not None:
+            self._upload(*finished)
+
+    def _upload(self, path: str, shard_key: str, index: list) -> None:
+        # Large files are uploaded in parallel parts, the local shard is deleted once uploaded
+        self.s3_hlp_instance.upload_file(filename=path, bucket=self.bucket, key=shard_key)
+        self.s3_hlp_instance.upload_object(
+            body=b'\n'.join(self.encode_json(entry) for entry in index),
+            bucket=self.bucket,
+            key=shard_key[:-len('.tar')] + '.index.jsonl'
+        )
+        with self._lock:
+            self._uploaded_keys.extend(entry['key'] for entry in index)
+
+    def add_sample(self, sample_key: str, files: dict, fields: dict = None) -> int:
+        # Add the files of a sample, mapping extensions to contents or to paths of local files that are moved into
+        # the shard, `fields` are stored in the index entry. Returns the size of the sample's files
+        finished = None
+        with self._lock:
+            if self._tar is None:
+                self._open()
+            # Sizes are read before writing, a missing file does not leave a partial sample in the shard
+            members = list()
+            for extension, content in files.items():
+                tarinfo = tarfile.TarInfo(f'{sample_key}.{extension}')
+                tarinfo.mtime = int(time.time())
+                tarinfo.size = len(content) if isinstance(content, bytes) else os.path.getsize(content)
+                members.append((extension, tarinfo, content))
+            entry = {'key': sample_key, **(fields or dict()), 'shard': self._shard_key, 'members': dict()}
+            for extension, tarinfo, content in members:
+                offset_data = self._tar.offset + len(tarinfo.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+                if isinstance(content, bytes):
+                    self._tar.addfile(tarinfo, BytesIO(content))
+                else:
+                    with open(content, 'rb') as file:
+                        self._tar.addfile(tarinfo, file)
+                entry['members'][extension] = [offset_data, tarinfo.size]
+            self._index.append(entry)
+            if self._tar.offset >= self.max_shard_size_B or time.time() - self._opened_at >= self.max_shard_age_s:
+                finished = self._close()
+        for _, _, content in members:
+            if not isinstance(content, bytes):
+                os.remove(content)
+        # Upload outside of the lock, other threads continue with the next shard
+        if finished is not None:
+            self._upload(*finished)
+        return sum(tarinfo.size for _, tarinfo, _ in members)
+
+    def flush(self) -> None:
+        # Upload the current shard, even if it is not full
+        with self._lock:
+            finished = self._close() if self._tar is not None else None
+        if finished is not None:
+            self._upload(*finished)
+
+    def drain_uploaded(self) -> list:
+        # Keys of the samples whose shard was uploaded since the previous call
+        with self._lock:
+            uploaded_keys, self._uploaded_keys = self._uploaded_keys, list()
+        return uploaded_keys
+
+
+class ShardReader:
+    """
+    Random access to the samples of the shards written by ShardWriter, through the shard indexes.
+    """
+
+    def __init__(self, s3_hlp_instance: S3Helper, bucket: str = None, prefix: str = None) -> None:
+        self.s3_hlp_instance = s3_hlp_instance
+        self.bucket = bucket or ShardWriter.BUCKET
+        self.prefix = prefix or ShardWriter.PREFIX
+
+    def iter_index(self) -> Iterator[dict]:
+        # Index entries of all complete shards, streamed shard by shard
+        for key in self.s3_hlp_instance.list_keys(bucket=self.bucket, prefix=f'{self.prefix}/'):
+            if key.endswith('.index.jsonl'):
+                yield from self.s3_hlp_instance.iter_object(bucket=self.bucket, key=key)
+
+    def load_member(self, entry: dict, extension: str) -> bytes:
+        # Read one file of a sample with a ranged GET of its shard
+        offset, size = entry['members'][extension]
+        return self.s3_hlp_instance.load_object_range(bucket=self.bucket, key=entry['shard'], start=offset, length=size)
@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator
+
+from .downloader import Downloader
+from .streaming import AudioStreamer, AudioTranscoder
+from .worker_context import WorkerContext
+
+
+class StagedEngine:
+    """
+    Execution engine that splits the download of a video into a network stage and a CPU stage, so that both
+    saturate independently instead of a worker alternating between downloading and transcoding.
+
+    The best audio as served is fetched by `download_concurrency` threads, transcoded to FLAC by a pool of
+    `transcode_concurrency` ffmpeg worker processes, and the audio and transcript are uploaded by
+    `upload_concurrency` threads. At most `max_queued_transcodes` raw files are being downloaded, waiting for or
+    in transcoding at any time, so downloads pause while transcoding falls behind and disk use stays bounded.
+    Tasks are prefetched videos for `download` or video IDs for `run`, which are prepared in the network stage.
+    Streamed audio is transcoded by ffmpeg while it is read, it is processed in the network stage as a whole.
+
+    Transcoding processes are spawned rather than forked from the threaded worker. `transcode_fn` defaults to
+    `AudioTranscoder.transcode` and can be replaced, e.g. to transcode with another tool.
+    """
+
+    def __init__(self, input_cfg: dict, run_locally: bool = False, download_concurrency: int = 4,
+                 transcode_concurrency: int = None, upload_concurrency: int = None, max_queued_transcodes: int = None,
+                 context: WorkerContext = None, transcode_fn: Callable = None) -> None:
+        self.input_cfg = input_cfg
+        self.context = context or WorkerContext.get(run_locally=run_locally)
+        self.download_concurrency = download_concurrency
+        self.transcode_concurrency = transcode_concurrency or os.cpu_count() or 1
+        self.upload_concurrency = upload_concurrency or download_concurrency
+        self.max_queued_transcodes = max(max_queued_transcodes or 2 * self.transcode_concurrency, self.transcode_concurrency)
+        self.transcode_fn = transcode_fn or AudioTranscoder.transcode
+
+    @staticmethod
+    def _error_response(video_id: str, exc: Exception) -> dict:
+        return {'video_id': video_id, 'status': False, 'uploaded_bytes': 0, 'error': str(exc)}
+
+    def _fetch(self, task, method: str) -> dict:
+        # Returns the fetched video, or the response of a video that is finished in this stage
+        prepared = task
+        if method == 'run':
+            prepared = Downloader.prepare(task, self.input_cfg, self.context)
+            if prepared is None:
+                return {'response': {'video_id': task, 'status': False, 'uploaded_bytes': 0}}
+        if 'audio_source' in prepared:
+            return {'response': Downloader.download(prepared, self.context)}
+        return Downloader.fetch_raw_audio(prepared, self.context)
+
+    def run(self, tasks: Iterable, method: str = 'download') -> Iterator[dict]:
+        ffmpeg_path = AudioStreamer.get_ffmpeg_path(self.context.yt_dl_cfg.get('ffmpeg_location'))
+        postprocessor_args = self.context.yt_dl_cfg.get('postprocessor_args', [])
+        download_slots = threading.Semaphore(self.download_concurrency)
+        transcode_slots = threading.Semaphore(self.max_queued_transcodes)
+        responses = queue.Queue()
+        end_of_tasks = object()
+        feed_errors = list()
+
+        with ThreadPoolExecutor(max_workers=self.download_concurrency, thread_name_prefix='download') as download_executor, \
+             ThreadPoolExecutor(max_workers=self.upload_concurrency, thread_name_prefix='upload') as upload_executor, \
+             ProcessPoolExecutor(max_workers=self.transcode_concurrency, mp_context=multiprocessing.get_context('spawn')) as transcode_executor:
+
+            def on_uploaded(fetched: dict, future: Future) -> None:
+                try:
+                    responses.put(future.result())
+                except Exception as exc:
+                    responses.put(self._error_response(fetched['video_id'], exc))
+
+            def on_transcoded(fetched: dict, future: Future) -> None:
+                transcode_slots.release()
+                try:
+                    transcode_s = future.result()
+                except Exception as exc:
+                    if os.path.exists(fetched['raw_path']):
+                        os.remove(fetched['raw_path'])
+                    responses.put(self._error_response(fetched['video_id'], exc))
+                    return
+                upload_executor.submit(Downloader.upload, fetched, self.context, transcode_s).add_done_callback(
+                    lambda future: on_uploaded(fetched, future)
+                )
+
+            def on_fetched(video_id: str, future: Future) -> None:
+                download_slots.release()
+                try:
+                    fetched = future.result()
+                except Exception as exc:
+                    transcode_slots.release()
+                    responses.put(self._error_response(video_id, exc))
+                    return
+                if 'response' in fetched:
+                    transcode_slots.release()
+                    responses.put(fetched['response'])
+                    return
+                transcode_executor.submit(
+                    self.transcode_fn, fetched['raw_path'], fetched['audio_path'], ffmpeg_path, postprocessor_args
+                ).add_done_callback(lambda future: on_transcoded(fetched, future))
+
+            def feed() -> None:
+                # Start a download once it has a place in the transcoding queue and a network slot
+                n_tasks = 0
+                try:
+                    for task in tasks:
+                        transcode_slots.acquire()
+                        download_slots.acquire()
+                        video_id = task if method == 'run' else task['video_id']
+                        download_executor.submit(self._fetch, task, method).add_done_callback(
+                            lambda future, video_id=video_id: on_fetched(video_id, future)
+                        )
+                        n_tasks += 1
+                except Exception as exc:
+                    feed_errors.append(exc)
+                finally:
+                    responses.put((end_of_tasks, n_tasks))
+
+            threading.Thread(target=feed, name='staged-feed', daemon=True).start()
+            n_tasks, n_responses = None, 0
+            while n_tasks is None or n_responses < n_tasks:
+                response = responses.get()
+                if isinstance(response, tuple) and response[0] is end_of_tasks:
+                    n_tasks = response[1]
+                    continue
+                n_responses += 1
+                yield response
+        # The tasks could not be read to the end, e.g. the task queue failed
+        if len(feed_errors) > 0:
+            raise feed_errors[0]
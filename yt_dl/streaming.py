@@ -0,0 +1,116 @@
+import os
+import shutil
+import subprocess
+import time
+
+from .aws_helpers import S3Helper
+
+
+class FFmpegAudioStream:
+    """
+    File-like reader over the stdout of an ffmpeg process that transcodes an audio source to FLAC.
+
+    Reaching the end of the stream waits for ffmpeg to exit and raises if it failed, so that a
+    multipart upload reading from it is aborted instead of completed with truncated audio.
+    """
+
+    def __init__(self, command: list) -> None:
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.process.stdout.read(size)
+        if not chunk:
+            self.close()
+        return chunk
+
+    def close(self) -> None:
+        stderr = self.process.stderr.read()
+        if self.process.wait() != 0:
+            raise RuntimeError(f'ffmpeg exited with code {self.process.returncode}: {stderr.decode(errors="replace").strip()}')
+
+    def kill(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+class AudioStreamer:
+    """
+    Helper class for streaming audio straight from its source through ffmpeg into S3.
+
+    The source is read by ffmpeg, transcoded with the yt_dl postprocessor arguments (16 kHz mono FLAC)
+    and written to stdout, which feeds a bounded S3 multipart upload. Nothing is written to disk, so
+    disk use stays constant and uploading overlaps transcoding. Since stdout cannot be seeked, ffmpeg
+    cannot rewrite the FLAC STREAMINFO header at the end, which leaves the total sample count and MD5 unset.
+    """
+
+    @staticmethod
+    def get_ffmpeg_path(ffmpeg_location: str) -> str:
+        # yt_dl configurations point either to the binary or to the directory containing it
+        if ffmpeg_location is None:
+            return shutil.which('ffmpeg') or 'ffmpeg'
+        if os.path.isdir(ffmpeg_location):
+            return os.path.join(ffmpeg_location, 'ffmpeg')
+        return ffmpeg_location
+
+    @staticmethod
+    def get_audio_source(video_metadata: dict) -> dict:
+        # Input of the format selected by yt_dl, the URL is signed and expires after a few hours
+        audio_format = video_metadata['requested_formats'][0] if 'requested_formats' in video_metadata else video_metadata
+        http_headers = audio_format.get('http_headers') or dict()
+        input_args = []
+        if len(http_headers) > 0:
+            input_args += ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in http_headers.items())]
+        return {'input_args': input_args + ['-i', audio_format['url']]}
+
+    @staticmethod
+    def build_ffmpeg_command(ffmpeg_path: str, audio_source: dict, postprocessor_args: list) -> list:
+        return [
+            ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin',
+            *audio_source['input_args'],
+            '-vn', *postprocessor_args,
+            '-f', 'flac', 'pipe:1'
+        ]
+
+    @classmethod
+    def stream_to_s3(cls, audio_source: dict, yt_dl_cfg: dict, s3_hlp_instance: S3Helper, bucket: str, key: str) -> int:
+        command = cls.build_ffmpeg_command(
+            cls.get_ffmpeg_path(yt_dl_cfg.get('ffmpeg_location')),
+            audio_source,
+            yt_dl_cfg.get('postprocessor_args', [])
+        )
+        stream = FFmpegAudioStream(command)
+        try:
+            return s3_hlp_instance.upload_stream(stream, bucket=bucket, key=key)
+        finally:
+            stream.kill()
+
+
+class AudioTranscoder:
+    """
+    Helper class for transcoding downloaded audio files with the yt_dl postprocessor arguments (16 kHz mono FLAC)
+    outside of the yt_dl download, so that transcoding can run in its own pool of processes.
+    """
+
+    @staticmethod
+    def build_ffmpeg_command(ffmpeg_path: str, input_path: str, output_path: str, postprocessor_args: list) -> list:
+        return [
+            ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-nostdin', '-y',
+            '-i', input_path,
+            '-vn', *postprocessor_args,
+            '-f', 'flac', output_path
+        ]
+
+    @classmethod
+    def transcode(cls, input_path: str, output_path: str, ffmpeg_path: str, postprocessor_args: list, delete_input: bool = True) -> float:
+        # Returns the transcoding time, the input is deleted once transcoded
+        st = time.perf_counter()
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        command = cls.build_ffmpeg_command(ffmpeg_path, input_path, output_path, postprocessor_args)
+        process = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise RuntimeError(f'ffmpeg exited with code {process.returncode}: {process.stderr.decode(errors="replace").strip()}')
+        if delete_input is True:
+            os.remove(input_path)
+        return time.perf_counter() - st
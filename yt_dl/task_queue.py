@@ -0,0 +1,479 @@
+import os
+import random
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from .aws_helpers import DynamoDBHelper
+
+
+class TaskQueue(ABC):
+    """
+    Persistent queue of the video IDs of a pipeline run, so that an interrupted run resumes with the remaining videos only.
+
+    A task is pending until a worker leases it. It is done once the downloader returned a response, also when the
+    video was rejected by the constraints, and for sharded outputs once the shard holding the video was uploaded, its
+    lease is renewed meanwhile. A failed attempt returns it to pending after an exponential backoff, and
+    after `max_attempts` attempts it is failed. A lease that expired, e.g. because the worker died half way through an
+    upload, makes the task leasable again, so videos that wrote their report but did not finish uploading are retried.
+    The queue is sealed once task generation finished, so a resumed run skips channel enumeration. If task generation
+    fails the queue is left unsealed, so a resumed run generates the tasks again, and `iter_leased` stops waiting for tasks.
+    """
+
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATES = (PENDING, LEASED, DONE, FAILED)
+    LEASE_RETRY_JITTER_S = 0.1
+
+    def __init__(self, run_id: str, lease_timeout_s: float = 30 * 60, max_attempts: int = 3, retry_backoff_s: float = 60) -> None:
+        self.run_id = run_id
+        self.lease_timeout_s = lease_timeout_s
+        self.max_attempts = max_attempts
+        self.retry_backoff_s = retry_backoff_s
+        # Error of the task generation filling the queue in this process, if it failed
+        self.generation_error = None
+        # Leased tasks whose sample waits for the upload of its shard, with the time their lease was last renewed
+        self._pending_uploads = dict()
+
+    def _get_retry_time(self, attempts: int) -> float:
+        return time.time() + self.retry_backoff_s * 2 ** max(attempts - 1, 0)
+
+    @abstractmethod
+    def add(self, video_ids: list) -> int:
+        # Add new tasks, tasks already in the queue are left as they are
+        ...
+
+    @abstractmethod
+    def lease(self, max_tasks: int = 1) -> list:
+        # Lease up to `max_tasks` tasks that are pending or whose lease expired
+        ...
+
+    @abstractmethod
+    def complete(self, video_id: str) -> None:
+        ...
+
+    @abstractmethod
+    def fail(self, video_id: str, error: str) -> None:
+        ...
+
+    @abstractmethod
+    def extend_leases(self, video_ids: list) -> None:
+        # Restart the lease timeout of tasks that are still leased
+        ...
+
+    @abstractmethod
+    def reset_leases(self) -> int:
+        # Return all leased tasks to pending, used by a resumed driver whose predecessor held the leases
+        ...
+
+    @abstractmethod
+    def next_available_at(self) -> float:
+        # Earliest time a pending task can be leased, None if there is none. Leased tasks are in flight, their lease
+        # expiry is not waited for
+        ...
+
+    @abstractmethod
+    def counts(self) -> dict:
+        ...
+
+    @abstractmethod
+    def seal(self) -> None:
+        ...
+
+    @abstractmethod
+    def is_sealed(self) -> bool:
+        ...
+
+    def fill(self, video_ids: Iterable[str], batch_size: int = 25) -> int:
+        # Add the generated tasks in batches as they come and seal the queue at the end
+        n_added, batch = 0, list()
+        try:
+            for video_id in video_ids:
+                batch.append(video_id)
+                if len(batch) == batch_size:
+                    n_added += self.add(batch)
+                    batch = list()
+        except Exception as exc:
+            # Not sealed, the tasks generated so far are kept and the missing ones are generated by the next run
+            self.generation_error = exc
+            raise
+        finally:
+            if len(batch) > 0:
+                n_added += self.add(batch)
+        self.seal()
+        return n_added
+
+    def is_finished(self) -> bool:
+        counts = self.counts()
+        return self.is_sealed() and counts[self.PENDING] + counts[self.LEASED] == 0
+
+    def iter_leased(self, batch_size: int = 1, poll_interval_s: float = 1) -> Iterator[str]:
+        # Lease tasks one batch at a time. While task generation is running, wait for new tasks, afterwards stop
+        # once no pending task can be leased, leaving tasks in backoff or leased by other workers to a later pass
+        while True:
+            self.renew_leases()
+            video_ids = self.lease(batch_size)
+            if len(video_ids) > 0:
+                yield from video_ids
+            elif self.generation_error is not None:
+                return
+            elif self.is_sealed():
+                # Other workers took the tasks this one tried, lease again while pending tasks are available
+                next_available_at = self.next_available_at()
+                if next_available_at is None or next_available_at > time.time():
+                    return
+                # Jitter spreads the workers that lost the same tasks
+                time.sleep(random.uniform(0, min(poll_interval_s, self.LEASE_RETRY_JITTER_S)))
+            else:
+                time.sleep(poll_interval_s)
+
+    def complete_many(self, video_ids: Iterable[str]) -> None:
+        for video_id in video_ids:
+            self._pending_uploads.pop(video_id, None)
+            self.complete(video_id)
+
+    def renew_leases(self) -> None:
+        # Keep the leases of samples waiting in an open shard, so an idle worker's tasks are not leased and downloaded again
+        now = time.time()
+        video_ids = [video_id for video_id, renewed_at in list(self._pending_uploads.items()) if now - renewed_at >= self.lease_timeout_s / 2]
+        if len(video_ids) > 0:
+            self.extend_leases(video_ids)
+            for video_id in video_ids:
+                if video_id in self._pending_uploads:
+                    self._pending_uploads[video_id] = now
+
+    def release_pending_uploads(self) -> None:
+        # Samples not stored by the end of a pass were lost with their worker, their leases expire and they are retried
+        self._pending_uploads.clear()
+
+    def record_response(self, response: dict) -> None:
+        # A returned response completes the task, an error schedules a retry. Sharded videos stay leased until the
+        # response of a later video of the worker, or its flush, reports their shard as uploaded, and their leases are
+        # renewed meanwhile
+        self.complete_many(response.get('stored_video_ids', []))
+        if response.get('error') is not None:
+            self.fail(response['video_id'], response['error'])
+        elif response.get('pending_upload') is not True:
+            self.complete(response['video_id'])
+        else:
+            # The lease was taken before the download, it is renewed from the time the sample was buffered
+            self.extend_leases([response['video_id']])
+            self._pending_uploads[response['video_id']] = time.time()
+        self.renew_leases()
+
+
+class SQLiteTaskQueue(TaskQueue):
+    """
+    Task queue stored in a local SQLite database, shared by the processes of one machine.
+    """
+
+    def __init__(self, path: str, run_id: str, **kwargs) -> None:
+        super().__init__(run_id, **kwargs)
+        self.path = os.path.abspath(path)
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def __getstate__(self) -> dict:
+        # Connections are opened again in the process the queue is sent to
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads, one is opened per thread
+        if getattr(self._local, 'connection', None) is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS tasks '
+                '(run_id TEXT, video_id TEXT, state TEXT, attempts INTEGER, available_at REAL, error TEXT, updated_at REAL, '
+                'PRIMARY KEY (run_id, video_id))'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (run_id, state, available_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, sealed INTEGER)')
+            self._local.connection = connection
+        return self._local.connection
+
+    def add(self, video_ids: list) -> int:
+        now = time.time()
+        cursor = self._get_connection().executemany(
+            'INSERT OR IGNORE INTO tasks (run_id, video_id, state, attempts, available_at, error, updated_at) VALUES (?, ?, ?, 0, ?, NULL, ?)',
+            [(self.run_id, video_id, self.PENDING, now, now) for video_id in video_ids]
+        )
+        return cursor.rowcount
+
+    def lease(self, max_tasks: int = 1) -> list:
+        connection = self._get_connection()
+        now = time.time()
+        # Take the write lock up front so that concurrent workers never lease the same task
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Expired leases of tasks that used up their attempts are failed
+            connection.execute(
+                'UPDATE tasks SET state = ?, error = COALESCE(error, ?), updated_at = ? '
+                'WHERE run_id = ? AND state = ? AND available_at <= ? AND attempts >= ?',
+                (self.FAILED, 'Lease expired', now, self.run_id, self.LEASED, now, self.max_attempts)
+            )
+            rows = connection.execute(
+                'SELECT video_id FROM tasks WHERE run_id = ? AND state IN (?, ?) AND available_at <= ? ORDER BY available_at, rowid LIMIT ?',
+                (self.run_id, self.PENDING, self.LEASED, now, max_tasks)
+            ).fetchall()
+            connection.executemany(
+                'UPDATE tasks SET state = ?, attempts = attempts + 1, available_at = ?, updated_at = ? WHERE run_id = ? AND video_id = ?',
+                [(self.LEASED, now + self.lease_timeout_s, now, self.run_id, video_id) for video_id, in rows]
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return [video_id for video_id, in rows]
+
+    def complete(self, video_id: str) -> None:
+        self._get_connection().execute(
+            'UPDATE tasks SET state = ?, error = NULL, updated_at = ? WHERE run_id = ? AND video_id = ?',
+            (self.DONE, time.time(), self.run_id, video_id)
+        )
+
+    def fail(self, video_id: str, error: str) -> None:
+        connection = self._get_connection()
+        row = connection.execute('SELECT attempts FROM tasks WHERE run_id = ? AND video_id = ?', (self.run_id, video_id)).fetchone()
+        attempts = row[0] if row is not None else self.max_attempts
+        state = self.FAILED if attempts >= self.max_attempts else self.PENDING
+        connection.execute(
+            'UPDATE tasks SET state = ?, available_at = ?, error = ?, updated_at = ? WHERE run_id = ? AND video_id = ?',
+            (state, self._get_retry_time(attempts), error, time.time(), self.run_id, video_id)
+        )
+
+    def extend_leases(self, video_ids: list) -> None:
+        now = time.time()
+        self._get_connection().executemany(
+            'UPDATE tasks SET available_at = ?, updated_at = ? WHERE run_id = ? AND video_id = ? AND state = ?',
+            [(now + self.lease_timeout_s, now, self.run_id, video_id, self.LEASED) for video_id in video_ids]
+        )
+
+    def reset_leases(self) -> int:
+        now = time.time()
+        cursor = self._get_connection().execute(
+            'UPDATE tasks SET state = ?, available_at = ?, updated_at = ? WHERE run_id = ? AND state = ?',
+            (self.PENDING, now, now, self.run_id, self.LEASED)
+        )
+        return cursor.rowcount
+
+    def next_available_at(self) -> float:
+        return self._get_connection().execute(
+            'SELECT MIN(available_at) FROM tasks WHERE run_id = ? AND state = ?',
+            (self.run_id, self.PENDING)
+        ).fetchone()[0]
+
+    def counts(self) -> dict:
+        rows = self._get_connection().execute(
+            'SELECT state, COUNT(*) FROM tasks WHERE run_id = ? GROUP BY state', (self.run_id,)
+        ).fetchall()
+        return {**{state: 0 for state in self.STATES}, **dict(rows)}
+
+    def seal(self) -> None:
+        self._get_connection().execute('INSERT OR REPLACE INTO runs (run_id, sealed) VALUES (?, 1)', (self.run_id,))
+
+    def is_sealed(self) -> bool:
+        row = self._get_connection().execute('SELECT sealed FROM runs WHERE run_id = ?', (self.run_id,)).fetchone()
+        return row is not None and row[0] == 1
+
+
+class DynamoDBTaskQueue(TaskQueue):
+    """
+    Task queue stored in a DynamoDB table, shared by all nodes of a cluster.
+
+    Tasks are keyed by run ID and video ID. The `run_state` attribute (run ID and state) and `available_at` form the
+    key of the `RUN_STATE_INDEX` global secondary index, so leasing and counting read only the tasks in the requested
+    state. Leases are taken with conditional updates, so a task is leased by one worker only even though the index is
+    eventually consistent. Workers try the tasks of a page of the index in random order, and go on to the next pages
+    while tasks they tried were taken by other workers. The sealed marker is stored as an item without `run_state`.
+    """
+
+    RUN_STATE_INDEX = 'run_state-available_at-index'
+    SEALED_MARKER = '#sealed'
+    LEASE_PAGE_SIZE = 25
+
+    def __init__(self, table_name: str, run_id: str, **kwargs) -> None:
+        super().__init__(run_id, **kwargs)
+        self.table_name = table_name
+        self.dynamo_hlp_instance = DynamoDBHelper(table_name=table_name)
+
+    def __getstate__(self) -> dict:
+        # The helper keeps thread-bound tables, it is created again in the process the queue is sent to
+        state = self.__dict__.copy()
+        del state['dynamo_hlp_instance']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.dynamo_hlp_instance = DynamoDBHelper(table_name=self.table_name)
+
+    def _run_state(self, state: str) -> str:
+        return f'{self.run_id}#{state}'
+
+    def _query_state(self, state: str, available_before: float = None, limit: int = None) -> list:
+        key_condition = Key('run_state').eq(self._run_state(state))
+        if available_before is not None:
+            key_condition = key_condition & Key('available_at').lte(available_before)
+        query_expressions = {"IndexName": self.RUN_STATE_INDEX, "KeyConditionExpression": key_condition}
+        if limit is not None:
+            return self.dynamo_hlp_instance.query_items({**query_expressions, "Limit": limit})['Items']
+        return self.dynamo_hlp_instance.query_all_items(query_expressions)
+
+    def _iter_state_pages(self, state: str, available_before: float, page_size: int) -> Iterator[list]:
+        # Pages of the tasks in the state, read one at a time
+        query_expressions = {
+            "IndexName": self.RUN_STATE_INDEX,
+            "KeyConditionExpression": Key('run_state').eq(self._run_state(state)) & Key('available_at').lte(available_before),
+            "Limit": page_size
+        }
+        while True:
+            response = self.dynamo_hlp_instance.query_items(query_expressions)
+            yield response['Items']
+            if 'LastEvaluatedKey' not in response:
+                return
+            query_expressions["ExclusiveStartKey"] = response['LastEvaluatedKey']
+
+    def _set_state(self, video_id: str, state: str, available_at: float, expected_state: str = None,
+                   error: str = None, add_attempt: bool = False) -> dict:
+        # Conditional state transition, returns the updated item or None if the task was taken by another worker
+        update_expression = 'SET task_state = :state, run_state = :run_state, available_at = :available_at, last_error = :error'
+        expression_values = {
+            ":state": state,
+            ":run_state": self._run_state(state),
+            ":available_at": int(available_at),
+            ":error": error
+        }
+        if add_attempt is True:
+            update_expression += ' ADD attempts :one'
+            expression_values[":one"] = 1
+        update_expressions = {
+            "UpdateExpression": update_expression,
+            "ConditionExpression": 'attribute_exists(video_id)',
+            "ExpressionAttributeValues": expression_values,
+            "ReturnValues": 'ALL_NEW'
+        }
+        if expected_state is not None:
+            update_expressions["ConditionExpression"] += ' AND task_state = :expected_state AND available_at <= :now'
+            expression_values[":expected_state"] = expected_state
+            expression_values[":now"] = int(time.time())
+        try:
+            return self.dynamo_hlp_instance.update_item(
+                key={"run_id": self.run_id, "video_id": video_id},
+                update_expressions=update_expressions
+            )['Attributes']
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return None
+
+    def add(self, video_ids: list) -> int:
+        n_added = 0
+        for video_id in video_ids:
+            try:
+                self.dynamo_hlp_instance.dynamodb_table.put_item(
+                    Item={
+                        "run_id": self.run_id,
+                        "video_id": video_id,
+                        "task_state": self.PENDING,
+                        "run_state": self._run_state(self.PENDING),
+                        "available_at": int(time.time()),
+                        "attempts": 0
+                    },
+                    ConditionExpression='attribute_not_exists(video_id)'
+                )
+                n_added += 1
+            except ClientError as exc:
+                if exc.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        return n_added
+
+    def lease(self, max_tasks: int = 1) -> list:
+        now = int(time.time())
+        leased = list()
+        for state in (self.PENDING, self.LEASED):
+            for items in self._iter_state_pages(state, now, max(max_tasks, self.LEASE_PAGE_SIZE)):
+                # Concurrent workers do not all race for the head of the index
+                random.shuffle(items)
+                for item in items:
+                    # Expired leases of tasks that used up their attempts are failed
+                    if state == self.LEASED and item.get('attempts', 0) >= self.max_attempts:
+                        self._set_state(item['video_id'], self.FAILED, now, expected_state=state, error=item.get('last_error') or 'Lease expired')
+                        continue
+                    if self._set_state(item['video_id'], self.LEASED, now + self.lease_timeout_s, expected_state=state, add_attempt=True) is not None:
+                        leased.append(item['video_id'])
+                    if len(leased) == max_tasks:
+                        return leased
+        return leased
+
+    def complete(self, video_id: str) -> None:
+        self._set_state(video_id, self.DONE, time.time())
+
+    def fail(self, video_id: str, error: str) -> None:
+        item = self.dynamo_hlp_instance.get_item({"run_id": self.run_id, "video_id": video_id}) or dict()
+        attempts = int(item.get('attempts', self.max_attempts))
+        state = self.FAILED if attempts >= self.max_attempts else self.PENDING
+        self._set_state(video_id, state, self._get_retry_time(attempts), error=error)
+
+    def extend_leases(self, video_ids: list) -> None:
+        now = time.time()
+        for video_id in video_ids:
+            try:
+                self.dynamo_hlp_instance.update_item(
+                    key={"run_id": self.run_id, "video_id": video_id},
+                    update_expressions={
+                        "UpdateExpression": 'SET available_at = :available_at',
+                        "ConditionExpression": 'task_state = :leased',
+                        "ExpressionAttributeValues": {":available_at": int(now + self.lease_timeout_s), ":leased": self.LEASED}
+                    }
+                )
+            except ClientError as exc:
+                # The task was completed, failed or reset in the meantime
+                if exc.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+    def reset_leases(self) -> int:
+        n_reset = 0
+        for item in self._query_state(self.LEASED):
+            if self._set_state(item['video_id'], self.PENDING, time.time()) is not None:
+                n_reset += 1
+        return n_reset
+
+    def next_available_at(self) -> float:
+        items = self._query_state(self.PENDING, limit=1)
+        return float(items[0]['available_at']) if len(items) > 0 else None
+
+    def counts(self) -> dict:
+        counts = dict()
+        for state in self.STATES:
+            query_expressions = {
+                "IndexName": self.RUN_STATE_INDEX,
+                "KeyConditionExpression": Key('run_state').eq(self._run_state(state)),
+                "Select": 'COUNT'
+            }
+            counts[state] = 0
+            while True:
+                response = self.dynamo_hlp_instance.query_items(query_expressions)
+                counts[state] += response['Count']
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query_expressions["ExclusiveStartKey"] = response['LastEvaluatedKey']
+        return counts
+
+    def seal(self) -> None:
+        self.dynamo_hlp_instance.import_item({"run_id": self.run_id, "video_id": self.SEALED_MARKER})
+
+    def is_sealed(self) -> bool:
+        return self.dynamo_hlp_instance.get_item({"run_id": self.run_id, "video_id": self.SEALED_MARKER}) is not None
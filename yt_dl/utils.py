@@ -1,3 +1,6 @@
+import copy
+from functools import lru_cache
+
 import yaml
 
 
@@ -7,6 +10,11 @@ def get_video_length(time_str):
 def load_yaml_config(cfg_path: str) -> dict:
     return yaml.safe_load(open(cfg_path))
 
+@lru_cache(maxsize=None)
+def _load_cached_yaml_config(cfg_path: str) -> dict:
+    return load_yaml_config(cfg_path)
+
 def load_yt_dl_config(run_locally: bool):
     cfg_name = 'yt_dl_local_config' if run_locally is True else 'yt_dl_remote_config'
-    return load_yaml_config(f"yt_dl/configs/{cfg_name}.yaml")
\ No newline at end of file
+    # Parse once per process, callers get their own copy since YoutubeDL may modify it
+    return copy.deepcopy(_load_cached_yaml_config(f"yt_dl/configs/{cfg_name}.yaml"))
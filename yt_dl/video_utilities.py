@@ -1,10 +1,17 @@
+import json
+from datetime import datetime
 from decimal import Decimal
-from typing import Final
+from typing import BinaryIO, Callable, Final, Iterator
 
-import pandas as pd
+import numpy as np
 from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_wpm.__main__ import (calc_seconds_per_word, calc_speak_time,
-                                  normalize_languages, normalize_youtube_id)
+from youtube_wpm.__main__ import normalize_languages, normalize_youtube_id
+from youtube_wpm._youtube import RE_SOUND, RE_SPEAKER_NAME
+
+from .channel_utilities import ChannelPerformanceUtilities
+from .profiling import StageProfiler
+from .rate_limiting import RequestRouter
+from .response_cache import ResponseCache
 
 
 class TranscriptHelper:
@@ -15,37 +22,126 @@ class TranscriptHelper:
     It provides methods for tasks such as loading, conversion and formatting of transcript data.
     """
 
-    @staticmethod 
-    def _convert_to_srt(transcripts: list) -> str:
-        def convert_time(seconds: float) -> str:
-            hours = int(seconds // 3600)
-            seconds %= 3600
-            minutes = int(seconds // 60)
-            seconds = seconds % 60
-            milliseconds = int((seconds - int(seconds)) * 1000)
-            return f"{hours:02d}:{minutes:02d}:{int(seconds):02d},{milliseconds:03d}"
-        
-        def format_transcript(counter: int, transcript: dict) -> str:
-            return f"{counter}\n" \
-                   f"{convert_time(transcript['start'])} --> {convert_time(transcript['start'] + transcript['duration'])}\n" \
-                   f"{transcript['text']}\n\n"
+    TRANSCRIPT_FORMATS: Final = ('srt', 'vtt', 'jsonl')
+    ENCODE_CHUNK_SEGMENTS: Final = 1024
+
+    @staticmethod
+    def _format_timestamp(milliseconds: int, separator: str) -> str:
+        # Integer arithmetic avoids the float drift of splitting seconds into parts
+        hours, milliseconds = divmod(milliseconds, 3600000)
+        minutes, milliseconds = divmod(milliseconds, 60000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+
+    @classmethod
+    def iter_transcript(cls, transcripts: list, transcript_format: str = 'srt') -> Iterator[bytes]:
+        # Encode the transcript in SRT, WebVTT or JSONL format, in chunks of `ENCODE_CHUNK_SEGMENTS` segments
+        if transcript_format not in cls.TRANSCRIPT_FORMATS:
+            raise NotImplementedError(f'Transcript format {transcript_format} is not implemented!')
+        format_timestamp = cls._format_timestamp
+        separator = ',' if transcript_format == 'srt' else '.'
+        if transcript_format == 'vtt':
+            yield b"WEBVTT\n\n"
 
-        return ''.join(format_transcript(i + 1, transcript) for i, transcript in enumerate(transcripts))
+        lines = []
+        for counter, transcript in enumerate(transcripts, start=1):
+            start_ms = round(transcript['start'] * 1000)
+            end_ms = round((transcript['start'] + transcript['duration']) * 1000)
+            if transcript_format == 'jsonl':
+                lines.append(json.dumps({'start_ms': start_ms, 'end_ms': end_ms, 'text': transcript['text']}) + "\n")
+            else:
+                if transcript_format == 'srt':
+                    lines.append(f"{counter}\n")
+                lines.append(f"{format_timestamp(start_ms, separator)} --> {format_timestamp(end_ms, separator)}\n"
+                             f"{transcript['text']}\n\n")
+            if counter % cls.ENCODE_CHUNK_SEGMENTS == 0:
+                yield ''.join(lines).encode('utf-8')
+                lines = []
+        if len(lines) > 0:
+            yield ''.join(lines).encode('utf-8')
 
     @classmethod
-    def _get_video_transcript(cls, video_id: str, cap_lng: str) -> tuple:
+    def write_transcript(cls, transcripts: list, buffer: BinaryIO, transcript_format: str = 'srt') -> int:
+        # Write the encoded transcript into a binary buffer or stream, returns the number of written bytes
+        written = 0
+        for chunk in cls.iter_transcript(transcripts, transcript_format):
+            written += buffer.write(chunk)
+        return written
+
+    @staticmethod
+    def _fetch_video_transcript(video_id: str, cap_lng: str, proxy: str = None) -> tuple:
+        proxies = {'http': proxy, 'https': proxy} if proxy is not None else None
         try:
-            transcripts = YouTubeTranscriptApi().list_transcripts(normalize_youtube_id(video_id))
+            transcripts = YouTubeTranscriptApi().list_transcripts(normalize_youtube_id(video_id), proxies=proxies)
         except Exception as exc:
-            return None, '', exc.cause
+            # Throttled and proxy failures are retried instead of being recorded
+            if RequestRouter.is_throttled(exc) or (proxy is not None and RequestRouter.is_proxy_error(exc)):
+                raise
+            return None, getattr(exc, 'cause', str(exc)), False
         if len(transcripts._generated_transcripts) == 0:
-            return None, '', 'Captions unavailable'
+            return None, 'Captions unavailable', True
         if cap_lng in transcripts._generated_transcripts:
             transcript = transcripts.find_transcript(normalize_languages(cap_lng)).fetch()
-            srt_content = cls._convert_to_srt(transcript)
-            return transcript, srt_content, ''
+            return transcript, '', True
+        else:
+            return None, 'Selected caption language not available', True
+
+    @classmethod
+    def _get_video_transcript(cls, video_id: str, cap_lng: str, response_cache: ResponseCache = None, request_router: RequestRouter = None,
+                              fetch_transcript_fn: Callable = None) -> tuple:
+        fetch_transcript_fn = fetch_transcript_fn or cls._fetch_video_transcript
+        cached = response_cache.get('transcript', video_id, cap_lng) if response_cache is not None else None
+        if cached is not None:
+            transcript, msg = cached['transcript'], cached['msg']
+        elif request_router is not None:
+            transcript, msg, cacheable = request_router.call(
+                RequestRouter.YOUTUBE_HOST,
+                lambda proxy: fetch_transcript_fn(video_id, cap_lng, proxy)
+            )
         else:
-            return None, '', 'Selected caption language not available'
+            transcript, msg, cacheable = fetch_transcript_fn(video_id, cap_lng)
+        if cached is None:
+            # Failed requests may succeed later and are not cached
+            if response_cache is not None and cacheable:
+                response_cache.set('transcript', {'transcript': transcript, 'msg': msg}, video_id, cap_lng)
+        return transcript, msg
+
+
+class TranscriptAnalytics:
+    """
+    Speech-rate and quality metrics of a transcript, from the speech segments tokenized by WordsPerMinuteHelper.
+
+    All metrics come from one pass of vectorized NumPy operations over the segment arrays: the running maximum of
+    the segment ends is the end of the speech covered before every segment, from which the speech coverage and the
+    silence gaps between consecutive segments follow. Intros and outros before the first and after the last caption
+    are not silences. The per-segment WPM distribution and the caption density are reduced from the same arrays.
+    """
+
+    # Gaps without speech from this length on are counted as silences
+    MIN_SILENCE_GAP_S: Final[float] = 2.0
+
+    @classmethod
+    def get_metrics(cls, tokenized: tuple, video_duration_s: float) -> dict:
+        starts, durations, word_cts, _ = tokenized
+        video_duration_s = float(video_duration_s)
+        ends = starts + durations
+        # Caption display times overlap, only the time after the covered end adds speech
+        covered_ends = np.maximum.accumulate(ends) if len(ends) > 0 else ends
+        prev_covered_ends = np.concatenate(([0.0], covered_ends[:-1]))
+        covered_s = float(np.maximum(ends - np.maximum(starts, prev_covered_ends), 0).sum())
+        # Only the gaps between segments are silences
+        gaps = starts[1:] - covered_ends[:-1]
+        # Segments without display duration have no speech rate
+        timed = durations > 0
+        segment_wpm = word_cts[timed] * 60 / durations[timed]
+        return {
+            'speech_coverage': min(covered_s / video_duration_s, 1.0) if video_duration_s > 0 else 0.0,
+            'max_silence_gap_s': max(float(gaps.max()), 0.0) if len(gaps) > 0 else 0.0,
+            'silence_gap_count': int((gaps >= cls.MIN_SILENCE_GAP_S).sum()),
+            'segment_wpm_mean': float(segment_wpm.mean()) if len(segment_wpm) > 0 else 0.0,
+            'segment_wpm_std': float(segment_wpm.std()) if len(segment_wpm) > 0 else 0.0,
+            'caption_density_per_M': len(starts) / (video_duration_s / 60) if video_duration_s > 0 else 0.0
+        }
 
 
 class WordsPerMinuteHelper:
@@ -54,27 +150,94 @@ class WordsPerMinuteHelper:
 
     This class provides methods to analyze audio content and determine the average words per minute spoken in the audio.
     It serves as a tool for estimating the speech rate or transcription speed based on the audio input.
+
+    The estimate is the fixed-point iteration of `youtube_wpm.calc_speak_time`: the speaking time of every segment
+    is approximated from its word and character counts at the current WPM, blended with its display duration, and the
+    WPM is recomputed until it changes by less than `EXIT_WPM_DIFF_THRESHOLD`. Segments are tokenized once into arrays,
+    iterations run as vectorized NumPy operations and many transcripts can be estimated in one call.
     """
 
     MAX_ITERATION: Final = 10
     EXIT_WPM_DIFF_THRESHOLD: Final[float] = 1
-    INITIAL_APPROXIMATE_WPM: Final[float] = Decimal(180)
+    INITIAL_APPROXIMATE_WPM: Final[float] = 180
+    # Weights of the display duration and approximate speaking time of a segment, as in youtube_wpm
+    DISPLAY_DURATION_WEIGHT: Final[float] = 1 / 6
+    SPEAK_TIME_WEIGHT: Final[float] = 5 / 6
+
+    @staticmethod
+    def _tokenize(sequences: list) -> tuple:
+        # Start, display duration, word and character counts of the segments containing speech
+        starts, durations, word_cts, char_cts = [], [], [], []
+        for sequence in sequences:
+            text = sequence["text"].strip().replace("\n", " ")
+            text = RE_SOUND.sub("", text).strip()
+            text = RE_SPEAKER_NAME.sub("", text).strip()
+            if not text:
+                continue
+            words = text.split()
+            starts.append(sequence["start"])
+            durations.append(sequence["duration"])
+            word_cts.append(len(words))
+            char_cts.append(sum(len(word) for word in words))
+        return (np.array(starts, dtype=np.float64), np.array(durations, dtype=np.float64),
+                np.array(word_cts, dtype=np.float64), np.array(char_cts, dtype=np.float64))
 
     @classmethod
-    def get_video_wpm(cls, sequences: list) -> Decimal:
-        initial_wpm: Final = Decimal(cls.INITIAL_APPROXIMATE_WPM)
-        prev_wpm: Decimal = initial_wpm
-        
-        inference_spw = calc_seconds_per_word(prev_wpm)
-        for i in range(cls.MAX_ITERATION):
-            stats = calc_speak_time(sequences, inference_spw=inference_spw)
-            diff_wpm = abs(stats.wpm - prev_wpm)
-            print(f"iteration={i}, wpm={stats.wpm:.1f}, diff_wpm={diff_wpm:.1f}")
-            if diff_wpm < cls.EXIT_WPM_DIFF_THRESHOLD:
+    def get_videos_wpm(cls, sequences_list: list) -> np.ndarray:
+        return cls._get_tokenized_wpm([cls._tokenize(sequences) for sequences in sequences_list])
+
+    @classmethod
+    def _get_tokenized_wpm(cls, tokenized: list) -> np.ndarray:
+        n_videos = len(tokenized)
+        lengths = np.array([len(starts) for starts, _, _, _ in tokenized], dtype=np.int64)
+        wpm = np.zeros(n_videos)
+        if lengths.sum() == 0:
+            return wpm
+
+        # Concatenate all segments, `owner` maps every segment to its video
+        starts, durations, word_cts, char_cts = (np.concatenate(arrays) for arrays in zip(*tokenized))
+        owner = np.repeat(np.arange(n_videos), lengths)
+        last_idx = np.cumsum(lengths) - 1
+        has_segments = lengths > 0
+
+        # Talking begins at the first segment with a non-zero start, blank time is only counted after it
+        nonzero_start = starts != 0
+        first_talk_idx = np.full(n_videos, len(starts))
+        np.minimum.at(first_talk_idx, owner[nonzero_start], np.flatnonzero(nonzero_start))
+        first_talk_idx[first_talk_idx == len(starts)] = -1
+        begin_talk = np.where(first_talk_idx >= 0, starts[np.maximum(first_talk_idx, 0)], 0.0)
+        counts_blank = np.zeros(len(starts), dtype=bool)
+        counts_blank[1:] = (owner[1:] == owner[:-1]) & (first_talk_idx[owner[1:]] >= 0) & (np.arange(1, len(starts)) > first_talk_idx[owner[1:]])
+
+        # Segment end is linear in the seconds per word: start + display weight + speak time weight * spw
+        end_base = starts + durations * cls.DISPLAY_DURATION_WEIGHT
+        end_per_spw = (word_cts * 0.95 + char_cts / 100) * cls.SPEAK_TIME_WEIGHT
+        total_word_ct = np.bincount(owner, weights=word_cts, minlength=n_videos)
+
+        prev_wpm = np.full(n_videos, float(cls.INITIAL_APPROXIMATE_WPM))
+        active = has_segments.copy()
+        for _ in range(cls.MAX_ITERATION):
+            inference_spw = 60 / prev_wpm
+            last = end_base + end_per_spw * inference_spw[owner]
+            gaps = np.zeros(len(starts))
+            gaps[1:] = starts[1:] - last[:-1]
+            gaps_mask = counts_blank & (gaps > 0) & (np.concatenate(([0.0], last[:-1])) > 0)
+            total_blank_secs = np.bincount(owner[gaps_mask], weights=gaps[gaps_mask], minlength=n_videos)
+            total_speak_secs = last[last_idx] - begin_talk - total_blank_secs
+
+            # Only videos that have not converged yet are updated
+            iter_wpm = np.divide(total_word_ct * 60, total_speak_secs, out=np.zeros(n_videos), where=active)
+            wpm = np.where(active, iter_wpm, wpm)
+            converged = active & (np.abs(iter_wpm - prev_wpm) < cls.EXIT_WPM_DIFF_THRESHOLD)
+            prev_wpm = np.where(active, iter_wpm, prev_wpm)
+            active &= ~converged
+            if not active.any():
                 break
-            inference_spw = calc_seconds_per_word(stats.wpm)
-            prev_wpm = stats.wpm
-        return stats.wpm
+        return wpm
+
+    @classmethod
+    def get_video_wpm(cls, sequences: list) -> float:
+        return float(cls.get_videos_wpm([sequences])[0])
     
 
 class VideoMetadataUtilities():
@@ -87,34 +250,61 @@ class VideoMetadataUtilities():
     """
 
     @staticmethod
-    def _get_and_check_transcript(video_id: str, cap_lng: str) -> tuple:
+    def _get_and_check_transcript(video_id: str, cap_lng: str, response_cache: ResponseCache = None, request_router: RequestRouter = None,
+                                  fetch_transcript_fn: Callable = None) -> tuple:
         # Get video transcript
-        sequences, srt_content, msg = TranscriptHelper._get_video_transcript(video_id, cap_lng)
+        with StageProfiler.stage('transcript_fetch'):
+            sequences, msg = TranscriptHelper._get_video_transcript(video_id, cap_lng, response_cache, request_router, fetch_transcript_fn)
         if sequences is None:
-            return {'status': False, 'msg': msg}, sequences, srt_content
-        return {'status': True, 'msg': msg}, sequences, srt_content
+            return {'status': False, 'msg': msg}, sequences
+        return {'status': True, 'msg': msg}, sequences
     
     @staticmethod
-    def _check_wpm(sequences: list, min_wpm: int) -> tuple:
+    def _check_wpm(sequences: list, min_wpm: int, video_duration: Decimal) -> tuple:
         if sequences is not None:
-            # Get WPM
-            video_wpm = int(WordsPerMinuteHelper.get_video_wpm(sequences))
+            # Get WPM and the transcript analytics, from one tokenization of the transcript
+            with StageProfiler.stage('wpm'):
+                tokenized = WordsPerMinuteHelper._tokenize(sequences)
+                video_wpm = int(WordsPerMinuteHelper._get_tokenized_wpm([tokenized])[0])
+                transcript_metrics = TranscriptAnalytics.get_metrics(tokenized, video_duration)
             if video_wpm < min_wpm:
-                return False, video_wpm
-            return True, video_wpm
+                return False, video_wpm, transcript_metrics
+            return True, video_wpm, transcript_metrics
         else:
-            return None, Decimal("0")
+            return None, Decimal("0"), None
+
+    @staticmethod
+    def get_transcript_failure_messages(transcript_metrics: dict, input_cfg: dict) -> list:
+        # Check the transcript analytics against the optional constraints of the configuration
+        reasons: list = []
+        if transcript_metrics is None:
+            return reasons
+        if input_cfg.get('min_speech_coverage') is not None and transcript_metrics['speech_coverage'] < input_cfg['min_speech_coverage']:
+            reasons.append('Low speech coverage')
+        if input_cfg.get('max_silence_gap_s') is not None and transcript_metrics['max_silence_gap_s'] > input_cfg['max_silence_gap_s']:
+            reasons.append('Long silence')
+        if input_cfg.get('max_segment_wpm_std') is not None and transcript_metrics['segment_wpm_std'] > input_cfg['max_segment_wpm_std']:
+            reasons.append('Irregular WPM')
+        if input_cfg.get('min_caption_density_per_M') is not None and transcript_metrics['caption_density_per_M'] < input_cfg['min_caption_density_per_M']:
+            reasons.append('Sparse captions')
+        return reasons
     
     @staticmethod
-    def _check_duration(video_duration: float, input_cfg: dict) -> tuple:
-        # Check video length
+    def get_duration_failure_message(video_duration: float, input_cfg: dict) -> str:
+        # Check video length, None if it is in the configured range
+        if video_duration/60 < input_cfg['min_audio_duration_M']:
+            return 'Too short'
+        if video_duration/60 > input_cfg['max_audio_duration_M']:
+            return 'Too long'
+        return None
+
+    @classmethod
+    def _check_duration(cls, video_duration: float, input_cfg: dict) -> tuple:
         video_duration = Decimal(str(video_duration)) # unit [s]
-        if video_duration/60 > input_cfg['min_audio_duration_M'] and video_duration/60 > input_cfg['max_audio_duration_M']:
-            return False, video_duration
-        return True, video_duration
+        return cls.get_duration_failure_message(video_duration, input_cfg), video_duration
     
     @staticmethod
-    def _get_failure_message(seq_cond: dict, wpm_cond: bool, dur_cond: bool) -> str:
+    def _get_failure_message(seq_cond: dict, wpm_cond: bool, dur_failure_msg: str, transcript_failure_msgs: list = None) -> str:
         # Check conditions and create reasons message
         reasons: list = []
 
@@ -128,48 +318,56 @@ class VideoMetadataUtilities():
             pass
         else:
             reasons.append('Unknown WPM')
+        # Check transcript quality
+        reasons.extend(transcript_failure_msgs or [])
         # Check duration
-        if not dur_cond:
-            reasons.append('Too short')
+        if dur_failure_msg is not None:
+            reasons.append(dur_failure_msg)
 
         return ' - '.join(reasons) if len(reasons) > 0 else None
 
     @classmethod
-    def check_video_constraints(cls, video_id: str, input_cfg: dict, video_metadata: dict) -> tuple:
+    def check_video_constraints(cls, video_id: str, input_cfg: dict, video_metadata: dict, response_cache: ResponseCache = None, request_router: RequestRouter = None,
+                                fetch_transcript_fn: Callable = None) -> tuple:
 
         # Check transcripts
-        seq_cond_response, sequences, video_srt_content = cls._get_and_check_transcript(video_id, input_cfg['captions_language'])
-
-        # Check words per minute
-        wpm_cond, video_wpm = cls._check_wpm(sequences, input_cfg['min_wpm'])
+        seq_cond_response, sequences = cls._get_and_check_transcript(video_id, input_cfg['captions_language'], response_cache, request_router, fetch_transcript_fn)
 
         # Check video duration
-        dur_cond, video_duration = cls._check_duration(video_metadata['duration'], input_cfg)
+        dur_failure_msg, video_duration = cls._check_duration(video_metadata['duration'], input_cfg)
+
+        # Check words per minute and transcript quality
+        wpm_cond, video_wpm, transcript_metrics = cls._check_wpm(sequences, input_cfg['min_wpm'], video_duration)
+        transcript_failure_msgs = cls.get_transcript_failure_messages(transcript_metrics, input_cfg)
 
         # Get failure message
-        cnsts_failure_msg = cls._get_failure_message(seq_cond_response, wpm_cond, dur_cond)
+        cnsts_failure_msg = cls._get_failure_message(seq_cond_response, wpm_cond, dur_failure_msg, transcript_failure_msgs)
         cnsts_passed = False if cnsts_failure_msg else True
 
-        return cnsts_passed, cnsts_failure_msg, video_srt_content, {
+        # Metrics are stored as Decimal, as DynamoDB does not accept floats
+        return cnsts_passed, cnsts_failure_msg, sequences, {
             'video_wpm': video_wpm,
-            'video_duration': video_duration
+            'video_duration': video_duration,
+            **{name: Decimal(str(round(value, 3))) for name, value in (transcript_metrics or dict()).items()}
         }
         
     @staticmethod
-    def upload_dl_metadata_report(dynamo_hlp_instance, channel_id: str, video_id: str, video_metadata: dict, response_msg: str, calc_metadata: dict) -> None:
-        # Import download request status
-        dynamo_hlp_instance.import_item(
-            item = {
-                "channel_id": channel_id,
-                "video_id": video_id,
-                **calc_metadata,
-                "video_title": video_metadata['title'],
-                "video_view_count": video_metadata['view_count'],
-                "video_like_count": video_metadata['like_count'],
-                "video_upload_date": pd.Timestamp(video_metadata['upload_date']).strftime('%Y-%m-%d'),
-                "update_time": pd.Timestamp.now().strftime('%Y-%m-%d %H:%m:%S'),
-                "channel_status": "Active",
-                "download_status": response_msg is None,
-                "reason": response_msg
-            }
-        )
\ No newline at end of file
+    def upload_dl_metadata_report(dynamo_hlp_instance, stats_hlp_instance, channel_id: str, video_id: str, video_metadata: dict, response_msg: str, calc_metadata: dict) -> dict:
+        # Import download request status in the background, the imported item is returned
+        item = {
+            "channel_id": channel_id,
+            "video_id": video_id,
+            **calc_metadata,
+            "video_title": video_metadata['title'],
+            "video_view_count": video_metadata['view_count'],
+            "video_like_count": video_metadata['like_count'],
+            "video_upload_date": datetime.strptime(video_metadata['upload_date'], '%Y%m%d').strftime('%Y-%m-%d'),
+            "update_time": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "channel_status": "Active",
+            "download_status": response_msg is None,
+            "reason": response_msg
+        }
+        dynamo_hlp_instance.import_item_buffered(item=item)
+        # Update channel aggregate
+        ChannelPerformanceUtilities.update_channel_stats(stats_hlp_instance, channel_id, video_id, response_msg is None, calc_metadata['video_duration'])
+        return item
\ No newline at end of file
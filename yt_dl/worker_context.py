@@ -0,0 +1,135 @@
+import os
+import threading
+from typing import Callable
+
+import yt_dlp as youtube_dl
+
+from .aws_helpers import DynamoDBHelper, S3Helper
+from .profiling import YoutubeDLHooks
+from .rate_limiting import RequestRouter
+from .response_cache import ResponseCache
+from .sharding import ShardWriter
+from .utils import load_yt_dl_config
+
+
+class WorkerContext:
+    """
+    Per-worker container of resources that are expensive to set up and safe to reuse across videos.
+
+    It holds the AWS helper instances backed by the pooled boto3 clients, the parsed yt_dl configuration
+    and one reusable YoutubeDL extractor per thread and proxy. One context is cached per process and run mode.
+    Download reports are written in the background by the buffered writer of the responses table. In sharded output
+    mode the outputs are packed into the shards of one shard writer per process, and videos are only stored once
+    their shard is uploaded, see `drain_stored_video_ids` and `flush`.
+    The YouTube response cache is stored on the node's disk and shared by all its workers. YouTube requests
+    go through the request router, which is set up from the request settings of the first input configuration of a run.
+    `ydl_cls` and `fetch_transcript_fn` replace the YouTube extractor and the transcript fetch, e.g. by local fakes.
+    """
+
+    RESPONSE_CACHE_PATHS = {
+        True: './data/cache/responses.sqlite',
+        False: '/tmp/yt_dl_cache/responses.sqlite'
+    }
+    SHARD_DIRS = {
+        True: './data/shards',
+        False: '/tmp/shards'
+    }
+
+    _instances = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, run_locally: bool = False, ydl_cls: Callable = None, fetch_transcript_fn: Callable = None) -> None:
+        self.run_locally = run_locally
+        # YouTube clients, the defaults unless replaced
+        self.ydl_cls = ydl_cls or youtube_dl.YoutubeDL
+        self.fetch_transcript_fn = fetch_transcript_fn
+        # Initialize dynamo and s3 helper instances
+        self.dynamo_hlp_instance = DynamoDBHelper(table_name = 'VideoChannelInfoTable')
+        self.stats_hlp_instance = DynamoDBHelper(table_name = 'ChannelStatsTable')
+        self.s3_hlp_instance = S3Helper()
+        # Load yt_dl configuration
+        self.yt_dl_cfg = load_yt_dl_config(run_locally=run_locally)
+        # Initialize YouTube response cache
+        self.response_cache = ResponseCache(self.RESPONSE_CACHE_PATHS[run_locally])
+        self._local = threading.local()
+        self._request_router = None
+        self._request_router_run_id = None
+        self._router_lock = threading.Lock()
+        self._shard_writer = None
+        self._shard_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, run_locally: bool = False, ydl_cls: Callable = None, fetch_transcript_fn: Callable = None) -> 'WorkerContext':
+        # Return the context of the current process, creating it on first use with the given YouTube clients
+        with cls._lock:
+            if run_locally not in cls._instances:
+                cls._instances[run_locally] = cls(run_locally=run_locally, ydl_cls=ydl_cls, fetch_transcript_fn=fetch_transcript_fn)
+            return cls._instances[run_locally]
+
+    def get_raw_yt_dl_cfg(self) -> dict:
+        # Best audio as served, without the ffmpeg postprocessing, written to a raw directory next to the audio files
+        raw_yt_dl_cfg = {key: value for key, value in self.yt_dl_cfg.items() if key not in ('postprocessors', 'postprocessor_args')}
+        raw_yt_dl_cfg['outtmpl'] = os.path.join(os.path.dirname(self.yt_dl_cfg['outtmpl']), 'raw', '%(id)s.%(ext)s')
+        return raw_yt_dl_cfg
+
+    def get_ydl(self, proxy: str = None, raw: bool = False) -> youtube_dl.YoutubeDL:
+        # YoutubeDL is not thread-safe, one extractor is reused per thread, proxy and configuration
+        ydls = self._local.__dict__.setdefault('ydls', dict())
+        if (proxy, raw) not in ydls:
+            # Hooks record the download and postprocessing stages and the retries of the current video
+            hooks = YoutubeDLHooks()
+            ydl_cfg = {**(self.get_raw_yt_dl_cfg() if raw is True else self.yt_dl_cfg), 'logger': hooks}
+            if proxy is not None:
+                ydl_cfg['proxy'] = proxy
+            ydl = self.ydl_cls(ydl_cfg)
+            ydl.add_progress_hook(hooks.progress_hook)
+            ydl.add_postprocessor_hook(hooks.postprocessor_hook)
+            ydls[(proxy, raw)] = ydl
+        return ydls[(proxy, raw)]
+
+    @property
+    def ydl(self) -> youtube_dl.YoutubeDL:
+        return self.get_ydl(proxy=None)
+
+    def get_shard_writer(self, shard_size_MB: float = None) -> ShardWriter:
+        # The shard writer is set up with the shard size of the first sharded video
+        with self._shard_lock:
+            if self._shard_writer is None:
+                self._shard_writer = ShardWriter(
+                    self.s3_hlp_instance,
+                    work_dir=self.SHARD_DIRS[self.run_locally],
+                    max_shard_size_B=int(shard_size_MB * 2**20) if shard_size_MB else None
+                )
+            return self._shard_writer
+
+    def drain_stored_video_ids(self) -> list:
+        # IDs of the sharded videos whose shard was uploaded since the previous call
+        return self._shard_writer.drain_uploaded() if self._shard_writer is not None else list()
+
+    def flush(self) -> list:
+        # Upload the current shard and wait until the download reports imported in the background are written,
+        # returns the IDs of the sharded videos stored since the previous drain
+        if self._shard_writer is not None:
+            self._shard_writer.flush()
+        self.dynamo_hlp_instance.flush()
+        return self.drain_stored_video_ids()
+
+    def get_request_router(self, input_cfg: dict = None, run_id: str = None) -> RequestRouter:
+        # The rate limiter is shared by the workers of the run when running on Ray on AWS, a new run ID sets it up again
+        with self._router_lock:
+            if self._request_router is None or (run_id is not None and run_id != self._request_router_run_id):
+                cluster = False
+                if self.run_locally is False:
+                    # Imported on use, local runs do not need Ray
+                    import ray
+                    cluster = ray.is_initialized()
+                self._request_router = RequestRouter.from_config(input_cfg, cluster=cluster, run_id=run_id)
+                self._request_router_run_id = run_id
+            return self._request_router
+
+    def release_request_router(self) -> None:
+        # Kill the rate limiter actor of the run, the next run sets up its own router
+        with self._router_lock:
+            if self._request_router is not None:
+                self._request_router.rate_limiter.kill()
+            self._request_router, self._request_router_run_id = None, None